@@ -20,6 +20,9 @@ from llm_processing.session3 import Session
 from llm_processing.volume import Volume
 import llm_processing.convert_csv_to_volume as convert_csv_to_volume
 import llm_processing.utility as utility
+from llm_processing.event_bus import format_progress
+from llm_processing.downloader import get_downloader
+from llm_processing.image_store import get_image_store
 import time
 import math
 import json
@@ -33,6 +36,98 @@ REQUIRED_ENV_VARS = {
 
 PROMPT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
 TRANCRIPTION_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output")
+# settings that are legitimately off or zero; every other input must be filled in before processing
+OPTIONAL_INPUT_KEYS = ["adaptive_concurrency", "volume_budget", "daily_budget", "cascade", "hedge_requests", "failover", "normalize_images", "crop_labels"]
+PROGRESS_REFRESH_SECONDS = 2
+ZOOM_VIEWER_HEIGHT = 800
+ZOOM_VIEWER_HTML = """
+<div id="viewer" style="position:relative;width:100%;height:__HEIGHT__px;background:#222;overflow:hidden;cursor:grab">
+    <canvas id="canvas" style="display:block"></canvas>
+    <div style="position:absolute;top:8px;right:8px">
+        <button id="zoom-in">+</button> <button id="zoom-out">-</button> <button id="fit">Fit</button>
+    </div>
+</div>
+<script>
+const info = __INFO__;
+const tileUrl = new URL(".", window.parent.location.href).href + "__TILE_URL__";
+const viewer = document.getElementById("viewer");
+const canvas = document.getElementById("canvas");
+const ctx = canvas.getContext("2d");
+const tiles = {};
+let scale = 1, x = 0, y = 0, fitScale = 1, drag = null;
+
+function getTile(level, col, row) {
+    const key = level + "/" + col + "/" + row;
+    if (!tiles[key]) {
+        tiles[key] = new Image();
+        tiles[key].onload = draw;
+        tiles[key].src = tileUrl.replace("{level}", level).replace("{col}", col).replace("{row}", row);
+    }
+    return tiles[key];
+}
+
+function drawLevel(level) {
+    const [width, height] = info.levels[level];
+    const size = info["tile size"];
+    const fx = info.width / width * scale, fy = info.height / height * scale;
+    for (let col = 0; col < Math.ceil(width / size); col++) {
+        for (let row = 0; row < Math.ceil(height / size); row++) {
+            const left = x + col * size * fx, top = y + row * size * fy;
+            if (left > canvas.width || top > canvas.height || left + size * fx < 0 || top + size * fy < 0) continue;
+            const tile = getTile(level, col, row);
+            if (tile.complete && tile.naturalWidth) ctx.drawImage(tile, left, top, tile.naturalWidth * fx, tile.naturalHeight * fy);
+        }
+    }
+}
+
+function draw() {
+    canvas.width = viewer.clientWidth;
+    canvas.height = viewer.clientHeight;
+    ctx.fillStyle = "#222";
+    ctx.fillRect(0, 0, canvas.width, canvas.height);
+    // the smallest level is always drawn first, so there is something under tiles still loading
+    const lastLevel = info.levels.length - 1;
+    const level = Math.max(0, Math.min(lastLevel, Math.floor(Math.log2(1 / scale))));
+    drawLevel(lastLevel);
+    if (level !== lastLevel) drawLevel(level);
+}
+
+function fit() {
+    fitScale = Math.min(viewer.clientWidth / info.width, viewer.clientHeight / info.height);
+    scale = fitScale;
+    x = (viewer.clientWidth - info.width * scale) / 2;
+    y = (viewer.clientHeight - info.height * scale) / 2;
+    draw();
+}
+
+function zoomAt(px, py, factor) {
+    const newScale = Math.max(fitScale / 2, Math.min(4, scale * factor));
+    x = px - (px - x) * newScale / scale;
+    y = py - (py - y) * newScale / scale;
+    scale = newScale;
+    draw();
+}
+
+viewer.addEventListener("wheel", e => { e.preventDefault(); zoomAt(e.offsetX, e.offsetY, e.deltaY < 0 ? 1.25 : 0.8); }, {passive: false});
+viewer.addEventListener("mousedown", e => { drag = [e.clientX, e.clientY]; viewer.style.cursor = "grabbing"; });
+window.addEventListener("mouseup", () => { drag = null; viewer.style.cursor = "grab"; });
+window.addEventListener("mousemove", e => {
+    if (!drag) return;
+    x += e.clientX - drag[0];
+    y += e.clientY - drag[1];
+    drag = [e.clientX, e.clientY];
+    draw();
+});
+window.addEventListener("resize", draw);
+document.getElementById("zoom-in").onclick = () => zoomAt(canvas.width / 2, canvas.height / 2, 1.5);
+document.getElementById("zoom-out").onclick = () => zoomAt(canvas.width / 2, canvas.height / 2, 1 / 1.5);
+document.getElementById("fit").onclick = fit;
+fit();
+</script>
+"""
+
+def inputs_are_complete():
+    return all(value for key, value in st.session_state.session_obj.input_dict.items() if key not in OPTIONAL_INPUT_KEYS)
 
 def set_up():
     #if "session_obj" not in st.session_state:
@@ -146,16 +241,17 @@ def display_messages(msg):
         st.warning(msg["warning"]) 
 
 def download_images_to_temp_folder(data, image_ref_name, image_dict):
-    for d in data:
-        url = d[image_ref_name]
+    urls = [d[image_ref_name].strip() for d in data if utility.get_image_name_url(d[image_ref_name].strip()) in image_dict["not_found"]]
+    for url, image_bytes in get_downloader().download_many(urls).items():
         image_name = utility.get_image_name_url(url)
+        if isinstance(image_bytes, Exception):
+            print(f"ERROR: could not download {url}: {image_bytes}")
+            continue
         if image_name in image_dict["not_found"]:
-            image = utility.get_image_from_url(url)
-            if image:
-                image_dict["found"].append(image_name)
-                image_dict["not_found"].remove(image_name)
-                image.save(f"temp_images/{image_name}")
-                print(f"downloaded {image_name}")
+            image_dict["found"].append(image_name)
+            image_dict["not_found"].remove(image_name)
+        get_image_store().put(image_bytes, image_name, url)
+        print(f"downloaded {image_name}")
     return image_dict            
          
 def enable_notes_display():
@@ -192,6 +288,7 @@ def handle_proceed_option():
     st.session_state.proceed_option = None
     remaining_initial_batch_size = 3 if not st.session_state.session_obj.pages else max(0, 3 - len(st.session_state.session_obj.pages))
     if proceed_option == "Pause":
+        st.session_state.session_obj.pause_jobs()
         st.session_state.status_msg = "Pausing..."
         return 
     if proceed_option == "Finish Remaining Jobs":
@@ -212,7 +309,7 @@ def handle_proceed_option():
         blank_transcript = utility.get_blank_transcript(st.session_state.selected_prompt_text)
         for failed_job in st.session_state.session_obj.jobs_dict["failed"]:
             idx, image_to_process = failed_job
-            # d = {"image": image, "transcript_obj": transcript_obj, "version_name": version_name, "image_ref": image_ref}
+            # d = {"transcript_obj": transcript_obj, "version_name": version_name, "image_ref": image_ref}
        
     elif proceed_option == "Retry Failed and Remaining Jobs":
         st.session_state.status_msg = "Retrying Failed Jobs and Finishing remaining jobs..."
@@ -234,14 +331,14 @@ def handle_proceed_option():
         st.session_state.pause_button_enabled = False
         st.session_state.background_processing = False
         st.session_state.status_msg = "Cancelling remaining jobs and aborting editing..."
-        time.sleep(3)
+        st.session_state.session_obj.cancel_jobs()
         st.session_state.session_obj.reset_inputs()
         reset_states()
     elif proceed_option == "Cancel All Jobs":
         st.session_state.pause_button_enabled = False
         st.session_state.background_processing = False
         st.session_state.status_msg = "Cancelling remaining jobs..."
-        time.sleep(3)
+        st.session_state.session_obj.cancel_jobs()
         st.session_state.session_obj.reset_inputs()
 
 def is_created_by_FMBT(data_file):
@@ -268,7 +365,7 @@ def locate_images_in_temp_folder(data_file, is_FMBT=False):
             data.append({"imageName": image_name} | val)    
     image_ref_name = find_image_ref_name(data)
     image_names = get_image_names_from_dicts(data, image_ref_name)
-    temp_images = [f.split(r".")[0].lower() for f in os.listdir("temp_images")]
+    temp_images = {f.split(r".")[0].lower() for f in get_image_store().get_image_refs()}
     d = {"found": [], "not_found": [], "image_names": image_names, "temp_images": temp_images}
     for image_name in image_names:
         if image_name.split(r".")[0].lower() in temp_images:
@@ -395,10 +492,16 @@ def display_image_with_rotation(image):
 
 def show_fullscreen_image():
     st.write("## Full-Screen Image Viewer")
-    image = st.session_state.session_obj.volume.current_image
-    st.image(image, caption=f"Full Screen of Image {current_image_idx + 1}", use_container_width=True)
+    previews = st.session_state.session_obj.volume.current_previews
+    current_image_idx = st.session_state.session_obj.volume.current_page_idx
+    html(get_zoom_viewer_html(previews), height=ZOOM_VIEWER_HEIGHT)
+    st.caption(f"Full Screen of Image {current_image_idx + 1}: scroll to zoom, drag to pan")
     st.button("Close Full Screen", on_click=close_fullscreen)
 
+def get_zoom_viewer_html(previews):
+    # the viewer fetches only the tiles in view, at the level the zoom needs, from Streamlit's static file serving
+    return ZOOM_VIEWER_HTML.replace("__INFO__", json.dumps(previews.get_info())).replace("__TILE_URL__", previews.get_tile_url()).replace("__HEIGHT__", str(ZOOM_VIEWER_HEIGHT))
+
 def update_fieldvalue():
     fieldvalue = st.session_state.fieldvalue_key
     st.session_state.session_obj.update_fieldvalue(fieldvalue) 
@@ -406,7 +509,22 @@ def update_fieldvalue():
 def update_status_bar_msg():
     msg = st.session_state.session_obj.msg
     st.session_state.pause_button_enabled = msg["pause_button_enabled"]
-    st.session_state.status_msg = "\n".join(msg["status"][::-1]) if "status" in msg else ""      
+    st.session_state.status_msg = "\n".join(st.session_state.session_obj.get_status_lines()[::-1])
+
+@st.fragment(run_every=PROGRESS_REFRESH_SECONDS)
+def show_background_progress():
+    # reruns on its own while a run is in the background, so progress shows without the user asking for it
+    session_obj = st.session_state.session_obj
+    if not session_obj.background_processing:
+        return
+    progress = session_obj.get_progress()
+    if progress["running"] or (progress["remaining"] and not session_obj.msg["pause_button_enabled"]):
+        st.info(f"Background processing: {format_progress(progress)}")
+        return
+    session_obj.background_processing = False
+    update_status_bar_msg()
+    st.session_state.status_msg = f"{format_progress(progress)}\n{st.session_state.status_msg}"
+    st.rerun()
 
 def update_table_content_option():
     st.session_state.session_obj.table_content_option = "content" if st.session_state.show_content_type=="transcript" else st.session_state.show_content_type
@@ -516,7 +634,7 @@ def main():
     if "session_obj" not in st.session_state or st.session_state.session_obj is None:
         st.session_state.session_obj = Session(user_name)
     update_status_bar_msg()    
-    processing_type = st.radio("Select Processing Operation:", ["Process New Images", "Edit Saved Processed Images (a.k.a. Volume)", "Import CSV (converts to Volume)", "Import JSON (converts to Volume)", "Import Data+Transcriptions from FMBT"])
+    processing_type = st.radio("Select Processing Operation:", ["Process New Images", "Resume Interrupted Run", "Edit Saved Processed Images (a.k.a. Volume)", "Import CSV (converts to Volume)", "Import JSON (converts to Volume)", "Import Data+Transcriptions from FMBT"])
     if processing_type == "Process New Images":
         # Input Settings
         input_settings_container = st.container(border=True)
@@ -618,6 +736,75 @@ def main():
                         st.write("Selected files:")
                         for file in uploaded_files:
                             st.write(f"- {file.name}")
+                st.session_state.session_obj.input_dict["max_workers"] = st.number_input(
+                    "Concurrent Workers (images processed at once):",
+                    min_value=1,
+                    max_value=256,
+                    value=st.session_state.session_obj.input_dict.get("max_workers", 1),
+                    step=1
+                )
+                st.session_state.session_obj.input_dict["execution_mode"] = st.radio(
+                    "Execution Mode:",
+                    ["threads", "asyncio", "pipeline", "batch_api"],
+                    horizontal=True,
+                    help="asyncio keeps many requests in flight on one event loop instead of one thread per worker; pipeline downloads and encodes images in separate stages while earlier images are with the model; batch_api sends the images through each provider's batch endpoint at about half the token price, but results can take hours"
+                )
+                if st.session_state.session_obj.input_dict["execution_mode"] == "batch_api":
+                    st.session_state.session_obj.input_dict["batch_backend"] = st.radio(
+                        "Batch Endpoint:",
+                        ["provider", "local"],
+                        horizontal=True,
+                        help="local runs the submit, poll and download cycle against a stand-in on this machine, without calling any provider"
+                    )
+                st.session_state.session_obj.input_dict["adaptive_concurrency"] = st.checkbox(
+                    "Adaptive Concurrency",
+                    value=st.session_state.session_obj.input_dict.get("adaptive_concurrency", False),
+                    help="Grow the number of images in flight per provider while latency and throttling stay healthy, and back off on throttles; the worker count above becomes the ceiling"
+                )
+                st.session_state.session_obj.input_dict["cascade"] = st.checkbox(
+                    "Cascade Models",
+                    value=st.session_state.session_obj.input_dict.get("cascade", False),
+                    help="Run the models one at a time, starting with the last one selected, and only go on to the next when a transcript has unsure markers, can't be parsed or has a non-ISO collection date; pick a low-cost model last"
+                )
+                st.session_state.session_obj.input_dict["hedge_requests"] = st.checkbox(
+                    "Hedge Slow Requests",
+                    value=st.session_state.session_obj.input_dict.get("hedge_requests", False),
+                    help="When a model call runs longer than 95% of that model's recent calls, send a duplicate and keep whichever answers first; the duplicate's cost is recorded separately as hedge cost"
+                )
+                st.session_state.session_obj.input_dict["failover"] = st.checkbox(
+                    "Fail Over Between Providers",
+                    value=st.session_state.session_obj.input_dict.get("failover", False),
+                    help="When a model's endpoint keeps failing or is out of quota, send its images to the same model served by another provider (e.g. Claude direct and Claude on Bedrock) until it recovers"
+                )
+                st.session_state.session_obj.input_dict["normalize_images"] = st.checkbox(
+                    "Downscale Images for Each Model",
+                    value=st.session_state.session_obj.input_dict.get("normalize_images", True),
+                    help="Send each model the image at the size it works at (e.g. 1568px on the long edge for Claude) instead of the full-resolution scan; see llm_processing/normalization.py"
+                )
+                st.session_state.session_obj.input_dict["crop_labels"] = st.checkbox(
+                    "Crop Sheets to Their Labels",
+                    value=st.session_state.session_obj.input_dict.get("crop_labels", False),
+                    help="Send the label and annotation regions found on each sheet instead of the whole sheet; sheets where the labels can't be found with confidence are sent whole. See llm_processing/label_regions.py"
+                )
+                volume_budget_col, daily_budget_col = st.columns(2)
+                st.session_state.session_obj.input_dict["volume_budget"] = volume_budget_col.number_input(
+                    "Volume Budget ($, 0 = none):",
+                    min_value=0.0,
+                    value=float(st.session_state.session_obj.input_dict.get("volume_budget", 0)),
+                    step=1.0
+                )
+                st.session_state.session_obj.input_dict["daily_budget"] = daily_budget_col.number_input(
+                    "Daily Budget ($, 0 = none):",
+                    min_value=0.0,
+                    value=float(st.session_state.session_obj.input_dict.get("daily_budget", 0)),
+                    step=1.0
+                )
+                st.session_state.session_obj.input_dict["budget_action"] = st.radio(
+                    "When the projected spend is over budget:",
+                    ["pause", "downgrade"],
+                    horizontal=True,
+                    help="downgrade switches the most expensive model to a cheaper Bedrock vision model that fits the budget, and pauses if none does"
+                )
             # Clear selection button
             if st.session_state.session_obj.input_dict["selected_images_info"] and st.button("Clear Selection"):
                 st.session_state.session_obj.input_dict["selected_images_info"] = []
@@ -626,9 +813,9 @@ def main():
 # end input_setting_container
 # Process Images Button
         process_container = st.container(border=True)
-        if all(list(st.session_state.session_obj.input_dict.values())):
+        if inputs_are_complete():
             process_container = st.container(border=True)
-            if all(list(st.session_state.session_obj.input_dict.values())):
+            if inputs_are_complete():
                 with process_container:
                     st.container(height=20, border=False)
                     
@@ -652,20 +839,38 @@ def main():
                     
                 status_bar_col, pause_button_col = st.columns([4, 2])
                 with status_bar_col:
-                    if st.session_state.session_obj.background_processing and st.button("Update Background Processing Status"):
-                        update_status_bar_msg()
-                        total_images = 3 - len(st.session_state.session_obj.input_dict["selected_images_info"])
-                        processed_images = len(st.session_state.session_obj.pages)
-                        remaining = total_images - processed_images
-                        if remaining > 0:
-                            st.info(f"Background processing: {processed_images}/{total_images} images processed")
-                        else:
-                            st.success("Initial batch of images processed!")
+                    show_background_progress()
+                    if st.session_state.session_obj.background_processing:
+                        pause_col, cancel_col = st.columns(2)
+                        if pause_col.button("Pause Processing"):
+                            st.session_state.session_obj.pause_jobs()
+                            st.session_state.status_msg = "Pausing: images already sent to a model will finish first..."
+                        if cancel_col.button("Cancel Processing"):
+                            st.session_state.session_obj.cancel_jobs()
                             st.session_state.session_obj.background_processing = False
+                            st.session_state.status_msg = "Cancelling: requests in flight are being stopped..."
                     status_bar = st.text_area("Status:", st.session_state.status_msg, height=100)
                 if st.session_state.pause_button_enabled:
                     with pause_button_col:
                         proceed_option = st.radio("How to Proceeed?:", ["Pause", "Retry Failed and Remaining Jobs", "Finish Remaining Jobs", "Cancel All Jobs", "Cancel All Jobs and Abort Editing"], index=None, key="proceed_option", on_change=handle_proceed_option)
+    elif processing_type == "Resume Interrupted Run":
+        resume_container = st.container(border=True)
+        with resume_container:
+            resumable_volumes = st.session_state.session_obj.get_resumable_volumes()
+            if not resumable_volumes:
+                st.info("No interrupted runs found.")
+            else:
+                selected_volume_name = st.radio("Select Run to Resume:", resumable_volumes)
+                counts = st.session_state.session_obj.get_job_state_counts(selected_volume_name)
+                st.write(", ".join(f"{state.replace('_', ' ')}: {count}" for state, count in counts.items()))
+                if st.button(f"Resume {selected_volume_name}"):
+                    try:
+                        if st.session_state.session_obj.resume_interrupted_volume(selected_volume_name, utility.get_api_key_dict_from_env()):
+                            process_2nd_batch()
+                        else:
+                            display_messages(st.session_state.session_obj.msg)
+                    except KeyError as e:
+                        st.error(f"Missing API key for {e}; add it to the .env file and try again")
     elif processing_type == "Import Data+Transcriptions from FMBT":
         data_file = st.file_uploader("Upload -data.json from FieldMusemumBedrockTranscription", type=["json"])
         if data_file and is_created_by_FMBT(data_file):
@@ -761,22 +966,15 @@ def main():
     if st.session_state.session_obj.pages:
         if st.session_state.session_obj.background_processing:
             update_status_bar_msg()
-            total_images = 3 - len(st.session_state.session_obj.input_dict["selected_images_info"])
-            processed_images = len(st.session_state.session_obj.pages)
-            remaining = total_images - processed_images
-            if remaining > 0:
-                st.info(f"Background processing: {processed_images}/{total_images} images processed")
-            else:
-                st.success("All images processed!")
-                st.session_state.session_obj.background_processing = False
         st.session_state.session_obj.volume.set_current_page()
         editor_container = st.container(border=False) 
         with editor_container:
             current_image_idx = st.session_state.session_obj.volume.current_page_idx
             col_image, col_editor = st.columns([4,3])
             with col_image:
-                image = st.session_state.session_obj.volume.current_image
-                # Add rotation check and processing
+                # the editor-size preview is sent as it is unless it has to be rotated
+                editor_image_path = st.session_state.session_obj.volume.current_previews.get_editor_path()
+                image = Image.open(editor_image_path)
                 processed_image = display_image_with_rotation(image)
                 orig_width, orig_height = processed_image.size
                 column_width = 600  # Estimate of your column width in pixels
@@ -785,7 +983,7 @@ def main():
                 blank_space_height = max(0, target_position - display_height)
                 blank_space_height = blank_space_height + 50 if blank_space_height != 0 else 0
                 blank_space = st.container(height=blank_space_height, border=False)
-                st.image(processed_image, caption=None, use_container_width=True)
+                st.image(editor_image_path if processed_image is image else processed_image, caption=None, use_container_width=True)
             with col_editor:            
                 col_text, col_fullscreen_button = st.columns([2,1])
                 st.write(f"### Image {current_image_idx+1}")
@@ -0,0 +1,292 @@
+import sys
+import os
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+import argparse
+import csv
+import json
+import signal
+import threading
+import time
+from dotenv import load_dotenv
+from llm_processing.volume import Volume
+from llm_processing.jobs_runner import JobsRunner
+from llm_processing.event_bus import EventBus, ProgressCounters, MetricsExporter
+from llm_processing.downloader import get_downloader
+from llm_processing.job_queue import JobQueue, DEFAULT_QUEUE_PATH
+from llm_processing.image_loader import ImageLoader, IMAGE_EXTENSIONS
+from llm_processing.cascade import DEFAULT_SAMPLE_RATE
+from llm_processing.hedging import HEDGE_PERCENTILE
+from llm_processing.utility import get_api_key_dict_from_env
+
+# usage (from the repo root):
+#   python -m llm_processing.batch --urls urls.txt --prompt "1.5Json.txt" --models claude-3.5-sonnet --volume my-volume --concurrency 16
+#   python -m llm_processing.batch --csv occurrences.csv --prompt "1.5Json.txt" --models gpt-4o claude-3.5-sonnet --volume my-volume
+#   python -m llm_processing.batch --folder test_images --prompt "1.5Json.txt" --models bedrock-us.anthropic.claude-3-5-sonnet-20241022-v2:0 --volume my-volume
+
+CSV_IMAGE_COLUMNS = ["accessURI", "docName"]
+PROGRESS_INTERVAL = 10
+
+
+def read_urls(filename):
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+def read_csv_sources(filename, column=None, image_folder=None):
+    with open(filename, "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
+        column = column or next((name for name in CSV_IMAGE_COLUMNS if name in reader.fieldnames), None)
+        if not column:
+            raise SystemExit(f"{filename} has none of the columns {', '.join(CSV_IMAGE_COLUMNS)}; pick one with --column")
+        for row in reader:
+            source = (row.get(column) or "").strip()
+            if not source:
+                continue
+            if image_folder and "http" not in source:
+                source = os.path.join(image_folder, source)
+            yield source
+
+
+def read_folder(folder):
+    for filename in sorted(os.listdir(folder)):
+        if any(filename.lower().endswith(ext) for ext in IMAGE_EXTENSIONS):
+            yield os.path.join(folder, filename)
+
+
+def get_image_sources(args):
+    if args.urls:
+        return read_urls(args.urls)
+    if args.csv:
+        return read_csv_sources(args.csv, args.column, args.image_folder)
+    return read_folder(args.folder)
+
+
+def get_prompt(prompt):
+    # prompts are looked up by name in the prompts folder, the same as in the app
+    prompt_name = os.path.basename(prompt)
+    prompt_path = f"prompts/{prompt_name}"
+    if not os.path.exists(prompt_path):
+        raise SystemExit(f"{prompt_path} not found; prompt files must be in the prompts folder")
+    with open(prompt_path, "r", encoding="utf-8") as f:
+        return prompt_name, f.read()
+
+
+class ProgressReporter:
+    def __init__(self, job_queue, volume_names, interval=PROGRESS_INTERVAL, jobs_runner=None, progress=None):
+        # volume_names can be several shard volumes, which are reported as one run
+        self.job_queue = job_queue
+        self.jobs_runner = jobs_runner
+        self.progress = progress
+        self.volume_names = volume_names
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.time_started = time.time()
+        self.processed_at_start = self.get_state_counts()["processed"]
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.report()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def get_state_counts(self):
+        counts = {}
+        for volume_name in self.volume_names:
+            for state, n in self.job_queue.get_state_counts(volume_name).items():
+                counts[state] = counts.get(state, 0) + n
+        return counts
+
+    def report(self):
+        counts = self.get_state_counts()
+        elapsed = time.time() - self.time_started
+        processed_this_run = counts["processed"] - self.processed_at_start
+        per_minute = processed_this_run * 60 / elapsed if elapsed else 0
+        if self.progress:
+            # the run's own counters give the recent rate, which the ETA follows
+            snapshot = self.progress.get_snapshot()
+            per_minute = snapshot["images/min"]
+        line = f"[{time.strftime('%H:%M:%S')}] processed {counts['processed']} | failed {counts['failed']} | in flight {counts['in_process']} | queued {counts['to_process']} | {per_minute:.1f} images/min"
+        if self.progress and snapshot["eta mins"] is not None and snapshot["remaining"]:
+            line += f" | about {snapshot['eta mins']:.0f} min left"
+        if self.jobs_runner and self.jobs_runner.budget_governor.is_enabled():
+            line += f" | spent ${self.jobs_runner.budget_governor.volume_spend:.2f}"
+        if self.jobs_runner and self.jobs_runner.adaptive_concurrency:
+            line += " | window " + ", ".join(f"{status['provider']} {status['window']}" for status in self.jobs_runner.get_concurrency_status())
+        open_endpoints = [status["endpoint"] for status in self.jobs_runner.llm_manager.get_endpoint_status() if status["state"] != "closed"] if self.jobs_runner else []
+        if open_endpoints:
+            line += " | unavailable " + ", ".join(open_endpoints)
+        download_status = get_downloader().get_status()
+        if download_status:
+            line += " | downloads " + ", ".join(f"{status['host']} {status['MB/s']} MB/s {status['avg secs']}s avg" for status in download_status)
+        print(line, flush=True)
+
+
+class BatchRun:
+    def __init__(self, args):
+        self.args = args
+        self.msg = {"pause_button_enabled": False, "errors": []}
+        prompt_name, prompt_text = get_prompt(args.prompt)
+        self.input_dict = {
+            "api_key_dict": get_api_key_dict_from_env(),
+            "selected_llms": args.models,
+            "selected_prompt_filename": prompt_name,
+            "prompt_text": prompt_text,
+            "selected_images_info": [],
+            "images_info_type": "batch",
+            "max_workers": args.concurrency,
+            "execution_mode": args.execution_mode,
+            "build_previews": False,
+            "adaptive_concurrency": args.adaptive_concurrency,
+            "volume_budget": args.volume_budget,
+            "budget_volume_name": getattr(args, "budget_volume", None) or args.volume,
+            "daily_budget": args.daily_budget,
+            "budget_action": args.budget_action,
+            "batch_backend": args.batch_backend,
+            "cascade": args.cascade,
+            "cascade_sample_rate": args.cascade_sample_rate,
+            "hedge_requests": args.hedge,
+            "hedge_percentile": args.hedge_percentile,
+            "failover": args.failover,
+            "normalize_images": not args.no_normalize,
+            "crop_labels": args.crop_labels,
+        }
+        self.volume = Volume(self.msg, args.volume)
+        self.ensure_directory_exists(self.volume.volumes_folder)
+        self.image_loader = ImageLoader(build_previews=False)
+        self.job_queue = JobQueue(args.queue_path)
+        self.setup_volume()
+        self.job_queue.add_volume(self.volume.name, self.input_dict, args.user)
+        self.event_bus = EventBus()
+        self.progress = ProgressCounters()
+        self.event_bus.subscribe(self.progress.handle)
+        self.metrics_exporter = MetricsExporter(self.volume.name)
+        self.event_bus.subscribe(self.metrics_exporter.handle)
+        self.jobs_runner = JobsRunner(self.msg, args.user, self.input_dict, self.volume, self.job_queue, self.event_bus)
+
+    def ensure_directory_exists(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def setup_volume(self):
+        volume_file = f"{self.volume.volumes_folder}/{self.volume.name}-volume.json"
+        if not os.path.exists(volume_file):
+            return
+        if not self.args.resume:
+            raise SystemExit(f"{volume_file} already exists; pass --resume to continue it or choose another --volume")
+        self.job_queue.release_expired_leases(self.volume.name)
+        self.volume.load_from_json(volume_file)
+        self.volume.reorder_pages(self.job_queue.get_positions(self.volume.name))
+        print(f"Resuming {self.volume.name} with {len(self.volume.pages)} page(s) already transcribed")
+
+    def get_done_keys(self):
+        # images that failed before are skipped too unless --retry-failed is given
+        states = ["processed"] if self.args.retry_failed else ["processed", "failed"]
+        committed_image_refs = {page["image_ref"] for page in self.volume.pages}
+        return set(self.job_queue.get_job_keys(self.volume.name, states)) | committed_image_refs
+
+    def is_done(self, source, done_keys):
+        return source in done_keys or self.image_loader.get_temp_image_name(source) in done_keys
+
+    def save_dead_letter(self):
+        dead_letter = self.jobs_runner.jobs_dict["dead_letter"]
+        if not dead_letter:
+            return
+        filename = f"{self.volume.volumes_folder}/{self.volume.name}-dead-letter.json"
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(dead_letter, f, ensure_ascii=False, indent=4)
+        print(f"{len(dead_letter)} image(s) failed; see {filename}")
+
+    def handle_interrupt(self, signum, frame):
+        # first Ctrl+C lets images already sent finish, a second one aborts them
+        if self.jobs_runner.cancellation_token.is_paused():
+            print("Cancelling; requests in flight are being stopped")
+            self.jobs_runner.cancel_jobs()
+        else:
+            print("Pausing; images already sent to a model will finish. Press Ctrl+C again to stop them now")
+            self.jobs_runner.pause_jobs()
+
+    def run(self, sources=None):
+        # sources defaults to the input named on the command line; shard workers pass their share of it
+        # only sources are held up front; each image is downloaded and encoded when the pipeline reaches it
+        done_keys = self.get_done_keys() if self.args.resume else set()
+        sources = sources if sources is not None else get_image_sources(self.args)
+        sources = [source for source in sources if not self.is_done(source, done_keys)]
+        reporter = ProgressReporter(self.job_queue, [self.volume.name], self.args.progress_interval, self.jobs_runner, self.progress)
+        if self.args.progress_interval:
+            reporter.start()
+        signal.signal(signal.SIGINT, self.handle_interrupt)
+        try:
+            if sources:
+                self.jobs_runner.load_jobs({"to_process": sources})
+                self.jobs_runner.process_jobs()
+            if self.jobs_runner.cancellation_token.should_stop():
+                print("Stopped early; rerun with --resume to pick up where this run stopped")
+        finally:
+            if self.args.progress_interval:
+                reporter.stop()
+            self.save_dead_letter()
+            self.job_queue.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m llm_processing.batch", description="Transcribe a batch of herbarium images without the Streamlit app.")
+    sources = parser.add_mutually_exclusive_group(required=True)
+    sources.add_argument("--urls", help="text file with one image url per line")
+    sources.add_argument("--csv", help="csv file with an accessURI or docName column")
+    sources.add_argument("--folder", help="folder of .jpg/.jpeg/.png images")
+    parser.add_argument("--column", help="csv column holding the image url or file name (default: accessURI, then docName)")
+    parser.add_argument("--image-folder", help="folder that docName file names in the csv are relative to")
+    parser.add_argument("--prompt", required=True, help="prompt file name in the prompts folder")
+    parser.add_argument("--models", nargs="+", required=True, help="models to run, e.g. claude-3.5-sonnet gpt-4o bedrock-<model id>")
+    parser.add_argument("--volume", required=True, help="volume name; output goes to output/volumes/<volume>-volume.json/.csv")
+    parser.add_argument("--concurrency", type=int, default=4, help="images in flight at once (default: 4)")
+    parser.add_argument("--execution-mode", choices=["threads", "asyncio", "pipeline", "batch_api"], default="pipeline", help="batch_api submits the images through each provider's batch endpoint at about half the token price; results can take hours")
+    parser.add_argument("--batch-backend", choices=["provider", "local"], default="provider", help="with --execution-mode batch_api, local runs the submit/poll/download cycle against a local stand-in instead of the providers")
+    parser.add_argument("--adaptive-concurrency", action="store_true", help="grow and shrink images in flight per provider from latency and throttles; --concurrency becomes the ceiling")
+    parser.add_argument("--cascade", action="store_true", help="run the models one at a time, last listed first, and go on to the next only when a transcript fails checks (unsure markers, unparsable output, non-ISO dates)")
+    parser.add_argument("--cascade-sample-rate", type=float, default=DEFAULT_SAMPLE_RATE, help=f"with --cascade, share of passing transcripts checked against the next model anyway (default: {DEFAULT_SAMPLE_RATE})")
+    parser.add_argument("--hedge", action="store_true", help="send a duplicate of a model call that runs past the model's recent latency percentile; the first answer wins")
+    parser.add_argument("--hedge-percentile", type=float, default=HEDGE_PERCENTILE, help=f"with --hedge, latency percentile a call must pass before it is duplicated (default: {HEDGE_PERCENTILE})")
+    parser.add_argument("--failover", action="store_true", help="when a model's endpoint keeps failing, send its images to the same model served elsewhere (e.g. Claude direct <-> Bedrock); see llm_processing/routing.py")
+    parser.add_argument("--no-normalize", action="store_true", help="send every model the full-resolution image instead of downscaling it to the model's profile; see llm_processing/normalization.py")
+    parser.add_argument("--crop-labels", action="store_true", help="send the label regions found on each sheet instead of the whole sheet, falling back to the whole sheet when detection is unsure; see llm_processing/label_regions.py")
+    parser.add_argument("--volume-budget", type=float, default=0, help="$ limit for this volume, across resumed runs (default: none)")
+    parser.add_argument("--daily-budget", type=float, default=0, help="$ limit for today across every volume using the same job queue (default: none)")
+    parser.add_argument("--budget-action", choices=["pause", "downgrade"], default="pause", help="what to do when the projected spend is over budget")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes; each transcribes a shard of the input into its own volume, merged at the end (default: 1)")
+    parser.add_argument("--user", default="batch", help="user name recorded on the created versions")
+    parser.add_argument("--resume", action="store_true", help="continue an existing volume, skipping images it already has")
+    parser.add_argument("--retry-failed", action="store_true", help="with --resume, also retry images that failed before")
+    parser.add_argument("--queue-path", default=DEFAULT_QUEUE_PATH, help=f"job queue database (default: {DEFAULT_QUEUE_PATH})")
+    parser.add_argument("--progress-interval", type=float, default=PROGRESS_INTERVAL, help="seconds between progress lines; 0 turns them off")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    load_dotenv()
+    args = parse_args(argv)
+    time_started = time.time()
+    if args.processes > 1:
+        from llm_processing.shard_coordinator import ShardCoordinator
+        ShardCoordinator(args).run()
+    else:
+        BatchRun(args).run()
+    print(f"Finished in {(time.time() - time_started) / 60:.1f} mins")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import json
+import os
+import time
+import uuid
+import boto3
+import llm_processing.utility as utility
+from llm_processing.errors import ProcessingError, TransientNetworkError, ProviderFatalError, ParseFailureError, get_error_for_status
+
+# provider batch endpoints bill about half the interactive price and don't draw on interactive rate limits
+BATCH_DISCOUNT = 0.5
+POLL_INTERVAL = 60
+LOCAL_POLL_INTERVAL = 1
+LOCAL_BATCH_DELAY = 2
+LOCAL_BATCHES_FOLDER = "output/local_batches"
+LOCAL_PLACEHOLDER = "[local batch]"
+OPENAI_FILES_URL = "https://api.openai.com/v1/files"
+OPENAI_BATCHES_URL = "https://api.openai.com/v1/batches"
+OPENAI_FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+BEDROCK_FINISHED_STATUSES = ("Completed", "PartiallyCompleted", "Failed", "Stopped", "Expired")
+
+
+def get_custom_id(idx):
+    return f"job-{idx}"
+
+
+def split_s3_uri(s3_uri):
+    bucket, __, prefix = s3_uri.removeprefix("s3://").partition("/")
+    return bucket, prefix.strip("/")
+
+
+class BatchBackend:
+    """Submit, poll and download cycle for one model's provider batch endpoint.
+
+    get_results returns {custom_id: result}, where a result is either the provider's response for that request
+    or a ProcessingError; parse_result turns a response into the (transcript text, costs) pair process_image returns.
+    """
+
+    poll_interval = POLL_INTERVAL
+
+    def __init__(self, processor):
+        self.processor = processor
+
+    def get_request(self, custom_id, base64_image):
+        raise NotImplementedError
+
+    def submit(self, requests):
+        raise NotImplementedError
+
+    def is_finished(self, batch_id):
+        raise NotImplementedError
+
+    def get_results(self, batch_id):
+        raise NotImplementedError
+
+    def cancel(self, batch_id):
+        raise NotImplementedError
+
+    def handle_result(self, result, image_ref, index, start_time):
+        raise NotImplementedError
+
+    def parse_result(self, result, image_ref, index, start_time):
+        transcript_text, costs = self.handle_result(result, image_ref, index, start_time)
+        return transcript_text, costs | self.get_discounted_costs()
+
+    def get_discounted_costs(self):
+        # recomputed from the token counts rather than the rounded interactive costs
+        processor = self.processor
+        return {
+            "input cost $": round((processor.input_tokens / 1_000_000) * processor.input_cost_per_mil * BATCH_DISCOUNT, 3),
+            "output cost $": round((processor.output_tokens / 1_000_000) * processor.output_cost_per_mil * BATCH_DISCOUNT, 3),
+            "batch discount": BATCH_DISCOUNT
+        }
+
+
+class AnthropicBatchBackend(BatchBackend):
+    def get_request(self, custom_id, base64_image):
+        return {"custom_id": custom_id, "params": self.processor.get_message_params(base64_image)}
+
+    def submit(self, requests):
+        return self.processor.client.messages.batches.create(requests=requests).id
+
+    def is_finished(self, batch_id):
+        return self.processor.client.messages.batches.retrieve(batch_id).processing_status == "ended"
+
+    def cancel(self, batch_id):
+        self.processor.client.messages.batches.cancel(batch_id)
+
+    def get_entry_error(self, entry):
+        result = entry.result
+        if result.type != "errored":
+            # expired and canceled requests never reached the model, so they are worth sending again
+            return TransientNetworkError(f"Batch request {entry.custom_id} {result.type}")
+        error = result.error.error
+        message = f"Batch request {entry.custom_id} failed: {error.type}: {error.message}"
+        if error.type in ("api_error", "overloaded_error"):
+            return TransientNetworkError(message)
+        return ProviderFatalError(message)
+
+    def get_results(self, batch_id):
+        results = {}
+        for entry in self.processor.client.messages.batches.results(batch_id):
+            results[entry.custom_id] = entry.result.message if entry.result.type == "succeeded" else self.get_entry_error(entry)
+        return results
+
+    def handle_result(self, message, image_ref, index, start_time):
+        return self.processor.handle_message(message, image_ref, index, start_time)
+
+
+class OpenAIBatchBackend(BatchBackend):
+    def get_request(self, custom_id, base64_image):
+        return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": self.processor.get_payload(base64_image)}
+
+    def get_auth_headers(self):
+        return {"Authorization": f"Bearer {self.processor.api_key}"}
+
+    def check_response(self, response, action):
+        if response.status_code != 200:
+            raise get_error_for_status(response.status_code, f"OpenAI batch {action} failed: {response.text}")
+        return response
+
+    def submit(self, requests):
+        jsonl = "\n".join(json.dumps(request) for request in requests)
+        file_response = self.processor.client.post(OPENAI_FILES_URL, headers=self.get_auth_headers(), data={"purpose": "batch"}, files={"file": ("batch.jsonl", jsonl.encode("utf-8"))})
+        input_file_id = self.check_response(file_response, "upload").json()["id"]
+        batch_payload = {"input_file_id": input_file_id, "endpoint": "/v1/chat/completions", "completion_window": "24h"}
+        batch_response = self.processor.client.post(OPENAI_BATCHES_URL, headers=self.processor.get_headers(), json=batch_payload)
+        return self.check_response(batch_response, "create").json()["id"]
+
+    def get_batch(self, batch_id):
+        return self.check_response(self.processor.client.get(f"{OPENAI_BATCHES_URL}/{batch_id}", headers=self.get_auth_headers()), "status").json()
+
+    def is_finished(self, batch_id):
+        return self.get_batch(batch_id)["status"] in OPENAI_FINISHED_STATUSES
+
+    def cancel(self, batch_id):
+        self.processor.client.post(f"{OPENAI_BATCHES_URL}/{batch_id}/cancel", headers=self.get_auth_headers())
+
+    def get_file_lines(self, file_id):
+        response = self.processor.client.get(f"{OPENAI_FILES_URL}/{file_id}/content", headers=self.get_auth_headers())
+        return [json.loads(line) for line in self.check_response(response, "download").text.splitlines() if line.strip()]
+
+    def get_results(self, batch_id):
+        batch = self.get_batch(batch_id)
+        results = {}
+        for file_key in ["output_file_id", "error_file_id"]:
+            if not batch.get(file_key):
+                continue
+            for entry in self.get_file_lines(batch[file_key]):
+                response = entry.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[entry["custom_id"]] = response
+                else:
+                    error_message = f"Batch request {entry['custom_id']} failed: {entry.get('error') or response.get('body')}"
+                    results[entry["custom_id"]] = get_error_for_status(response.get("status_code", 500), error_message)
+        return results
+
+    def handle_result(self, response, image_ref, index, start_time):
+        return self.processor.handle_response_data(response["body"], response["status_code"], {}, image_ref, index, start_time)
+
+
+class BedrockBatchBackend(BatchBackend):
+    """Bedrock batch inference reads its input from S3 and writes its output back there.
+
+    Needs BEDROCK_BATCH_S3_URI (an s3://bucket/prefix the job can read and write) and BEDROCK_BATCH_ROLE_ARN
+    (a service role Bedrock assumes for that access). Bedrock rejects jobs below its minimum record count,
+    so small runs are better sent interactively.
+    """
+
+    def __init__(self, processor):
+        super().__init__(processor)
+        self.s3_uri = os.getenv("BEDROCK_BATCH_S3_URI", "").rstrip("/")
+        self.role_arn = os.getenv("BEDROCK_BATCH_ROLE_ARN", "")
+        if not self.s3_uri or not self.role_arn:
+            raise ProviderFatalError("Bedrock batch inference needs BEDROCK_BATCH_S3_URI and BEDROCK_BATCH_ROLE_ARN to be set")
+        self.s3_client = boto3.client("s3")
+
+    def get_request(self, custom_id, base64_image):
+        return {"recordId": custom_id, "modelInput": self.processor.format_prompt(base64_image)}
+
+    def submit(self, requests):
+        job_name = f"transcriber-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        bucket, prefix = split_s3_uri(self.s3_uri)
+        job_prefix = f"{prefix}/{job_name}".strip("/")
+        input_key = f"{job_prefix}/input.jsonl"
+        jsonl = "\n".join(json.dumps(request) for request in requests)
+        self.s3_client.put_object(Bucket=bucket, Key=input_key, Body=jsonl.encode("utf-8"))
+        response = self.processor.bedrock_mgmt.create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=self.processor.get_inference_profile_id(),
+            inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{bucket}/{input_key}", "s3InputFormat": "JSONL"}},
+            outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{bucket}/{job_prefix}/output/"}}
+        )
+        return response["jobArn"]
+
+    def get_job(self, job_arn):
+        return self.processor.bedrock_mgmt.get_model_invocation_job(jobIdentifier=job_arn)
+
+    def is_finished(self, job_arn):
+        return self.get_job(job_arn)["status"] in BEDROCK_FINISHED_STATUSES
+
+    def cancel(self, job_arn):
+        self.processor.bedrock_mgmt.stop_model_invocation_job(jobIdentifier=job_arn)
+
+    def get_results(self, job_arn):
+        job = self.get_job(job_arn)
+        if job["status"] not in ("Completed", "PartiallyCompleted"):
+            return {}
+        # output lands under <output uri>/<job id>/<input file name>.out
+        bucket, prefix = split_s3_uri(job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"])
+        job_id = job_arn.split("/")[-1]
+        input_name = job["inputDataConfig"]["s3InputDataConfig"]["s3Uri"].split("/")[-1]
+        output_key = f"{prefix}/{job_id}/{input_name}.out".strip("/")
+        body = self.s3_client.get_object(Bucket=bucket, Key=output_key)["Body"].read().decode("utf-8")
+        results = {}
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "modelOutput" in entry:
+                results[entry["recordId"]] = entry["modelOutput"]
+            else:
+                error = entry.get("error", {})
+                results[entry["recordId"]] = ProviderFatalError(f"Batch record {entry['recordId']} failed: {error.get('errorCode')}: {error.get('errorMessage')}")
+        return results
+
+    def handle_result(self, model_output, image_ref, index, start_time):
+        return self.processor.handle_response_body(model_output, image_ref, start_time)
+
+
+class LocalBatchBackend(BatchBackend):
+    """Stands in for a provider batch endpoint so the batch mode can be run without one.
+
+    Requests and results are JSONL files under output/local_batches/<batch id>, and a batch ends delay seconds
+    after it is submitted. responder(request) returns {"text": ..., "usage": {"input_tokens": ..., "output_tokens": ...}}
+    or raises a ProcessingError; the default fills every prompt field with a placeholder.
+    """
+
+    poll_interval = LOCAL_POLL_INTERVAL
+
+    def __init__(self, processor, delay=LOCAL_BATCH_DELAY, responder=None, folder=LOCAL_BATCHES_FOLDER):
+        super().__init__(processor)
+        self.delay = delay
+        self.responder = responder or self.get_placeholder_response
+        self.folder = folder
+
+    def get_batch_folder(self, batch_id):
+        return f"{self.folder}/{batch_id}"
+
+    def read_jsonl(self, filename):
+        with open(filename, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def write_jsonl(self, filename, entries):
+        with open(filename, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+
+    def get_request(self, custom_id, base64_image):
+        # the image itself stays out of the request file; its size is enough to fake usage
+        return {"custom_id": custom_id, "model": self.processor.model, "image size": len(base64_image)}
+
+    def submit(self, requests):
+        batch_id = f"local-{uuid.uuid4().hex[:12]}"
+        batch_folder = self.get_batch_folder(batch_id)
+        os.makedirs(batch_folder)
+        self.write_jsonl(f"{batch_folder}/requests.jsonl", requests)
+        with open(f"{batch_folder}/status.json", "w", encoding="utf-8") as f:
+            json.dump({"submitted": time.time(), "status": "in_progress"}, f)
+        return batch_id
+
+    def get_status(self, batch_id):
+        with open(f"{self.get_batch_folder(batch_id)}/status.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def is_finished(self, batch_id):
+        status = self.get_status(batch_id)
+        return status["status"] == "cancelled" or time.time() - status["submitted"] >= self.delay
+
+    def cancel(self, batch_id):
+        status = self.get_status(batch_id) | {"status": "cancelled"}
+        with open(f"{self.get_batch_folder(batch_id)}/status.json", "w", encoding="utf-8") as f:
+            json.dump(status, f)
+
+    def get_placeholder_response(self, request):
+        transcript = {fieldname: LOCAL_PLACEHOLDER for fieldname in utility.get_blank_transcript(self.processor.prompt_text)}
+        return {"text": utility.dict_to_string(transcript), "usage": {"input_tokens": request["image size"] // 1000, "output_tokens": len(transcript) * 10}}
+
+    def write_results(self, batch_id):
+        results = []
+        for request in self.read_jsonl(f"{self.get_batch_folder(batch_id)}/requests.jsonl"):
+            try:
+                results.append({"custom_id": request["custom_id"], "response": self.responder(request)})
+            except ProcessingError as e:
+                results.append({"custom_id": request["custom_id"], "error": e.to_dict()})
+        self.write_jsonl(f"{self.get_batch_folder(batch_id)}/results.jsonl", results)
+
+    def get_results(self, batch_id):
+        if self.get_status(batch_id)["status"] == "cancelled":
+            return {}
+        results_file = f"{self.get_batch_folder(batch_id)}/results.jsonl"
+        if not os.path.exists(results_file):
+            self.write_results(batch_id)
+        results = {}
+        for entry in self.read_jsonl(results_file):
+            if "response" in entry:
+                results[entry["custom_id"]] = entry["response"]
+            else:
+                results[entry["custom_id"]] = ProviderFatalError(f"Batch request {entry['custom_id']} failed: {entry['error']['error']}")
+        return results
+
+    def handle_result(self, response, image_ref, index, start_time):
+        self.processor.input_tokens = response["usage"]["input_tokens"]
+        self.processor.output_tokens = response["usage"]["output_tokens"]
+        if not response["text"]:
+            raise ParseFailureError(f"Error processing image {index + 1} image '{image_ref}': empty batch response")
+        return response["text"], self.processor.get_transcript_processing_data((time.time() - start_time) / 60)
+
+
+def get_batch_backend(processor, backend="provider"):
+    if backend == "local":
+        return LocalBatchBackend(processor)
+    if processor.provider == "anthropic":
+        return AnthropicBatchBackend(processor)
+    if processor.provider == "openai":
+        return OpenAIBatchBackend(processor)
+    if processor.provider == "bedrock":
+        return BedrockBatchBackend(processor)
+    raise ProviderFatalError(f"{processor.modelname} has no batch endpoint")
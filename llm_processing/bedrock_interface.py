@@ -6,24 +6,38 @@ parent = os.path.dirname(current)
 sys.path.append(parent)
 
 
+import asyncio
 import boto3
 import base64
+import httpx
 import json
 import time
 import os
 import re
 from typing import Dict, Any, Tuple, Optional
-from botocore.exceptions import ClientError
+from urllib.parse import quote
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.exceptions import BotoCoreError, ClientError
 from llm_processing.llm_interface import ImageProcessor
+from llm_processing.errors import ProcessingError, ThrottledError, TransientNetworkError, ProviderFatalError, ParseFailureError, ImageUnreadableError
 from llm_processing.bedrock.utilities.base64_filter import filter_base64, filter_base64_from_dict
+from llm_processing.image_loader import get_media_type
+
+TRANSIENT_BEDROCK_ERRORS = ("ModelTimeoutException", "ServiceUnavailableException", "InternalServerException", "ModelNotReadyException", "(500)", "(502)", "(503)", "(504)")
 
 class BedrockImageProcessor(ImageProcessor):
+    provider = "bedrock"
+
     def __init__(self, api_key, prompt_name, prompt_text, model, modelname):
         super().__init__(api_key, prompt_name, prompt_text, model, modelname)
         self.bedrock_client = boto3.client("bedrock-runtime")
         self.bedrock_mgmt = boto3.client("bedrock")
         self.model_info = None
         self.account_id = self._get_account_id()
+        self.client = self.get_client()
+        self.async_client = None
+        self.async_client_loop = None
         self.set_token_costs_per_mil()
         print(f"BedrockImageProcessor initialized with model: {self.model}")
     
@@ -205,10 +219,12 @@ class BedrockImageProcessor(ImageProcessor):
                 # For models without inference profiles, use standard Bedrock
                 return self._process_with_bedrock(request_body, base64_image, image_name, start_time)
                 
+        except ProcessingError:
+            raise
         except Exception as e:
             error_message = f"Error processing image: {str(e)}"
             print(error_message)
-            return error_message, {"error": error_message}
+            raise ProviderFatalError(error_message) from e
 
     def convert_to_plain_text(self, d):
         if type(d) == dict:
@@ -222,54 +238,167 @@ class BedrockImageProcessor(ImageProcessor):
         else:
             return json.dumps(d)              
     
+    def handle_response_body(self, response_body: Dict[str, Any], image_name: str, start_time: float) -> Tuple[str, Dict[str, Any]]:
+        """Turn a Bedrock response body into transcript text and processing data."""
+        # Save raw response
+        self.save_raw_response(response_body, image_name)
+        
+        # Extract text from response
+
+        text = self.extract_text(response_body)
+        print(f"before convert_to_plain_text: {type(text) = }, {text = }")
+        text = self.convert_to_plain_text(text)
+        print(f"after convert_to_plain_text: {type(text) = }, {text = }")
+        # Update token usage if available
+        self.update_usage(response_body)
+        
+        # Calculate processing time
+        time_elapsed = (time.time() - start_time) / 60  # in minutes
+        processing_data = self.get_transcript_processing_data(time_elapsed)
+        
+        self.num_processed += 1
+        
+        return text, processing_data
+
+    def is_throttling_error(self, e: Exception) -> bool:
+        """Check whether an invocation failed because Bedrock throttled it."""
+        if isinstance(e, ClientError):
+            return e.response.get("Error", {}).get("Code") == "ThrottlingException"
+        return "ThrottlingException" in str(e) or "(429)" in str(e)
+
+    def get_invoke_error(self, model_id: str, e: Exception, error_message: Optional[str] = None) -> ProcessingError:
+        """Map a failed invocation onto the processing error taxonomy."""
+        error_message = error_message or self.get_invoke_error_message(model_id, e)
+        if self.is_throttling_error(e) or "ServiceQuotaExceededException" in str(e):
+            return ThrottledError(error_message)
+        if isinstance(e, (BotoCoreError, httpx.TransportError)) or any(error_name in str(e) for error_name in TRANSIENT_BEDROCK_ERRORS):
+            return TransientNetworkError(error_message)
+        if "ValidationException" in str(e) and "image" in str(e).lower():
+            return ImageUnreadableError(error_message)
+        return ProviderFatalError(error_message)
+
+    def get_invoke_error_message(self, model_id: str, e: Exception) -> str:
+        """Build an error message for a failed model invocation."""
+        error_message = f"Error invoking model {model_id}: {str(e)}"
+        print(error_message)
+        
+        # Add more context to the error message
+        if "AccessDeniedException" in str(e):
+            error_message += "\nAccess denied: You may not have permissions to use this model or inference profile."
+        elif "ValidationException" in str(e) and "inference profile" in str(e).lower():
+            error_message += "\nInference profile error: The inference profile may not be set up correctly."
+        elif "ResourceNotFoundException" in str(e):
+            error_message += "\nResource not found: The model or inference profile may not exist."
+        return error_message
+    
     def _process_with_bedrock(self, request_body: Dict[str, Any], base64_image: str, 
                              image_name: str, start_time: float) -> Tuple[str, Dict[str, Any]]:
         """Process an image using the Bedrock client."""
         # Determine if we need to use an inference profile
         model_id = self.get_inference_profile_id()
         
-        # Invoke the model
+        # Invoke the model over a signed httpx request rather than boto3, so abort_requests can close it mid-request
         print(f"Invoking model with ID: {model_id}")
+        reservation = self.acquire_rate_limit()
         try:
-            response = self.bedrock_client.invoke_model(
-                modelId=model_id,
-                body=json.dumps(request_body)
-            )
-            
-            response_body = json.loads(response.get("body").read())
-            
-            # Save raw response
-            self.save_raw_response(response_body, image_name)
-            
-            # Extract text from response
+            body = json.dumps(request_body)
+            url, headers = self.get_signed_invoke_request(model_id, body)
+            response = self.client.post(url, content=body, headers=headers)
+            response_body = self.get_invoke_response_body(response)
+        except Exception as e:
+            self.release_rate_limit(reservation, is_throttled=self.is_throttling_error(e))
+            raise self.get_invoke_error(model_id, e) from e
+        try:
+            return self.handle_response_body(response_body, image_name, start_time)
+        except Exception as e:
+            error_message = self.get_invoke_error_message(model_id, e)
+            raise ParseFailureError(error_message) from e
+        finally:
+            self.release_rate_limit(reservation, response.headers, is_completed=True)
 
-            text = self.extract_text(response_body)
-            print(f"before convert_to_plain_text: {type(text) = }, {text = }")
-            text = self.convert_to_plain_text(text)
-            print(f"after convert_to_plain_text: {type(text) = }, {text = }")
-            # Update token usage if available
-            self.update_usage(response_body)
-            
-            # Calculate processing time
-            time_elapsed = (time.time() - start_time) / 60  # in minutes
-            processing_data = self.get_transcript_processing_data(time_elapsed)
-            
-            self.num_processed += 1
-            
-            return text, processing_data
+    def get_client(self) -> httpx.Client:
+        return httpx.Client(timeout=httpx.Timeout(300.0))
+
+    def abort_requests(self):
+        """Close the sync client, so requests in flight on it fail right away; the next call gets a new one."""
+        # requests on the async client are aborted by cancelling their tasks
+        client = self.client
+        self.client = self.get_client()
+        client.close()
+
+    def get_invoke_response_body(self, response: httpx.Response) -> Dict[str, Any]:
+        """Return the JSON body of an InvokeModel response, raising with the Bedrock error type if it failed."""
+        if response.status_code != 200:
+            error_type = response.headers.get("x-amzn-ErrorType", "").split(":")[0]
+            raise Exception(f"{error_type} ({response.status_code}): {response.text}")
+        return response.json()
+
+    def get_async_client(self) -> httpx.AsyncClient:
+        """Get an httpx client for the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.async_client_loop is not loop:
+            self.async_client = httpx.AsyncClient(timeout=httpx.Timeout(300.0), limits=httpx.Limits(max_connections=None, max_keepalive_connections=50))
+            self.async_client_loop = loop
+        return self.async_client
+
+    async def close_async_client(self):
+        """Close the httpx client used for async invocations."""
+        if self.async_client is not None:
+            await self.async_client.aclose()
+            self.async_client = None
+
+    def get_signed_invoke_request(self, model_id: str, body: str) -> Tuple[str, Dict[str, str]]:
+        """Sign an InvokeModel request with the boto3 session credentials (SigV4)."""
+        region = self.bedrock_client.meta.region_name
+        url = f"https://bedrock-runtime.{region}.amazonaws.com/model/{quote(model_id, safe='')}/invoke"
+        aws_request = AWSRequest(method="POST", url=url, data=body, headers={"Content-Type": "application/json", "Accept": "application/json"})
+        credentials = boto3.Session().get_credentials().get_frozen_credentials()
+        SigV4Auth(credentials, "bedrock", region).add_auth(aws_request)
+        return url, dict(aws_request.headers)
+
+    async def _process_with_bedrock_async(self, request_body: Dict[str, Any], image_name: str, 
+                                          start_time: float) -> Tuple[str, Dict[str, Any]]:
+        """Process an image by calling the Bedrock runtime endpoint directly, without a thread per request."""
+        model_id = self.get_inference_profile_id()
+        print(f"Invoking model asynchronously with ID: {model_id}")
+        reservation = await self.acquire_rate_limit_async()
+        try:
+            body = json.dumps(request_body)
+            url, headers = self.get_signed_invoke_request(model_id, body)
+            response = await self.get_async_client().post(url, content=body, headers=headers)
+            response_body = self.get_invoke_response_body(response)
+        except Exception as e:
+            self.release_rate_limit(reservation, is_throttled=self.is_throttling_error(e))
+            raise self.get_invoke_error(model_id, e) from e
+        except BaseException:
+            self.release_rate_limit(reservation)
+            raise
+        try:
+            return self.handle_response_body(response_body, image_name, start_time)
+        except Exception as e:
+            error_message = self.get_invoke_error_message(model_id, e)
+            raise ParseFailureError(error_message) from e
+        finally:
+            self.release_rate_limit(reservation, response.headers, is_completed=True)
+
+    async def process_image_async(self, base64_image: str, image_name: str, image_index: int) -> Tuple[str, Dict[str, Any]]:
+        """Async counterpart of process_image."""
+        if not self.supports_image_processing():
+            raise ValueError(f"Model {self.model} does not support image processing")
+        provider = self.model.split(".")[0] if "." in self.model else ""
+        if self.needs_inference_profile() and provider == "meta":
+            # SageMaker endpoints have no async path here
+            return await super().process_image_async(base64_image, image_name, image_index)
+        start_time = time.time()
+        request_body = self.format_prompt(base64_image)
+        try:
+            return await self._process_with_bedrock_async(request_body, image_name, start_time)
+        except ProcessingError:
+            raise
         except Exception as e:
-            error_message = f"Error invoking model {model_id}: {str(e)}"
+            error_message = f"Error processing image: {str(e)}"
             print(error_message)
-            
-            # Add more context to the error message
-            if "AccessDeniedException" in str(e):
-                error_message += "\nAccess denied: You may not have permissions to use this model or inference profile."
-            elif "ValidationException" in str(e) and "inference profile" in str(e).lower():
-                error_message += "\nInference profile error: The inference profile may not be set up correctly."
-            elif "ResourceNotFoundException" in str(e):
-                error_message += "\nResource not found: The model or inference profile may not exist."
-            
-            return error_message, {"error": error_message}
+            raise ProviderFatalError(error_message) from e
     
     def _process_with_sagemaker(self, request_body: Dict[str, Any], base64_image: str, 
                                image_name: str, start_time: float) -> Tuple[str, Dict[str, Any]]:
@@ -322,7 +451,7 @@ class BedrockImageProcessor(ImageProcessor):
             elif "AccessDeniedException" in str(e):
                 error_message += "\nAccess denied: You may not have permissions to use this SageMaker endpoint."
             
-            return error_message, {"error": error_message}
+            raise self.get_invoke_error(endpoint_name, e, error_message) from e
     
     def update_usage(self, response_data: Dict[str, Any]):
         """Update token usage from response data."""
@@ -495,7 +624,7 @@ class BedrockImageProcessorTesting(ImageProcessor):
         start_time = time.time()
         try:
             if include_random_error and random.random() < RANDOM_ERROR_THRESHOLD:
-                raise Exception("Hypothetical Random Error Occurred")
+                raise TransientNetworkError("Hypothetical Random Error Occurred")
             response_body = self.load_sample_raw_response()
             self.update_usage(response_body)
             text = self.extract_text(response_body)
@@ -503,10 +632,12 @@ class BedrockImageProcessorTesting(ImageProcessor):
             processing_data = self.get_transcript_processing_data(time_elapsed)
             self.num_processed += 1    
             return text, processing_data
+        except ProcessingError:
+            raise
         except Exception as e:
             error_message = f"Error processing image: {str(e)}"
             print(error_message)
-            return error_message, {"error": error_message}
+            raise ProviderFatalError(error_message) from e
     
     def update_usage(self, response_data: Dict[str, Any]):
         """Update token usage from response data."""
@@ -560,7 +691,7 @@ class ClaudeImageProcessor(BedrockImageProcessor):
                             "type": "image",
                             "source": {
                                 "type": "base64",
-                                "media_type": "image/jpeg",
+                                "media_type": get_media_type(base64_image),
                                 "data": base64_image
                             }
                         },
@@ -621,7 +752,7 @@ class NovaImageProcessor(BedrockImageProcessor):
                 "content": [
                     {
                         "image": {
-                            "format": "jpeg",
+                            "format": get_media_type(base64_image).split("/")[1],
                             "source": {"bytes": base64_image},
                         }
                     },
@@ -719,6 +850,10 @@ class MetaImageProcessor(BedrockImageProcessor):
         # Use SageMaker for Meta models
         return self._process_with_sagemaker(request_body, base64_image, image_name, start_time)
 
+    async def process_image_async(self, base64_image: str, image_name: str, image_index: int) -> Tuple[str, Dict[str, Any]]:
+        """SageMaker has no async path here, so run the blocking call off the event loop."""
+        return await ImageProcessor.process_image_async(self, base64_image, image_name, image_index)
+
 
 class MistralImageProcessor(BedrockImageProcessor):
     """Specialized processor for Mistral models."""
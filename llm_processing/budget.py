@@ -0,0 +1,173 @@
+import json
+import os
+import threading
+import time
+
+BEDROCK_VISION_MODELS_PATH = "llm_processing/bedrock/model_info/vision_model_info.json"
+BUDGET_ACTIONS = ["pause", "downgrade"]
+# until a model has transcribed an image, its tokens per image are assumed to be these
+DEFAULT_INPUT_TOKENS_PER_IMAGE = 1500
+DEFAULT_OUTPUT_TOKENS_PER_IMAGE = 500
+
+
+def get_bedrock_vision_models(path=BEDROCK_VISION_MODELS_PATH):
+    # (llm name, input $ per million tokens, output $ per million tokens) for every Bedrock model that passed the image test
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        models = json.load(f)
+    vision_models = []
+    for model in models:
+        pricing = model.get("pricing")
+        if model.get("image_test_success", False) and pricing:
+            vision_models.append((f"bedrock-{model['modelId']}", pricing.get("input", 0), pricing.get("output", 0)))
+    return vision_models
+
+
+def get_cost(input_tokens, output_tokens, input_cost_per_mil, output_cost_per_mil):
+    return (input_tokens * input_cost_per_mil + output_tokens * output_cost_per_mil) / 1_000_000
+
+
+class BudgetGovernor:
+    """Projects a volume's remaining spend from its average tokens per image, and pauses or downgrades before a volume or daily budget runs out.
+
+    Spend is recorded under volume_name, which shard processes set to the volume they are part of, so a volume budget
+    covers all of its shards together. Token history is kept per llm name, the same name models are priced and swapped under. Each model's cost is weighted by
+    the share of images that reached its place in the model order, so a cascade is projected at its observed escalation rate.
+    """
+
+    def __init__(self, volume_name, volume_budget=None, daily_budget=None, action="pause", job_queue=None):
+        self.volume_name = volume_name
+        self.volume_budget = volume_budget or None
+        self.daily_budget = daily_budget or None
+        self.action = action if action in BUDGET_ACTIONS else "pause"
+        self.job_queue = job_queue
+        self.lock = threading.Lock()
+        self.token_totals = {}
+        self.num_images = 0
+        # the number of images that got as far as each step of the model order
+        self.steps_reached = []
+        self.volume_spend = job_queue.get_volume_spend(volume_name) if job_queue else 0
+        self.daily_spend = {}
+
+    def is_enabled(self):
+        return bool(self.volume_budget or self.daily_budget)
+
+    def get_transcript_spend(self, transcript_obj):
+        # a freshly processed transcript only holds the versions the models just created
+        spend = {"cost": 0, "input tokens": 0, "output tokens": 0, "models": {}, "steps": 0}
+        for costs_dict, generation_info in zip(transcript_obj.versions["costs"], transcript_obj.versions["generation info"]):
+            if not generation_info.get("is ai generated"):
+                continue
+            spend["cost"] += costs_dict.get("input cost $", 0) + costs_dict.get("output cost $", 0) + costs_dict.get("hedge cost $", 0)
+            spend["input tokens"] += costs_dict.get("input tokens", 0)
+            spend["output tokens"] += costs_dict.get("output tokens", 0)
+            spend["models"][generation_info.get("endpoint") or generation_info["created by"]] = (costs_dict.get("input tokens", 0), costs_dict.get("output tokens", 0))
+            spend["steps"] += 1
+        return spend
+
+    def record_job(self, job_key, transcript_obj):
+        spend = self.get_transcript_spend(transcript_obj)
+        day = time.strftime("%Y-%m-%d")
+        with self.lock:
+            self.volume_spend += spend["cost"]
+            self.daily_spend[day] = self.daily_spend.get(day, 0) + spend["cost"]
+            self.num_images += 1
+            self.steps_reached += [0] * (spend["steps"] - len(self.steps_reached))
+            for step in range(spend["steps"]):
+                self.steps_reached[step] += 1
+            for llm, (input_tokens, output_tokens) in spend["models"].items():
+                totals = self.token_totals.setdefault(llm, {"images": 0, "input tokens": 0, "output tokens": 0})
+                totals["images"] += 1
+                totals["input tokens"] += input_tokens
+                totals["output tokens"] += output_tokens
+        if self.job_queue:
+            self.job_queue.record_spend(self.volume_name, job_key, spend["cost"], spend["input tokens"], spend["output tokens"])
+            self.volume_spend = self.get_volume_spend()
+        return spend
+
+    def get_average_tokens(self, llm):
+        # a model with no history yet (e.g. one just downgraded to) borrows the average of the others
+        with self.lock:
+            totals = self.token_totals.get(llm)
+            if not totals:
+                images = sum(t["images"] for t in self.token_totals.values())
+                if not images:
+                    return DEFAULT_INPUT_TOKENS_PER_IMAGE, DEFAULT_OUTPUT_TOKENS_PER_IMAGE
+                totals = {"images": images, "input tokens": sum(t["input tokens"] for t in self.token_totals.values()), "output tokens": sum(t["output tokens"] for t in self.token_totals.values())}
+            return totals["input tokens"] / totals["images"], totals["output tokens"] / totals["images"]
+
+    def get_model_cost_per_image(self, llm, input_cost_per_mil, output_cost_per_mil):
+        input_tokens, output_tokens = self.get_average_tokens(llm)
+        return get_cost(input_tokens, output_tokens, input_cost_per_mil, output_cost_per_mil)
+
+    def get_reach_rate(self, step):
+        # every model runs on every image until there is history to say otherwise
+        with self.lock:
+            if not self.num_images:
+                return 1
+            return self.steps_reached[step] / self.num_images if step < len(self.steps_reached) else 0
+
+    def get_model_costs(self, model_prices):
+        # model_prices: (llm name, input $ per million, output $ per million) for each model, in the order they run
+        return [self.get_reach_rate(step) * self.get_model_cost_per_image(llm, input_price, output_price) for step, (llm, input_price, output_price) in enumerate(model_prices)]
+
+    def get_cost_per_image(self, model_prices):
+        return sum(self.get_model_costs(model_prices))
+
+    def get_volume_spend(self):
+        # read back from the queue, so spend by other processes on the same volume counts too
+        if self.job_queue:
+            return self.job_queue.get_volume_spend(self.volume_name)
+        with self.lock:
+            return self.volume_spend
+
+    def get_daily_spend(self):
+        if self.job_queue:
+            return self.job_queue.get_daily_spend()
+        with self.lock:
+            return self.daily_spend.get(time.strftime("%Y-%m-%d"), 0)
+
+    def get_remaining_budget(self):
+        remaining = []
+        if self.volume_budget:
+            remaining.append(self.volume_budget - self.get_volume_spend())
+        if self.daily_budget:
+            remaining.append(self.daily_budget - self.get_daily_spend())
+        return min(remaining) if remaining else None
+
+    def get_projection(self, remaining_images, model_prices):
+        return remaining_images * self.get_cost_per_image(model_prices)
+
+    def is_over_budget(self, remaining_images, model_prices):
+        if not self.is_enabled() or not remaining_images:
+            return False
+        return self.get_projection(remaining_images, model_prices) > self.get_remaining_budget()
+
+    def get_downgrade(self, remaining_images, model_prices, vision_models=None):
+        # swaps the priciest model for the best-priced Bedrock vision model that brings the projection within budget
+        vision_models = get_bedrock_vision_models() if vision_models is None else vision_models
+        remaining_budget = self.get_remaining_budget()
+        model_costs = self.get_model_costs(model_prices)
+        priciest_step = max(range(len(model_costs)), key=lambda step: model_costs[step])
+        priciest_cost, priciest_llm = model_costs[priciest_step], model_prices[priciest_step][0]
+        other_costs = sum(model_costs) - priciest_cost
+        # the replacement takes the priciest model's place, and reaches the same share of images;
+        # a model with no history is priced at the volume's average tokens per image
+        candidates = []
+        for llm, input_price, output_price in vision_models:
+            cost = self.get_reach_rate(priciest_step) * self.get_model_cost_per_image(llm, input_price, output_price)
+            if cost < priciest_cost and remaining_images * (other_costs + cost) <= remaining_budget:
+                candidates.append((cost, llm))
+        if not candidates:
+            return None
+        return priciest_llm, max(candidates)[1]
+
+    def get_status(self):
+        return {
+            "volume spend $": round(self.get_volume_spend(), 4),
+            "daily spend $": round(self.get_daily_spend(), 4),
+            "volume budget $": self.volume_budget,
+            "daily budget $": self.daily_budget,
+            "remaining budget $": self.get_remaining_budget(),
+        }
@@ -0,0 +1,56 @@
+import threading
+from llm_processing.errors import JobCancelledError
+
+
+class CancellationToken:
+    """Shared by a run's workers: pause stops new jobs and lets in-flight ones finish, cancel also aborts requests in flight."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.paused = threading.Event()
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        # callbacks run once, on cancel, from the thread that cancels
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def pause(self):
+        self.paused.set()
+
+    def cancel(self):
+        self.cancelled.set()
+        with self.lock:
+            callbacks = self.callbacks.copy()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error while cancelling: {type(e).__name__}: {e}")
+
+    def reset(self):
+        self.cancelled.clear()
+        self.paused.clear()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    def is_paused(self):
+        return self.paused.is_set()
+
+    def should_stop(self):
+        return self.is_cancelled() or self.is_paused()
+
+    def raise_if_cancelled(self):
+        if self.is_cancelled():
+            raise JobCancelledError("Processing was cancelled")
+
+    def wait(self, seconds):
+        # sleeps that end early on cancel; returns True if cancelled
+        return self.cancelled.wait(seconds)
@@ -0,0 +1,63 @@
+import random
+import re
+from llm_processing.compare2 import TranscriptComparer
+
+UNSURE_MARKERS = ["unsure and check"]
+DATE_FIELDS = ["minimumEventDate", "maximumEventDate"]
+# unknown months and days are entered as 00, as the prompts ask
+ISO_DATE_PATTERN = re.compile(r"^\d{4}-(0\d|1[0-2])-([0-2]\d|3[01])$")
+NO_VALUES = ["", "n/a"]
+DEFAULT_SAMPLE_RATE = 0.05
+MIN_AGREEMENT = 0.8
+
+
+def is_iso_date(value):
+    return bool(ISO_DATE_PATTERN.match(value.strip()))
+
+
+class CascadePolicy:
+    """Decides whether a cheaper model's transcript can stand or the next model in the cascade should run.
+
+    A sample of transcripts that pass the checks are escalated anyway, and the next model's version is
+    compared with them, so a cheap model that passes the checks while getting labels wrong still shows up.
+    """
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, min_agreement=MIN_AGREEMENT):
+        self.sample_rate = sample_rate
+        self.min_agreement = min_agreement
+
+    def get_content_reasons(self, content_dict):
+        values = {fieldname: field["value"] for fieldname, field in content_dict.items() if isinstance(field, dict)}
+        reasons = []
+        if any(marker in value.lower() for value in values.values() for marker in UNSURE_MARKERS):
+            reasons.append("unsure marker")
+        for fieldname in DATE_FIELDS:
+            value = values.get(fieldname, "")
+            if value.strip().lower() not in NO_VALUES and not is_iso_date(value):
+                reasons.append(f"invalid {fieldname}")
+        return reasons
+
+    def get_agreement(self, transcript_obj):
+        versions = transcript_obj.versions
+        comparer = TranscriptComparer(transcript_obj)
+        comparison = comparer.compare_versions(versions["content"][-1], versions["content"][-2], versions["generation info"][-1], versions["generation info"][-2])
+        return comparison["alignment rating"]
+
+    def record_agreement(self, transcript_obj):
+        # returns None when there is no earlier version to compare with
+        if len(transcript_obj.versions["content"]) < 2:
+            return None
+        agreement = self.get_agreement(transcript_obj)
+        transcript_obj.versions["generation info"][-1]["cascade agreement"] = round(agreement, 3)
+        return agreement
+
+    def get_escalation_reasons(self, transcript_obj, is_sampled_check=False):
+        # is_sampled_check means the previous model passed and this model ran only as a spot check of it
+        reasons = self.get_content_reasons(transcript_obj.versions["content"][-1])
+        if is_sampled_check:
+            agreement = self.record_agreement(transcript_obj)
+            if agreement is not None and agreement < self.min_agreement:
+                reasons.append("low agreement")
+        if not reasons and random.random() < self.sample_rate:
+            reasons.append("sampled")
+        return reasons
@@ -1,8 +1,6 @@
 import anthropic
-import base64
-import requests
+import asyncio
 from PIL import Image
-from io import BytesIO
 import json
 import os
 import time
@@ -10,12 +8,19 @@ import traceback
 from llm_processing.utility import extract_info_from_text
 from llm_processing.transcript6 import Transcript
 from llm_processing.llm_interface import ImageProcessor
+from llm_processing.errors import ParseFailureError, TransientNetworkError, get_error_for_status
+from llm_processing.rate_limiter import get_retry_after
+from llm_processing.image_loader import encode_image, get_media_type
 
 class ClaudeImageProcessor(ImageProcessor):
+    provider = "anthropic"
+
     def __init__(self, api_key, prompt_name, prompt_text, model="claude-3-5-sonnet-20240620", modelname="claude-3.5-sonnet"):
     #def __init__(self, api_key, prompt_name, prompt_text, model="claude-3-7-sonnet-20250219", modelname="claude-3.7-sonnet"):    
         super().__init__(api_key, prompt_name, prompt_text, model, modelname)
         self.client = anthropic.Anthropic(api_key=api_key)
+        self.async_client = None
+        self.async_client_loop = None
 
     def set_token_costs_per_mil(self):
         if "3-5-sonnet" in self.model or "3-7-sonnet" in self.model:
@@ -79,62 +84,119 @@ class ClaudeImageProcessor(ImageProcessor):
             
           
 
+    def get_async_client(self):
+        # async clients are bound to the event loop they were first used on
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.async_client_loop is not loop:
+            self.async_client = anthropic.AsyncAnthropic(api_key=self.api_key)
+            self.async_client_loop = loop
+        return self.async_client
+
+    async def close_async_client(self):
+        if self.async_client is not None:
+            await self.async_client.close()
+            self.async_client = None
+
+    def abort_requests(self):
+        # closing the client drops its connections, so requests in flight on it fail right away
+        client = self.client
+        self.client = anthropic.Anthropic(api_key=self.api_key)
+        client.close()
+
+    def get_message_params(self, base64_image):
+        return {
+            "model": "claude-3-5-sonnet-20240620",
+            "max_tokens": 2500,
+            "temperature": 0,
+            "system": (
+                "You are an assistant that has a job to extract text from "
+                "an image and parse it out. Only include the text that is "
+                "relevant to the image. Do not Hallucinate"
+            ),
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": self.prompt_text},
+                        {
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": get_media_type(base64_image),
+                                "data": base64_image,
+                            },
+                        },
+                    ],
+                }
+            ],
+        }
+
+    def handle_message(self, message, image_ref, index, start_time):
+        end_time = time.time()
+        elapsed_time = (end_time - start_time) / 60
+        response_data = self.extract_json(message)
+        self.save_raw_response(response_data, image_ref)
+        self.update_usage(message)
+        transcript_processing_data = self.get_transcript_processing_data(elapsed_time)
+        if not message.content or not message.content[0].text:
+            raise ParseFailureError(f"Error processing image {index + 1} image '{image_ref}': {response_data}")
+        content = self.get_content_from_response(message.content)
+        return content, transcript_processing_data
+
+    def get_request_error(self, e, image_ref, index):
+        error_message = f"Error processing image {index + 1} from image '{image_ref}': {str(e)}"
+        print(f"ERROR: {error_message}")
+        if isinstance(e, anthropic.APIStatusError):
+            return get_error_for_status(e.status_code, error_message, get_retry_after(e.response.headers))
+        return TransientNetworkError(error_message)
+
     def process_image(self, base64_image, image_ref, index):
         start_time = time.time()
+        reservation = self.acquire_rate_limit()
         try:
-            message = self.client.messages.create(
-                model="claude-3-5-sonnet-20240620",
-                max_tokens=2500,
-                temperature=0,
-                system=(
-                    "You are an assistant that has a job to extract text from "
-                    "an image and parse it out. Only include the text that is "
-                    "relevant to the image. Do not Hallucinate"
-                ),
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": self.prompt_text},
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "image/jpeg",
-                                    "data": base64_image,
-                                },
-                            },
-                        ],
-                    }
-                ],
-            )
-            end_time = time.time()
-            elapsed_time = (end_time - start_time) / 60
-            response_data = self.extract_json(message)
-            self.save_raw_response(response_data, image_ref)
-            self.update_usage(message)
-            transcript_processing_data = self.get_transcript_processing_data(elapsed_time)
-            if not message.content or not message.content[0].text:
-                error_message = f"Error processing image {index + 1} image '{image_ref}': {response_data}"
-                return error_message, transcript_processing_data 
-            content = self.get_content_from_response(message.content)
-            return content, transcript_processing_data
-        except requests.exceptions.RequestException as e:
-            error_message = (
-                f"Error processing image {index + 1} from image '{image_ref}': {str(e)}"
-            )
-            print(f"ERROR: {error_message}")
-            return error_message, None
+            raw_response = self.client.messages.with_raw_response.create(**self.get_message_params(base64_image))
+            message = raw_response.parse()
+        except anthropic.APIStatusError as e:
+            self.release_rate_limit(reservation, e.response.headers, is_throttled=e.status_code in (429, 529))
+            raise self.get_request_error(e, image_ref, index) from e
+        except anthropic.APIConnectionError as e:
+            self.release_rate_limit(reservation)
+            raise self.get_request_error(e, image_ref, index) from e
+        except Exception:
+            self.release_rate_limit(reservation)
+            raise
+        try:
+            return self.handle_message(message, image_ref, index, start_time)
+        finally:
+            self.release_rate_limit(reservation, raw_response.headers, is_completed=True)
+
+    async def process_image_async(self, base64_image, image_ref, index):
+        start_time = time.time()
+        reservation = await self.acquire_rate_limit_async()
+        try:
+            raw_response = await self.get_async_client().messages.with_raw_response.create(**self.get_message_params(base64_image))
+            message = await raw_response.parse()
+        except anthropic.APIStatusError as e:
+            self.release_rate_limit(reservation, e.response.headers, is_throttled=e.status_code in (429, 529))
+            raise self.get_request_error(e, image_ref, index) from e
+        except anthropic.APIConnectionError as e:
+            self.release_rate_limit(reservation)
+            raise self.get_request_error(e, image_ref, index) from e
+        except BaseException:
+            self.release_rate_limit(reservation)
+            raise
+        try:
+            return self.handle_message(message, image_ref, index, start_time)
+        finally:
+            self.release_rate_limit(reservation, raw_response.headers, is_completed=True)
 
     def get_image_content_dict(self, image):
-        buffered = BytesIO()
-        image.save(buffered, format="JPEG")
-        base64_image = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        base64_image = encode_image(image)
         return {
             "type": "image",
             "source": {
                 "type": "base64",
-                "media_type": "image/jpeg",
+                "media_type": get_media_type(base64_image),
                 "data": base64_image,
             },
         }                 
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import deque
+
+INITIAL_WINDOW = 4
+MAX_WINDOW = 256
+LATENCY_SAMPLES = 50
+MIN_SAMPLES = 10
+# p95 this far over the best p95 seen counts as congestion
+LATENCY_TOLERANCE = 1.5
+# the best p95 drifts up a little with every sample, so a provider that is slower for the afternoon becomes the new normal
+BASELINE_DRIFT = 0.01
+THROTTLE_RATE_LIMIT = 0.05
+THROTTLE_DECREASE = 0.5
+LATENCY_DECREASE = 0.9
+MIN_DECREASE_INTERVAL = 1.0
+
+
+def get_percentile(values, percentile):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class ConcurrencyController:
+    """AIMD window of requests in flight for one provider: +1 after a window's worth of healthy responses, multiplied down on throttles or rising p95 latency."""
+
+    def __init__(self, provider, initial_window=INITIAL_WINDOW, min_window=1, max_window=MAX_WINDOW):
+        self.provider = provider
+        self.lock = threading.Lock()
+        self.window = float(initial_window)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.throttles = deque(maxlen=LATENCY_SAMPLES)
+        self.baseline_p95 = None
+        self.successes_since_change = 0
+        self.last_decrease = 0
+        self.throttle_count = 0
+
+    def get_window(self):
+        with self.lock:
+            return max(self.min_window, int(self.window))
+
+    def get_p95(self):
+        return get_percentile(self.latencies, 95) if len(self.latencies) >= MIN_SAMPLES else None
+
+    def get_throttle_rate(self):
+        return sum(self.throttles) / len(self.throttles) if self.throttles else 0
+
+    def update_baseline(self):
+        p95 = self.get_p95()
+        if p95 is None:
+            return
+        if self.baseline_p95 is None:
+            self.baseline_p95 = p95
+        self.baseline_p95 = min(p95, self.baseline_p95 * (1 + BASELINE_DRIFT))
+
+    def is_congested(self):
+        p95 = self.get_p95()
+        if p95 is not None and p95 > self.baseline_p95 * LATENCY_TOLERANCE:
+            return True
+        return len(self.throttles) >= MIN_SAMPLES and self.get_throttle_rate() > THROTTLE_RATE_LIMIT
+
+    def decrease(self, factor):
+        # requests sent before the last decrease answer afterwards; count them once per round trip, not once each
+        now = time.monotonic()
+        round_trip = get_percentile(self.latencies, 50) if self.latencies else MIN_DECREASE_INTERVAL
+        if now - self.last_decrease < max(MIN_DECREASE_INTERVAL, round_trip):
+            return
+        self.window = max(self.min_window, self.window * factor)
+        self.last_decrease = now
+        self.successes_since_change = 0
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.throttles.append(False)
+            self.update_baseline()
+            if self.is_congested():
+                self.decrease(LATENCY_DECREASE)
+                return
+            self.successes_since_change += 1
+            if self.successes_since_change >= self.window:
+                self.window = min(self.max_window, self.window + 1)
+                self.successes_since_change = 0
+
+    def record_throttle(self):
+        with self.lock:
+            self.throttles.append(True)
+            self.throttle_count += 1
+            self.decrease(THROTTLE_DECREASE)
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "provider": self.provider,
+                "window": max(self.min_window, int(self.window)),
+                "p95 latency (s)": self.get_p95(),
+                "throttle rate": round(self.get_throttle_rate(), 3),
+                "throttle count": self.throttle_count,
+            }
+
+
+concurrency_controllers = {}
+concurrency_controllers_lock = threading.Lock()
+
+
+def get_concurrency_controller(provider):
+    # one window per provider, shared by every model and worker in the process
+    with concurrency_controllers_lock:
+        if provider not in concurrency_controllers:
+            concurrency_controllers[provider] = ConcurrencyController(provider)
+        return concurrency_controllers[provider]
@@ -35,13 +35,12 @@ def process_dicts(unprocessed_dicts, fieldnames, prompt_filename, modelname, ima
     for image_data in unprocessed_dicts:
         print(f"{image_data = }")
         image_ref = image_data[image_ref_name]
-        image = utility.get_image_from_temp_folder(image_ref)
         transcript_obj = Transcript(image_ref, prompt_filename)
         transcript_obj.initialize_versions()
         content = get_transcript_content(image_data, fieldnames)
         costs = transcript_obj.get_blank_costs_dict() if not all_costs else all_costs[image_ref]
         version_name = transcript_obj.create_transcription_from_ai(content, modelname, costs, old_version_name="base", is_ai_generated=is_ai_generated)
-        page = {"image": image, "transcript_obj": transcript_obj, "version_name": version_name, "image_ref": image_ref}
+        page = {"transcript_obj": transcript_obj, "version_name": version_name, "image_ref": image_ref}
         pages.append(page)
     return pages
 
@@ -0,0 +1,165 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from llm_processing.errors import RetryPolicy, ImageUnreadableError, ThrottledError, TransientNetworkError, JobCancelledError, get_error_for_status
+
+MAX_DOWNLOADS = 16
+# museum image servers are slow and easily overloaded, so each host gets only a few connections at once
+MAX_CONNECTIONS_PER_HOST = 4
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+DOWNLOAD_RETRY_POLICY = RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=15.0)
+
+
+def get_host(url):
+    return urlparse(url).netloc or url
+
+
+class HostStats:
+    def __init__(self, host):
+        self.host = host
+        self.downloads = 0
+        self.failures = 0
+        self.retries = 0
+        self.bytes = 0
+        self.seconds = 0
+
+    def get_status(self):
+        return {
+            "host": self.host,
+            "downloads": self.downloads,
+            "failures": self.failures,
+            "retries": self.retries,
+            "MB": round(self.bytes / 1_000_000, 2),
+            "avg secs": round(self.seconds / self.downloads, 2) if self.downloads else 0,
+            "MB/s": round(self.bytes / 1_000_000 / self.seconds, 2) if self.seconds else 0,
+        }
+
+
+class Downloader:
+    """Fetches images over one pooled requests session, so connections to a host are kept alive between images.
+
+    Each host gets at most max_connections_per_host downloads at once. Transient failures are retried with backoff.
+    Callers asking for a url that is already downloading wait for that download instead of starting another.
+    """
+
+    def __init__(self, max_downloads=MAX_DOWNLOADS, max_connections_per_host=MAX_CONNECTIONS_PER_HOST, retry_policy=DOWNLOAD_RETRY_POLICY):
+        self.max_connections_per_host = max_connections_per_host
+        self.retry_policy = retry_policy
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_downloads, pool_maxsize=max_connections_per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_downloads)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.host_slots = {}
+        self.host_stats = {}
+
+    def get_host_slot(self, host):
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+                self.host_stats[host] = HostStats(host)
+            return self.host_slots[host]
+
+    def download(self, url, cancellation_token=None):
+        # returns the image bytes; concurrent calls for the same url share one download
+        url = url.strip()
+        with self.lock:
+            future = self.in_flight.get(url)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.in_flight[url] = future
+        if not is_owner:
+            return future.result()
+        try:
+            future.set_result(self.fetch(url, cancellation_token))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.in_flight[url]
+        return future.result()
+
+    def download_many(self, urls):
+        # returns {url: bytes or the exception it failed with}, fetching up to max_downloads at once
+        futures = {url: self.executor.submit(self.download, url) for url in dict.fromkeys(urls)}
+        results = {}
+        for url, future in futures.items():
+            try:
+                results[url] = future.result()
+            except Exception as e:
+                results[url] = e
+        return results
+
+    def fetch(self, url, cancellation_token=None):
+        host = get_host(url)
+        host_slot = self.get_host_slot(host)
+        stats = self.host_stats[host]
+        attempt = 1
+        while True:
+            try:
+                with host_slot:
+                    start_time = time.monotonic()
+                    content = self.get_content(url)
+                    elapsed = time.monotonic() - start_time
+                with self.lock:
+                    stats.downloads += 1
+                    stats.bytes += len(content)
+                    stats.seconds += elapsed
+                return content
+            except (ThrottledError, TransientNetworkError) as e:
+                if not self.retry_policy.should_retry(attempt):
+                    with self.lock:
+                        stats.failures += 1
+                    e.attempts = attempt
+                    raise
+                delay = self.retry_policy.get_delay(attempt, e.retry_after)
+                print(f"Retrying download of {url} after {e.error_type} error (attempt {attempt}) in {delay:.1f}s: {e.message}")
+                with self.lock:
+                    stats.retries += 1
+                # a cancelled run stops waiting for its retry rather than sleeping out the backoff
+                if cancellation_token is None:
+                    time.sleep(delay)
+                elif cancellation_token.wait(delay):
+                    raise JobCancelledError(f"Download of {url} was cancelled")
+                attempt += 1
+            except Exception:
+                with self.lock:
+                    stats.failures += 1
+                raise
+
+    def get_content(self, url):
+        try:
+            response = self.session.get(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            raise TransientNetworkError(f"Could not download {url}: {type(e).__name__}: {e}")
+        if response.status_code in (408, 429) or response.status_code >= 500:
+            retry_after = response.headers.get("retry-after")
+            retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+            raise get_error_for_status(response.status_code, f"Could not download {url}: HTTP {response.status_code}", retry_after)
+        if response.status_code >= 400:
+            raise ImageUnreadableError(f"Could not download {url}: HTTP {response.status_code}")
+        return response.content
+
+    def get_status(self):
+        with self.lock:
+            return [stats.get_status() for stats in self.host_stats.values()]
+
+
+downloader = None
+downloader_lock = threading.Lock()
+
+
+def get_downloader():
+    # one per process, so every download path shares the same connection pools and per-host limits
+    global downloader
+    with downloader_lock:
+        if downloader is None:
+            downloader = Downloader()
+        return downloader
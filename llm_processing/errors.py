@@ -0,0 +1,81 @@
+import random
+import requests
+import httpx
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter: attempt n waits a random time up to base_delay * 2**(n-1), capped at max_delay."""
+
+    def __init__(self, max_attempts, base_delay=1.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, attempt):
+        return attempt < self.max_attempts
+
+    def get_delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return max(delay, retry_after) if retry_after else delay
+
+
+class ProcessingError(Exception):
+    error_type = "processing error"
+    retry_policy = RetryPolicy(max_attempts=1)
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+        self.attempts = 1
+
+    def to_dict(self):
+        return {"error type": self.error_type, "error": self.message}
+
+
+class ThrottledError(ProcessingError):
+    error_type = "throttled"
+    retry_policy = RetryPolicy(max_attempts=6, base_delay=2.0, max_delay=120.0)
+
+
+class TransientNetworkError(ProcessingError):
+    error_type = "transient network"
+    retry_policy = RetryPolicy(max_attempts=4, base_delay=1.0, max_delay=30.0)
+
+
+class ProviderFatalError(ProcessingError):
+    error_type = "provider fatal"
+    retry_policy = RetryPolicy(max_attempts=1)
+
+
+class ParseFailureError(ProcessingError):
+    error_type = "parse failure"
+    retry_policy = RetryPolicy(max_attempts=2, base_delay=1.0, max_delay=5.0)
+
+
+class ImageUnreadableError(ProcessingError):
+    error_type = "image unreadable"
+    retry_policy = RetryPolicy(max_attempts=1)
+
+
+class JobCancelledError(ProcessingError):
+    error_type = "cancelled"
+    retry_policy = RetryPolicy(max_attempts=1)
+
+
+def get_error_for_status(status_code, message, retry_after=None):
+    if status_code in (429, 529):
+        return ThrottledError(message, retry_after)
+    if status_code in (408, 409) or status_code >= 500:
+        return TransientNetworkError(message, retry_after)
+    if status_code in (400, 413, 422) and "image" in message.lower():
+        return ImageUnreadableError(message)
+    return ProviderFatalError(message)
+
+
+def classify_error(e):
+    if isinstance(e, ProcessingError):
+        return e
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, httpx.TransportError)):
+        return TransientNetworkError(f"{type(e).__name__}: {e}")
+    return ProcessingError(f"{type(e).__name__}: {e}")
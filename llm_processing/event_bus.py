@@ -0,0 +1,208 @@
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+METRICS_FOLDER = "output/metrics"
+# images/min is worked out over the last few minutes, so the ETA follows a run that speeds up or slows down
+RATE_WINDOW = 300
+MAX_FINISH_TIMES = 5000
+
+
+class Event:
+    event_type = "event"
+
+    def __init__(self, job=None, message="", **data):
+        self.job = job
+        self.message = message
+        self.data = data
+        self.time = time.time()
+
+    def to_dict(self):
+        return {"event type": self.event_type, "time": time.strftime("%Y-%m-%d-%H%M-%S", time.localtime(self.time)), "job": self.job, "message": self.message} | self.data
+
+
+class RunStarted(Event):
+    event_type = "run started"
+
+
+class RunFinished(Event):
+    event_type = "run finished"
+
+
+class RunStatus(Event):
+    event_type = "run status"
+
+
+class JobStarted(Event):
+    event_type = "job started"
+
+
+class JobFinished(Event):
+    event_type = "job finished"
+
+
+class JobFailed(Event):
+    event_type = "job failed"
+
+
+class JobRetrying(Event):
+    event_type = "job retrying"
+
+
+class JobCancelled(Event):
+    event_type = "job cancelled"
+
+
+class CostUpdate(Event):
+    event_type = "cost update"
+
+
+class Subscription:
+    """A subscriber's own queue of events, drained by whichever thread reads it; a callback instead runs on the publishing thread."""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.queue = queue.SimpleQueue()
+
+    def put(self, event):
+        if self.callback:
+            self.callback(event)
+        else:
+            self.queue.put(event)
+
+    def get_events(self):
+        events = []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+
+class EventBus:
+    """Background workers publish typed progress events; the UI, the CLI and the metrics export each subscribe.
+
+    Nothing reads a list another thread is appending to: every subscriber gets its own queue or callback.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = []
+
+    def subscribe(self, callback=None):
+        subscription = Subscription(callback)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def publish(self, event):
+        with self.lock:
+            subscriptions = self.subscriptions.copy()
+        for subscription in subscriptions:
+            try:
+                subscription.put(event)
+            except Exception as e:
+                print(f"Error handling {event.event_type} event: {type(e).__name__}: {e}")
+
+
+class ProgressCounters:
+    """Counts a run's jobs from its events and works out images/min and the ETA from recent finishes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = 0
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.cost = 0
+        self.stopped = False
+        self.is_running = False
+        self.time_started = time.time()
+        self.finish_times = deque(maxlen=MAX_FINISH_TIMES)
+
+    def handle(self, event):
+        with self.lock:
+            if isinstance(event, RunStarted):
+                self.total = event.data["total"]
+                self.processed = event.data["processed"]
+                self.failed = event.data["failed"]
+                self.in_flight = 0
+                self.stopped = False
+                self.is_running = True
+                if not self.finish_times:
+                    self.time_started = event.time
+            elif isinstance(event, RunFinished):
+                self.stopped = event.data.get("stopped", False)
+                self.is_running = False
+            elif isinstance(event, JobStarted):
+                self.in_flight += 1
+            elif isinstance(event, JobFinished):
+                self.in_flight -= 1
+                self.processed += 1
+                self.finish_times.append(event.time)
+            elif isinstance(event, JobFailed):
+                self.in_flight -= 1
+                self.failed += 1
+            elif isinstance(event, JobCancelled):
+                self.in_flight -= 1
+            elif isinstance(event, CostUpdate):
+                self.cost += event.data.get("cost", 0)
+
+    def get_rate(self):
+        # images finished per minute
+        now = time.time()
+        window_start = max(now - RATE_WINDOW, self.time_started)
+        recent = [t for t in self.finish_times if t >= window_start]
+        elapsed = now - window_start
+        return len(recent) * 60 / elapsed if elapsed > 0 else 0
+
+    def get_snapshot(self):
+        with self.lock:
+            remaining = max(0, self.total - self.processed - self.failed)
+            rate = self.get_rate()
+            return {
+                "total": self.total,
+                "processed": self.processed,
+                "failed": self.failed,
+                "in flight": max(0, self.in_flight),
+                "remaining": remaining,
+                "images/min": rate,
+                "eta mins": remaining / rate if rate else None,
+                "cost $": self.cost,
+                "running": self.is_running,
+                "stopped": self.stopped,
+            }
+
+
+def format_progress(snapshot):
+    line = f"{snapshot['processed']}/{snapshot['total']} images processed"
+    if snapshot["failed"]:
+        line += f", {snapshot['failed']} failed"
+    line += f" | {snapshot['images/min']:.1f} images/min"
+    if snapshot["eta mins"] is not None and snapshot["remaining"]:
+        line += f" | about {snapshot['eta mins']:.0f} min left"
+    return line
+
+
+class MetricsExporter:
+    """Appends every event to a JSON lines file, output/metrics/<volume>-events.jsonl by default."""
+
+    def __init__(self, volume_name, folder=METRICS_FOLDER):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.filename = f"{folder}/{volume_name}-events.jsonl"
+        self.lock = threading.Lock()
+
+    def handle(self, event):
+        line = json.dumps(event.to_dict(), ensure_ascii=False, default=str)
+        with self.lock:
+            with open(self.filename, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
@@ -0,0 +1,131 @@
+import asyncio
+import copy
+import threading
+import time
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+from llm_processing.concurrency_controller import get_percentile
+
+HEDGE_PERCENTILE = 95
+DEFAULT_HEDGE_DEADLINE = 30
+MIN_HEDGE_DEADLINE = 2
+LATENCY_SAMPLES = 200
+MIN_SAMPLES = 20
+# hedges are capped at this share of calls, so a provider that is slow across the board isn't sent double the load
+MAX_HEDGE_RATE = 0.1
+
+
+class HedgePolicy:
+    """Sends a duplicate of a model call that runs past that model's recent latency percentile.
+
+    The first answer wins and the other call is aborted. The call that lost is charged to the transcript's
+    costs as hedge cost, estimated as its input tokens, since the prompt and image were sent either way.
+    """
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, max_hedge_rate=MAX_HEDGE_RATE):
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.num_calls = 0
+        self.num_hedged = 0
+
+    def record_latency(self, modelname, latency):
+        with self.lock:
+            self.latencies.setdefault(modelname, deque(maxlen=LATENCY_SAMPLES)).append(latency)
+
+    def get_deadline(self, modelname):
+        with self.lock:
+            latencies = list(self.latencies.get(modelname, []))
+        if len(latencies) < MIN_SAMPLES:
+            return DEFAULT_HEDGE_DEADLINE
+        return max(MIN_HEDGE_DEADLINE, get_percentile(latencies, self.percentile))
+
+    def record_call(self):
+        with self.lock:
+            self.num_calls += 1
+
+    def can_hedge(self):
+        with self.lock:
+            if self.num_hedged >= self.max_hedge_rate * self.num_calls:
+                return False
+            self.num_hedged += 1
+            return True
+
+    def get_status(self):
+        with self.lock:
+            return {"calls": self.num_calls, "hedged": self.num_hedged}
+
+    def add_hedge_costs(self, response, processor):
+        transcript_text, costs = response
+        input_tokens = costs.get("input tokens", 0)
+        hedge_cost = round((input_tokens / 1_000_000) * getattr(processor, "input_cost_per_mil", 0), 3)
+        return transcript_text, costs | {"hedged": True, "hedge input tokens": input_tokens, "hedge cost $": hedge_cost}
+
+    def get_result(self, future):
+        try:
+            return future.result(), None
+        except Exception as e:
+            return None, e
+
+    def run(self, executor, processor, hedge_processor, base64_image, image_ref, index):
+        # processor and hedge_processor are separate instances of the same model, since processors keep token usage on the instance.
+        # Each call runs on a copy, so a loser that can't be aborted doesn't write its token usage onto the processor the worker
+        # reuses next; aborts go to the originals, which swap in a new client and close the one the copy is using
+        self.record_call()
+        start_time = time.monotonic()
+        primary = executor.submit(copy.copy(processor).process_image, base64_image, image_ref, index)
+        done, __ = wait([primary], timeout=self.get_deadline(processor.modelname))
+        if done or not self.can_hedge():
+            response = primary.result()
+            self.record_latency(processor.modelname, time.monotonic() - start_time)
+            return response
+        print(f"Hedging {image_ref} on {processor.modelname} after {time.monotonic() - start_time:.1f}s")
+        hedge = executor.submit(copy.copy(hedge_processor).process_image, base64_image, image_ref, index)
+        callers = {primary: processor, hedge: hedge_processor}
+        # each call's latency runs from its own send, so a winning hedge isn't charged the deadline it waited out
+        send_times = {primary: start_time, hedge: time.monotonic()}
+        pending = set(callers)
+        first_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                response, error = self.get_result(future)
+                if error is not None:
+                    first_error = first_error or error
+                    continue
+                for loser in pending:
+                    callers[loser].abort_requests()
+                self.record_latency(processor.modelname, time.monotonic() - send_times[future])
+                return self.add_hedge_costs(response, processor)
+        raise first_error
+
+    async def run_async(self, processor, hedge_processor, base64_image, image_ref, index):
+        self.record_call()
+        start_time = time.monotonic()
+        primary = asyncio.ensure_future(processor.process_image_async(base64_image, image_ref, index))
+        pending = {primary}
+        try:
+            done, __ = await asyncio.wait(pending, timeout=self.get_deadline(processor.modelname))
+            if done or not self.can_hedge():
+                response = await pending.pop()
+                self.record_latency(processor.modelname, time.monotonic() - start_time)
+                return response
+            print(f"Hedging {image_ref} on {processor.modelname} after {time.monotonic() - start_time:.1f}s")
+            hedge = asyncio.ensure_future(hedge_processor.process_image_async(base64_image, image_ref, index))
+            pending.add(hedge)
+            send_times = {primary: start_time, hedge: time.monotonic()}
+            first_error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        first_error = first_error or task.exception()
+                        continue
+                    self.record_latency(processor.modelname, time.monotonic() - send_times[task])
+                    return self.add_hedge_costs(task.result(), processor)
+            raise first_error
+        finally:
+            # cancelling a losing or abandoned task aborts its request
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,123 @@
+import os
+from PIL import Image
+from io import BytesIO
+import base64
+from llm_processing.errors import ImageUnreadableError
+from llm_processing.downloader import get_downloader
+from llm_processing.image_store import get_image_store
+from llm_processing.previews import get_preview_builder
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+# formats every provider accepts as they are; anything else is encoded to JPEG
+PASSTHROUGH_FORMATS = ["JPEG", "PNG"]
+# the tightest provider limits (Anthropic: 5MB of base64, 8000px a side)
+MAX_PASSTHROUGH_BYTES = 3_750_000
+MAX_PASSTHROUGH_DIMENSION = 8000
+# base64 of each format's file signature
+BASE64_SIGNATURES = {"/9j/": "image/jpeg", "iVBORw0KGgo": "image/png", "R0lGOD": "image/gif", "UklGR": "image/webp"}
+
+
+def get_media_type(base64_image):
+    for signature, media_type in BASE64_SIGNATURES.items():
+        if base64_image.startswith(signature):
+            return media_type
+    return "image/jpeg"
+
+
+def read_source_bytes(image):
+    # the JPEG or PNG bytes an image was opened from; an image that has been converted, rotated or resized has no format
+    if getattr(image, "format", None) not in PASSTHROUGH_FORMATS:
+        return None
+    if isinstance(getattr(image, "fp", None), BytesIO):
+        return image.fp.getvalue()
+    if getattr(image, "filename", ""):
+        with open(image.filename, "rb") as f:
+            return f.read()
+    return None
+
+
+def get_source_bytes(image):
+    # the source bytes, if they can be sent as they are
+    if max(image.size) > MAX_PASSTHROUGH_DIMENSION:
+        return None
+    source_bytes = read_source_bytes(image)
+    return source_bytes if source_bytes is not None and len(source_bytes) <= MAX_PASSTHROUGH_BYTES else None
+
+
+def encode_image(image):
+    source_bytes = get_source_bytes(image)
+    if source_bytes is None:
+        buffer = BytesIO()
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(buffer, format="JPEG")
+        source_bytes = buffer.getvalue()
+    return base64.b64encode(source_bytes).decode('utf-8')
+
+
+class ImageLoader:
+    def __init__(self, temp_images_folder="temp_images", build_previews=True):
+        self.temp_images_folder = temp_images_folder
+        self.image_store = get_image_store(temp_images_folder)
+        self.build_previews = build_previews
+        self.cancellation_token = None
+
+    def get_base64_image(self, image):
+        return encode_image(image)
+
+    def get_temp_image_name(self, image_source):
+        image_name = image_source.replace("\\", "/").split('/')[-1]  # Gets the last part of the URL or path as filename
+        if "http" in image_source and not any(image_name.lower().endswith(ext) for ext in IMAGE_EXTENSIONS):
+            image_name += '.jpg'
+        return image_name
+
+    def get_store_keys(self, image_source):
+        # urls are looked up by url, so images with the same file name on different servers stay apart
+        return {"image_ref": self.get_temp_image_name(image_source), "url": image_source.strip() if "http" in image_source else None}
+
+    def load_image_to_process(self, image_source):
+        # image_source is a url, a path on disk, or the ref of an image already in the image store
+        # the base64 image is left to the model calls, which encode it for each model's normalization profile
+        image_bytes = self.fetch_image_bytes(image_source)
+        image = self.open_image(image_bytes, image_source)
+        return (None, image_source, image)
+
+    def fetch_image_bytes(self, image_source):
+        image_bytes = self.image_store.get_bytes(**self.get_store_keys(image_source))
+        if image_bytes is not None:
+            return image_bytes
+        if "http" in image_source:
+            return self.download_image(image_source)
+        if os.path.exists(image_source):
+            return self.read_file(image_source)
+        raise ImageUnreadableError(f"{image_source} is no longer in the image store")
+
+    def read_file(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def download_image(self, url):
+        return get_downloader().download(url, self.cancellation_token)
+
+    def open_image(self, image_bytes, image_source):
+        # keeps a copy in the image store for the transcript and the editor, and starts building its previews
+        # JPEGs and PNGs only have their header read; pixels are decoded when something needs them
+        try:
+            image = Image.open(BytesIO(image_bytes))
+            is_lazy = image.format in PASSTHROUGH_FORMATS
+            if not is_lazy:
+                image.load()
+        except Exception as e:
+            raise ImageUnreadableError(f"{image_source} could not be opened as an image: {type(e).__name__}: {e}")
+        if image.mode not in ("RGB", "L") and not is_lazy:
+            image = image.convert("RGB")
+        image_hash = self.image_store.put(image_bytes, **self.get_store_keys(image_source))
+        if self.build_previews:
+            get_preview_builder().submit(image_hash)
+        return image
+
+    def save_upload(self, uploaded_file):
+        # uploads are written as they are; decoding waits until the image is processed
+        image_name = uploaded_file.name
+        self.image_store.put(uploaded_file.getvalue(), image_name)
+        return image_name
@@ -0,0 +1,175 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from io import BytesIO
+from PIL import Image
+
+IMAGE_STORE_FOLDER = "temp_images"
+INDEX_FILENAME = "index.sqlite3"
+
+
+def get_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class ImageStore:
+    """Keeps every image once, under the SHA-256 of its bytes, in <folder>/blobs/<first two hex digits>/<hash>.
+
+    A SQLite index maps image refs and urls to hashes, so finding an image is a key lookup rather than a folder scan.
+    The same image saved under two names or from two urls is stored once. Blobs are written to a temporary file and
+    renamed into place, and the index is in WAL mode, so several threads or processes can save images at once.
+    Images copied straight into the folder, as earlier versions stored them, are moved into the store when first looked up.
+    """
+
+    def __init__(self, folder=IMAGE_STORE_FOLDER):
+        self.folder = folder
+        self.blobs_folder = f"{folder}/blobs"
+        if not os.path.exists(self.blobs_folder):
+            os.makedirs(self.blobs_folder)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(f"{folder}/{INDEX_FILENAME}", check_same_thread=False, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER,
+                    time_added REAL
+                )""")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS refs (image_ref TEXT PRIMARY KEY, hash TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, hash TEXT)")
+
+    def execute(self, sql, params=()):
+        with self.lock, self.connection:
+            return self.connection.execute(sql, params).fetchall()
+
+    def get_blob_path(self, image_hash):
+        return f"{self.blobs_folder}/{image_hash[:2]}/{image_hash}"
+
+    def put(self, image_bytes, image_ref=None, url=None):
+        # saves the bytes unless an identical image is already stored, maps image_ref and url to them, and returns the hash
+        image_hash = get_hash(image_bytes)
+        blob_path = self.get_blob_path(image_hash)
+        if not os.path.exists(blob_path):
+            self.write_blob(blob_path, image_bytes)
+        self.add_to_index(image_hash, len(image_bytes), image_ref, url)
+        return image_hash
+
+    def write_blob(self, blob_path, image_bytes):
+        directory = os.path.dirname(blob_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(image_bytes)
+            os.replace(temp_path, blob_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def add_to_index(self, image_hash, size, image_ref=None, url=None):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO blobs (hash, size, time_added) VALUES (?, ?, ?)", (image_hash, size, time.time()))
+            if image_ref:
+                self.connection.execute("INSERT OR REPLACE INTO refs (image_ref, hash) VALUES (?, ?)", (image_ref, image_hash))
+            if url:
+                self.connection.execute("INSERT OR REPLACE INTO urls (url, hash) VALUES (?, ?)", (url.strip(), image_hash))
+
+    def get_image_hash(self, image_ref=None, url=None):
+        # images from a url are looked up by url, since two servers can use the same file name for different images;
+        # the file name is only trusted for images saved before urls were recorded
+        if url:
+            rows = self.execute("SELECT hash FROM urls WHERE url = ?", (url.strip(),))
+            if rows:
+                return rows[0]["hash"]
+            return self.adopt_legacy_download(image_ref, url) if image_ref else None
+        if image_ref:
+            rows = self.execute("SELECT hash FROM refs WHERE image_ref = ?", (image_ref,))
+            if rows:
+                return rows[0]["hash"]
+            return self.adopt_loose_file(image_ref)
+        return None
+
+    def has(self, image_ref=None, url=None):
+        return self.get_path(image_ref, url) is not None
+
+    def get_path(self, image_ref=None, url=None):
+        image_hash = self.get_image_hash(image_ref, url)
+        if image_hash is None:
+            return None
+        blob_path = self.get_blob_path(image_hash)
+        return blob_path if os.path.exists(blob_path) else None
+
+    def get_bytes(self, image_ref=None, url=None):
+        blob_path = self.get_path(image_ref, url)
+        if blob_path is None:
+            return None
+        with open(blob_path, "rb") as f:
+            return f.read()
+
+    def open_image(self, image_ref=None, url=None):
+        image_bytes = self.get_bytes(image_ref, url)
+        if image_bytes is None:
+            raise FileNotFoundError(f"{image_ref or url} is not in the image store")
+        return Image.open(BytesIO(image_bytes))
+
+    def get_image_refs(self):
+        self.adopt_loose_files()
+        return [row["image_ref"] for row in self.execute("SELECT image_ref FROM refs")]
+
+    def adopt_loose_file(self, image_ref):
+        # moves an image copied into the folder by hand into the store
+        loose_path = f"{self.folder}/{os.path.basename(image_ref)}"
+        if os.path.basename(image_ref) in ("", INDEX_FILENAME) or not os.path.isfile(loose_path):
+            return None
+        try:
+            with open(loose_path, "rb") as f:
+                image_bytes = f.read()
+            image_hash = self.put(image_bytes, os.path.basename(image_ref))
+            os.remove(loose_path)
+        except FileNotFoundError:
+            # another thread or process adopted it first
+            rows = self.execute("SELECT hash FROM refs WHERE image_ref = ?", (os.path.basename(image_ref),))
+            return rows[0]["hash"] if rows else None
+        return image_hash
+
+    def adopt_legacy_download(self, image_ref, url):
+        # earlier versions saved downloads as <folder>/<file name> with no record of the url; use that image rather than
+        # downloading it again, whether it is still loose or was adopted already, as long as no other url claims it
+        image_hash = self.adopt_loose_file(image_ref)
+        if image_hash is None:
+            rows = self.execute("SELECT hash FROM refs WHERE image_ref = ? AND hash NOT IN (SELECT hash FROM urls)", (os.path.basename(image_ref),))
+            image_hash = rows[0]["hash"] if rows else None
+        if image_hash is not None:
+            with self.lock, self.connection:
+                self.connection.execute("INSERT OR IGNORE INTO urls (url, hash) VALUES (?, ?)", (url.strip(), image_hash))
+        return image_hash
+
+    def adopt_loose_files(self):
+        for filename in os.listdir(self.folder):
+            if not filename.startswith(INDEX_FILENAME) and os.path.isfile(f"{self.folder}/{filename}"):
+                self.adopt_loose_file(filename)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+image_stores = {}
+image_stores_lock = threading.Lock()
+
+
+def get_image_store(folder=IMAGE_STORE_FOLDER):
+    # one per folder per process, sharing its index connection across threads
+    with image_stores_lock:
+        if folder not in image_stores:
+            image_stores[folder] = ImageStore(folder)
+        return image_stores[folder]
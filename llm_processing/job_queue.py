@@ -0,0 +1,193 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+JOB_STATES = ["to_process", "in_process", "processed", "failed"]
+DEFAULT_QUEUE_PATH = "output/job_queue.sqlite3"
+DEFAULT_LEASE_SECONDS = 120
+# settings needed to pick a run back up; API keys are never written to disk
+RESUMABLE_SETTINGS = ["selected_llms", "selected_prompt_filename", "prompt_text", "images_info_type", "max_workers", "execution_mode", "adaptive_concurrency", "volume_budget", "daily_budget", "budget_action", "batch_backend", "cascade", "cascade_sample_rate", "hedge_requests", "hedge_percentile", "failover", "normalize_images", "crop_labels"]
+
+
+class JobQueue:
+    """Job state for every volume in a local SQLite file, so a restarted app knows what is done and what is left."""
+
+    def __init__(self, db_path=DEFAULT_QUEUE_PATH, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lock = threading.Lock()
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS volumes (
+                    volume_name TEXT PRIMARY KEY,
+                    user_name TEXT,
+                    settings TEXT,
+                    time_created TEXT
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    volume_name TEXT,
+                    job_key TEXT,
+                    position INTEGER,
+                    state TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    error_type TEXT,
+                    error TEXT,
+                    time_updated REAL,
+                    PRIMARY KEY (volume_name, job_key)
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (volume_name, state, position)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS spend (
+                    volume_name TEXT,
+                    job_key TEXT,
+                    day TEXT,
+                    cost REAL,
+                    input_tokens INTEGER,
+                    output_tokens INTEGER,
+                    time_recorded REAL
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS spend_day ON spend (day)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS spend_volume ON spend (volume_name)")
+
+    def execute(self, sql, params=()):
+        with self.lock, self.connection:
+            return self.connection.execute(sql, params).fetchall()
+
+    def execute_update(self, sql, params=()):
+        # returns True if any row was updated
+        with self.lock, self.connection:
+            return self.connection.execute(sql, params).rowcount > 0
+
+    def executemany(self, sql, rows):
+        with self.lock, self.connection:
+            self.connection.executemany(sql, rows)
+
+    def add_volume(self, volume_name, input_dict, user_name):
+        settings = {name: input_dict.get(name) for name in RESUMABLE_SETTINGS}
+        self.execute(
+            "INSERT OR REPLACE INTO volumes (volume_name, user_name, settings, time_created) VALUES (?, ?, ?, ?)",
+            (volume_name, user_name, json.dumps(settings), time.strftime("%Y-%m-%d-%H%M-%S")))
+
+    def get_volume_settings(self, volume_name):
+        rows = self.execute("SELECT user_name, settings FROM volumes WHERE volume_name = ?", (volume_name,))
+        if not rows:
+            return None
+        return {"user_name": rows[0]["user_name"]} | json.loads(rows[0]["settings"])
+
+    def enqueue(self, volume_name, job_keys):
+        rows = self.execute("SELECT COALESCE(MAX(position), -1) AS last FROM jobs WHERE volume_name = ?", (volume_name,))
+        first_position = rows[0]["last"] + 1
+        now = time.time()
+        self.executemany(
+            "INSERT OR IGNORE INTO jobs (volume_name, job_key, position, state, time_updated) VALUES (?, ?, ?, 'to_process', ?)",
+            [(volume_name, job_key, first_position + idx, now) for idx, job_key in enumerate(job_keys)])
+
+    def lease(self, volume_name, job_key):
+        # returns False if the job is already processed, or another owner holds a lease on it that hasn't expired
+        now = time.time()
+        return self.execute_update(
+            "UPDATE jobs SET state = 'in_process', attempts = attempts + 1, lease_owner = ?, lease_expires = ?, time_updated = ? WHERE volume_name = ? AND job_key = ? AND (state IN ('to_process', 'failed') OR (state = 'in_process' AND (lease_expires < ? OR lease_owner = ?)))",
+            (self.owner, now + self.lease_seconds, now, volume_name, job_key, now, self.owner))
+
+    def renew_leases(self):
+        now = time.time()
+        self.execute(
+            "UPDATE jobs SET lease_expires = ? WHERE state = 'in_process' AND lease_owner = ?",
+            (now + self.lease_seconds, self.owner))
+
+    def release_lease(self, volume_name, job_key):
+        self.execute(
+            "UPDATE jobs SET state = 'to_process', lease_owner = NULL, lease_expires = NULL, time_updated = ? WHERE volume_name = ? AND job_key = ? AND state = 'in_process'",
+            (time.time(), volume_name, job_key))
+
+    def release_expired_leases(self, volume_name):
+        now = time.time()
+        self.execute(
+            "UPDATE jobs SET state = 'to_process', lease_owner = NULL, lease_expires = NULL, time_updated = ? WHERE volume_name = ? AND state = 'in_process' AND lease_expires < ?",
+            (now, volume_name, now))
+
+    def release_own_leases(self, volume_name):
+        now = time.time()
+        self.execute(
+            "UPDATE jobs SET state = 'to_process', lease_owner = NULL, lease_expires = NULL, time_updated = ? WHERE volume_name = ? AND state = 'in_process' AND lease_owner = ?",
+            (now, volume_name, self.owner))
+
+    def mark_processed(self, volume_name, job_key):
+        # only the lease owner records an outcome (or anyone, for a job nobody holds), so a worker whose lease expired
+        # can't overwrite the outcome from the process that took the job over; returns False when refused
+        return self.execute_update(
+            "UPDATE jobs SET state = 'processed', lease_owner = NULL, lease_expires = NULL, error_type = NULL, error = NULL, time_updated = ? WHERE volume_name = ? AND job_key = ? AND (lease_owner IS NULL OR lease_owner = ?)",
+            (time.time(), volume_name, job_key, self.owner))
+
+    def mark_failed(self, volume_name, job_key, error_type, error):
+        # refused like mark_processed
+        return self.execute_update(
+            "UPDATE jobs SET state = 'failed', lease_owner = NULL, lease_expires = NULL, error_type = ?, error = ?, time_updated = ? WHERE volume_name = ? AND job_key = ? AND (lease_owner IS NULL OR lease_owner = ?)",
+            (error_type, error, time.time(), volume_name, job_key, self.owner))
+
+    def requeue(self, volume_name, job_keys):
+        now = time.time()
+        self.executemany(
+            "UPDATE jobs SET state = 'to_process', error_type = NULL, error = NULL, time_updated = ? WHERE volume_name = ? AND job_key = ?",
+            [(now, volume_name, job_key) for job_key in job_keys])
+
+    def get_job_keys(self, volume_name, states):
+        placeholders = ", ".join("?" for __ in states)
+        rows = self.execute(
+            f"SELECT job_key FROM jobs WHERE volume_name = ? AND state IN ({placeholders}) ORDER BY position",
+            (volume_name, *states))
+        return [row["job_key"] for row in rows]
+
+    def get_positions(self, volume_name):
+        rows = self.execute("SELECT job_key, position FROM jobs WHERE volume_name = ?", (volume_name,))
+        return {row["job_key"]: row["position"] for row in rows}
+
+    def get_state_counts(self, volume_name):
+        rows = self.execute("SELECT state, COUNT(*) AS n FROM jobs WHERE volume_name = ? GROUP BY state", (volume_name,))
+        counts = {state: 0 for state in JOB_STATES}
+        counts.update({row["state"]: row["n"] for row in rows})
+        return counts
+
+    def record_spend(self, volume_name, job_key, cost, input_tokens, output_tokens):
+        self.execute(
+            "INSERT INTO spend (volume_name, job_key, day, cost, input_tokens, output_tokens, time_recorded) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (volume_name, job_key, time.strftime("%Y-%m-%d"), cost, input_tokens, output_tokens, time.time()))
+
+    def get_volume_spend(self, volume_name):
+        rows = self.execute("SELECT COALESCE(SUM(cost), 0) AS total FROM spend WHERE volume_name = ?", (volume_name,))
+        return rows[0]["total"]
+
+    def get_daily_spend(self, day=None):
+        # across every volume and process using this queue file
+        rows = self.execute("SELECT COALESCE(SUM(cost), 0) AS total FROM spend WHERE day = ?", (day or time.strftime("%Y-%m-%d"),))
+        return rows[0]["total"]
+
+    def get_volume_names(self, prefix):
+        rows = self.execute("SELECT DISTINCT volume_name FROM jobs WHERE substr(volume_name, 1, ?) = ? ORDER BY volume_name", (len(prefix), prefix))
+        return [row["volume_name"] for row in rows]
+
+    def get_unfinished_volumes(self):
+        rows = self.execute(
+            "SELECT DISTINCT volume_name FROM jobs WHERE state IN ('to_process', 'in_process') ORDER BY volume_name")
+        return [row["volume_name"] for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,19 +1,62 @@
-
-
-
-
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import asyncio
+import threading
+import time
 #from llm_processing.llm_manager_testing import LLMManager
 from llm_processing.llm_manager4 import LLMManager
-from llm_processing.transcript6 import Transcript
+from llm_processing.errors import classify_error, JobCancelledError
+from llm_processing.cancellation import CancellationToken
+from llm_processing.budget import BudgetGovernor
+from llm_processing.cascade import CascadePolicy, DEFAULT_SAMPLE_RATE
+from llm_processing.hedging import HedgePolicy, HEDGE_PERCENTILE
+from llm_processing.image_loader import ImageLoader
+from llm_processing.pipeline import Pipeline
+from llm_processing.scheduler import LaneScheduler
+from llm_processing.event_bus import EventBus, RunStarted, RunFinished, RunStatus, JobStarted, JobFinished, JobFailed, JobRetrying, JobCancelled, CostUpdate
+
+LEASE_RENEWAL_INTERVAL = 30
+WINDOW_POLL_INTERVAL = 0.1
+# batch files embed every image as base64; a chunk is closed once its images pass this size, which leaves room for the
+# one that crossed it under the providers' per-file limits (200 MB for OpenAI, 256 MB for Anthropic)
+BATCH_API_CHUNK_MB = 150
+BATCH_API_MAX_REQUESTS = 10_000
 
 class JobsRunner:
-    def __init__(self, msg, user_name, input_dict, volume):
+    def __init__(self, msg, user_name, input_dict, volume, job_queue=None, event_bus=None):
         self.msg = msg
+        self.event_bus = event_bus or EventBus()
         self.input_dict = input_dict 
         self.user_name = user_name
         self.volume = volume 
+        self.max_workers = max(1, int(input_dict.get("max_workers", 1)))
+        self.execution_mode = input_dict.get("execution_mode", "threads")
+        self.adaptive_concurrency = input_dict.get("adaptive_concurrency", False)
+        self.batch_backend = input_dict.get("batch_backend", "provider")
+        self.image_loader = ImageLoader(build_previews=input_dict.get("build_previews", True))
+        self.lock = threading.Lock()
         self.jobs_dict = self.get_blank_jobs_dict()
+        self.job_order = {}
+        self.lanes = LaneScheduler()
+        self.job_queue = job_queue
+        self.last_lease_renewal = time.time()
+        # one pool for every run and resume, so worker threads and the processors they hold are reused
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
         self.llm_manager = self.get_llm_manager()
+        self.llm_manager.set_max_workers(self.max_workers)
+        self.cancellation_token = CancellationToken()
+        self.llm_manager.set_cancellation_token(self.cancellation_token)
+        self.image_loader.cancellation_token = self.cancellation_token
+        self.cancellation_token.add_callback(self.llm_manager.abort_requests)
+        if input_dict.get("cascade"):
+            self.llm_manager.set_cascade_policy(CascadePolicy(input_dict.get("cascade_sample_rate", DEFAULT_SAMPLE_RATE)))
+        if input_dict.get("hedge_requests"):
+            self.llm_manager.set_hedge_policy(HedgePolicy(input_dict.get("hedge_percentile", HEDGE_PERCENTILE)))
+        if input_dict.get("failover"):
+            self.llm_manager.enable_failover()
+        self.llm_manager.set_normalize_images(input_dict.get("normalize_images", True))
+        self.llm_manager.set_crop_labels(input_dict.get("crop_labels", False))
+        # shards of a volume share its budget, so their spend is recorded under the volume they are part of
+        self.budget_governor = BudgetGovernor(input_dict.get("budget_volume_name") or volume.name, input_dict.get("volume_budget"), input_dict.get("daily_budget"), input_dict.get("budget_action", "pause"), job_queue)
     
     def get_llm_manager(self):
         return LLMManager(self.msg, self.input_dict["api_key_dict"], self.input_dict["selected_llms"], self.input_dict["selected_prompt_filename"], self.input_dict["prompt_text"])        
@@ -34,10 +77,50 @@ class JobsRunner:
             "in_process": [],
             "processed": [],
             "failed": [],
+            "dead_letter": [],
             "transcript_objs": [],
             "pages": []
         }
 
+    def get_job_key(self, image_to_process):
+        # jobs are image sources (urls, paths or names in the temp images folder); images are loaded when they are processed
+        return image_to_process
+
+    def get_concurrency_limit(self):
+        # with adaptive concurrency max_workers is only the ceiling; the tightest provider window sets the pace
+        if not self.adaptive_concurrency:
+            return self.max_workers
+        windows = [controller.get_window() for controller in self.llm_manager.get_concurrency_controllers()]
+        return min([self.max_workers] + windows)
+
+    def get_concurrency_status(self):
+        return [controller.get_status() for controller in self.llm_manager.get_concurrency_controllers()]
+
+    def enforce_budget(self):
+        if not self.budget_governor.is_enabled():
+            return
+        remaining_images = len(self.jobs_dict["to_process"]) + len(self.jobs_dict["in_process"])
+        model_prices = self.llm_manager.get_model_prices()
+        if not self.budget_governor.is_over_budget(remaining_images, model_prices):
+            return
+        projection = self.budget_governor.get_projection(remaining_images, model_prices)
+        remaining_budget = self.budget_governor.get_remaining_budget()
+        downgrade = self.budget_governor.get_downgrade(remaining_images, model_prices) if self.budget_governor.action == "downgrade" else None
+        with self.lock:
+            if downgrade:
+                old_llm, new_llm = downgrade
+                self.llm_manager.replace_llm(old_llm, new_llm)
+                self.event_bus.publish(RunStatus(message=f"Projected spend ${projection:.2f} is over the remaining budget ${remaining_budget:.2f}; switched {old_llm} to {new_llm}"))
+                return
+            if not self.cancellation_token.is_paused():
+                self.msg["warning"] = f"Paused: projected spend ${projection:.2f} for {remaining_images} image(s) is over the remaining budget ${remaining_budget:.2f}"
+                self.event_bus.publish(RunStatus(message=self.msg["warning"]))
+        self.cancellation_token.pause()
+
+    def can_start_jobs(self):
+        self.enforce_budget()
+        return not self.cancellation_token.should_stop()
+
     def get_number_completed_jobs(self):
         return len(self.jobs_dict["processed"])    
 
@@ -50,43 +133,318 @@ class JobsRunner:
     def load_jobs(self, jobs_dict):
         for job_name, job in jobs_dict.items():
             self.jobs_dict[job_name] = job
-    
-    def process_jobs(self, batch_size=None):
-        if not batch_size:
-            batch_size = len(self.jobs_dict["to_process"])
-        self.msg["status"] = []
-        jobs = self.jobs_dict
-        copy_images_to_process = jobs["to_process"][:batch_size].copy()
-        for idx, image_to_process in enumerate(copy_images_to_process):
-            jobs["to_process"].remove(image_to_process)
-            jobs["in_process"].append(image_to_process)
-            image, transcript_obj, version_name, image_ref = self.llm_manager.process_one_image(idx, image_to_process)
-            if type(transcript_obj) != Transcript:
-                print(f"Error processing {image_ref}")
-                print(f"Error: {transcript_obj}")
-                self.msg["pause_button_enabled"] = True
-                self.msg["status"].append(transcript_obj)
-                jobs["failed"].append(image_to_process)
-                return
-            else:
-                d = {"image": image, "transcript_obj": transcript_obj, "version_name": version_name, "image_ref": image_ref}
-                print(f"Successfully processed {image_ref}")
-                self.msg["status"].append(f"Successfully processed {image_ref}\n")
-                jobs["processed"].append([image_to_process, image_ref])
-                jobs["transcript_objs"].append(transcript_obj)
-                jobs["pages"].append(d)
-                self.volume.add_page(d)
-                self.volume.commit_volume()
-                version_name = transcript_obj.create_new_version_for_user(self.user_name)
+        job_keys = [self.get_job_key(image_to_process) for image_to_process in self.jobs_dict["to_process"]]
+        if self.job_queue:
+            self.job_queue.enqueue(self.volume.name, job_keys)
+            self.job_order.update(self.job_queue.get_positions(self.volume.name))
+        for job_key in job_keys:
+            if job_key not in self.job_order:
+                self.job_order[job_key] = len(self.job_order)
+
+    def renew_leases(self, force=False):
+        if self.job_queue and (force or time.time() - self.last_lease_renewal > LEASE_RENEWAL_INTERVAL):
+            self.job_queue.renew_leases()
+            self.last_lease_renewal = time.time()
+
+    def start_job(self, image_to_process):
+        # returns False, and drops the job from this run, if another process is already working on it
+        with self.lock:
+            self.jobs_dict["to_process"].remove(image_to_process)
+            self.jobs_dict["in_process"].append(image_to_process)
+        if self.job_queue and not self.job_queue.lease(self.volume.name, self.get_job_key(image_to_process)):
+            with self.lock:
+                self.jobs_dict["in_process"].remove(image_to_process)
+            print(f"Skipping {self.get_job_key(image_to_process)}: it is already processed or leased by another process")
+            return False
+        self.event_bus.publish(JobStarted(self.get_job_key(image_to_process)))
+        return True
+
+    def return_job(self, image_to_process):
+        # a cancelled job goes back to the front of the queue, so resuming picks it up first
+        with self.lock:
+            self.jobs_dict["in_process"].remove(image_to_process)
+            self.jobs_dict["to_process"].insert(0, image_to_process)
+        if self.job_queue:
+            self.job_queue.release_lease(self.volume.name, self.get_job_key(image_to_process))
+
+    def set_focus(self, position, direction=1):
+        self.lanes.set_focus(position, direction)
+
+    def load_lanes(self, batch_size):
+        images_to_process = list(enumerate(self.jobs_dict["to_process"][:batch_size].copy()))
+        self.lanes.load(images_to_process, [self.job_order.get(self.get_job_key(image_to_process), idx) for idx, image_to_process in images_to_process])
+        return images_to_process
+
+    def pause_jobs(self):
+        self.cancellation_token.pause()
+
+    def cancel_jobs(self):
+        self.cancellation_token.cancel()
+
+    def finish_failed_job(self, image_to_process, error):
+        image_ref = self.get_job_key(image_to_process)
+        dead_letter = {"image ref": image_ref, "attempts": error.attempts, "time failed": time.strftime("%Y-%m-%d-%H%M-%S")} | error.to_dict()
+        with self.lock:
+            self.jobs_dict["in_process"].remove(image_to_process)
+            self.jobs_dict["failed"].append(image_to_process)
+            self.jobs_dict["dead_letter"].append(dead_letter)
+        if self.job_queue and not self.job_queue.mark_failed(self.volume.name, image_ref, error.error_type, error.message):
+            print(f"{image_ref} was taken over by another process after its lease expired; its outcome there stands")
+        self.event_bus.publish(JobFailed(image_ref, f"Failed {image_ref} ({error.error_type}, {error.attempts} attempts): {error.message}", error_type=error.error_type, attempts=error.attempts))
+
+    def finish_processed_job(self, image_to_process, image, transcript_obj, version_name, image_ref):
+        d = {"transcript_obj": transcript_obj, "version_name": version_name, "image_ref": image_ref}
+        with self.lock:
+            self.jobs_dict["in_process"].remove(image_to_process)
+            self.jobs_dict["processed"].append([image_to_process, image_ref])
+            self.jobs_dict["transcript_objs"].append(transcript_obj)
+            self.jobs_dict["pages"].append(d)
+        spend = self.budget_governor.record_job(self.get_job_key(image_to_process), transcript_obj)
+        self.volume.add_page(d, self.job_order.get(self.get_job_key(image_to_process)))
+        self.volume.commit_volume()
+        # the page is committed to the volume file before the queue records it, so a crash in between is reconciled on resume
+        if self.job_queue and not self.job_queue.mark_processed(self.volume.name, self.get_job_key(image_to_process)):
+            print(f"{image_ref} was taken over by another process after its lease expired; its outcome there stands")
+        transcript_obj.create_new_version_for_user(self.user_name)
+        self.event_bus.publish(CostUpdate(image_ref, cost=spend["cost"], input_tokens=spend["input tokens"], output_tokens=spend["output tokens"], volume_spend=self.budget_governor.volume_spend))
+        self.event_bus.publish(JobFinished(image_ref, f"Successfully processed {image_ref}", version_name=version_name))
+
+    def get_future_result(self, future):
+        try:
+            return future.result()
+        except Exception as e:
+            return e
+
+    def get_retry_delay(self, image_to_process, e, attempt):
+        # returns None once the error's retry policy is used up
+        error = classify_error(e)
+        error.attempts = attempt
+        if not error.retry_policy.should_retry(attempt):
+            return error, None
+        delay = error.retry_policy.get_delay(attempt, error.retry_after)
+        image_ref = self.get_job_key(image_to_process)
+        print(f"Retrying {image_ref} after {error.error_type} error (attempt {attempt}) in {delay:.1f}s: {error.message}")
+        self.event_bus.publish(JobRetrying(image_ref, f"Retrying {image_ref} after {error.error_type} error (attempt {attempt})", error_type=error.error_type, attempt=attempt, delay=delay))
+        return error, delay
+
+    def run_job(self, idx, image_to_process):
+        attempt = 1
+        image_info = None
+        while True:
+            try:
+                self.cancellation_token.raise_if_cancelled()
+                image_info = image_info or self.image_loader.load_image_to_process(image_to_process)
+                return self.llm_manager.process_one_image(idx, image_info)
+            except Exception as e:
+                # a request aborted by cancel surfaces as whatever error the closed connection raised
+                if self.cancellation_token.is_cancelled():
+                    return JobCancelledError("Processing was cancelled")
+                error, delay = self.get_retry_delay(image_to_process, e, attempt)
+                if delay is None:
+                    return error
+            if self.cancellation_token.wait(delay):
+                return JobCancelledError("Processing was cancelled")
+            attempt += 1
+
+    async def run_job_async(self, idx, image_to_process):
+        attempt = 1
+        image_info = None
+        while True:
+            try:
+                self.cancellation_token.raise_if_cancelled()
+                image_info = image_info or await asyncio.to_thread(self.image_loader.load_image_to_process, image_to_process)
+                return await self.llm_manager.process_one_image_async(idx, image_info)
+            except Exception as e:
+                if self.cancellation_token.is_cancelled():
+                    return JobCancelledError("Processing was cancelled")
+                error, delay = self.get_retry_delay(image_to_process, e, attempt)
+                if delay is None:
+                    return error
+            # waits on the token in a worker thread, so a cancel during the backoff ends it
+            if await asyncio.to_thread(self.cancellation_token.wait, delay):
+                return JobCancelledError("Processing was cancelled")
+            attempt += 1
+
+    def handle_result(self, image_to_process, result):
+        # returns None for a cancelled job, which is neither processed nor failed
+        if isinstance(result, JobCancelledError):
+            print(f"Cancelled {self.get_job_key(image_to_process)}")
+            self.return_job(image_to_process)
+            self.event_bus.publish(JobCancelled(self.get_job_key(image_to_process), f"Cancelled {self.get_job_key(image_to_process)}"))
+            return None
+        if isinstance(result, Exception):
+            error = classify_error(result)
+            print(f"Error processing {self.get_job_key(image_to_process)}")
+            print(f"Error: {error.message}")
+            self.finish_failed_job(image_to_process, error)
+            return False
+        image, transcript_obj, version_name, image_ref = result
+        print(f"Successfully processed {image_ref}")
+        self.finish_processed_job(image_to_process, image, transcript_obj, version_name, image_ref)
+        return True
+
+    def publish_run_started(self):
+        with self.lock:
+            processed = len(self.jobs_dict["processed"])
+            failed = len(self.jobs_dict["failed"])
+            total = len(self.jobs_dict["to_process"]) + len(self.jobs_dict["in_process"]) + processed + failed
+        self.event_bus.publish(RunStarted(total=total, processed=processed, failed=failed))
+
+    def report_batch_outcome(self, num_failed):
+        # failed images are set aside in the dead-letter list; the pause options come up once nothing is left to process
+        self.msg["pause_button_enabled"] = (bool(self.jobs_dict["failed"]) and not self.jobs_dict["to_process"]) or self.cancellation_token.should_stop()
+        if self.cancellation_token.should_stop():
+            # in-flight work has drained or been aborted; what is left stays queued for resume_jobs or a later run
+            if self.job_queue:
+                self.job_queue.release_own_leases(self.volume.name)
+            stopped = "Cancelled" if self.cancellation_token.is_cancelled() else "Paused"
+            self.event_bus.publish(RunStatus(message=f"{stopped} with {len(self.jobs_dict['to_process'])} image(s) left to process"))
+        if num_failed:
+            self.msg["warning"] = f"{num_failed} image(s) failed and were set aside; see the status log for details."
         if self.jobs_dict["transcript_objs"]:
-            self.msg["pause_button_enabled"] = False
             self.msg["success"] = "Images processed successfully!"
-        else:
+        elif not num_failed:
             print("Error!!!!")
             self.msg["warning"] = "No images or errors occurred. Check logs or outputs."
-            self.msg["pause_button_enabled"] = False
+        self.event_bus.publish(RunFinished(message=self.msg.get("warning", ""), stopped=self.cancellation_token.should_stop(), failed=num_failed))
+    
+    def process_jobs(self, batch_size=None):
+        if self.execution_mode == "asyncio":
+            asyncio.run(self.process_jobs_async(batch_size))
+            return
+        if not batch_size:
+            batch_size = len(self.jobs_dict["to_process"])
+        self.publish_run_started()
+        images_to_process = self.load_lanes(batch_size)
+        if self.execution_mode == "pipeline":
+            self.report_batch_outcome(Pipeline(self).run(images_to_process))
+            return
+        if self.execution_mode == "batch_api":
+            self.report_batch_outcome(self.process_jobs_with_batch_api())
+            return
+        pending = {}
+        num_failed = 0
+        while pending or (self.lanes.has_jobs() and not self.cancellation_token.should_stop()):
+            while len(pending) < self.get_concurrency_limit() and self.can_start_jobs():
+                next_job = self.lanes.get_next_job(len(pending), self.get_concurrency_limit())
+                if next_job is None:
+                    break
+                idx, image_to_process = next_job
+                if not self.start_job(image_to_process):
+                    continue
+                future = self.executor.submit(self.run_job, idx, image_to_process)
+                pending[future] = image_to_process
+            # a short wait, so a page the reviewer moves to starts without waiting for a job to finish
+            done, __ = wait(pending, timeout=WINDOW_POLL_INTERVAL if self.lanes.has_jobs() else LEASE_RENEWAL_INTERVAL, return_when=FIRST_COMPLETED)
+            self.renew_leases()
+            for future in done:
+                image_to_process = pending.pop(future)
+                if self.handle_result(image_to_process, self.get_future_result(future)) is False:
+                    num_failed += 1
+        self.report_batch_outcome(num_failed)
+
+    def process_jobs_with_batch_api(self):
+        # each chunk goes to every model's batch endpoint at once; results come back through the same create_version path
+        if self.llm_manager.cascade_policy:
+            print("Cascade is not applied in batch_api mode; every selected model transcribes every image")
+        num_failed = 0
+        while self.lanes.has_jobs() and self.can_start_jobs():
+            jobs = {}
+            images_info = []
+            normalizers = {}
+            chunk_bytes = 0
+            while chunk_bytes < BATCH_API_CHUNK_MB * 1_000_000 and len(images_info) < BATCH_API_MAX_REQUESTS:
+                next_job = self.lanes.get_next_job()
+                if next_job is None:
+                    break
+                idx, image_to_process = next_job
+                if not self.start_job(image_to_process):
+                    continue
+                try:
+                    image_info = self.image_loader.load_image_to_process(image_to_process)
+                    normalizer = self.llm_manager.create_normalizer(image_info[2], image_info[0])
+                    chunk_bytes += self.llm_manager.get_batch_request_size(normalizer)
+                except Exception as e:
+                    self.handle_result(image_to_process, e)
+                    num_failed += 1
+                    continue
+                jobs[idx] = image_to_process
+                images_info.append((idx, image_info))
+                normalizers[idx] = normalizer
+            if not images_info:
+                continue
+            try:
+                results = self.llm_manager.process_batch(images_info, self.batch_backend, self.renew_leases, normalizers)
+            except Exception as e:
+                results = {idx: e for idx, __ in images_info}
+            for idx, result in results.items():
+                if self.handle_result(jobs[idx], result) is False:
+                    num_failed += 1
+        return num_failed
+
+    async def process_jobs_async(self, batch_size=None):
+        # one event loop keeps up to max_workers images in flight without a thread per request
+        if not batch_size:
+            batch_size = len(self.jobs_dict["to_process"])
+        self.publish_run_started()
+        images_to_process = self.load_lanes(batch_size)
+        semaphore = asyncio.Semaphore(self.max_workers)
+        in_flight = [0]
+
+        async def run_job():
+            # each task takes whichever job the lanes hand out when a slot frees up
+            started = False
+            try:
+                async with semaphore:
+                    while True:
+                        if not self.can_start_jobs():
+                            return None
+                        next_job = self.lanes.get_next_job(in_flight[0], self.get_concurrency_limit())
+                        if next_job or not self.lanes.has_jobs():
+                            break
+                        await asyncio.sleep(WINDOW_POLL_INTERVAL)
+                    if next_job is None:
+                        return None
+                    idx, image_to_process = next_job
+                    if not self.start_job(image_to_process):
+                        return None
+                    started = True
+                    in_flight[0] += 1
+                    try:
+                        result = await self.run_job_async(idx, image_to_process)
+                    finally:
+                        in_flight[0] -= 1
+            except asyncio.CancelledError:
+                if not started:
+                    return None
+                result = JobCancelledError("Processing was cancelled")
+            # committing the page writes the volume file
+            return await asyncio.to_thread(self.handle_result, image_to_process, result)
+
+        async def keep_leases():
+            while True:
+                await asyncio.sleep(LEASE_RENEWAL_INTERVAL)
+                self.renew_leases(force=True)
+
+        loop = asyncio.get_running_loop()
+        tasks = [asyncio.create_task(run_job()) for __ in images_to_process]
+
+        def cancel_tasks():
+            # cancelling a task aborts its request; called from whichever thread cancels the run
+            loop.call_soon_threadsafe(lambda: [task.cancel() for task in tasks])
+
+        self.cancellation_token.add_callback(cancel_tasks)
+        lease_task = asyncio.create_task(keep_leases())
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            self.cancellation_token.remove_callback(cancel_tasks)
+            lease_task.cancel()
+            await self.llm_manager.close_async_clients()
+        self.report_batch_outcome(results.count(False))
 
     def resume_jobs(self, try_failed_jobs, batch_size=None):
+        self.cancellation_token.reset()
         if try_failed_jobs:
             failed_jobs = []
             for job in self.jobs_dict["failed"]:
@@ -94,4 +452,7 @@ class JobsRunner:
                     failed_jobs.append(job)
             self.jobs_dict["to_process"] = failed_jobs + self.jobs_dict["to_process"]
             self.jobs_dict["failed"] = []
-        self.process_jobs(batch_size)                
\ No newline at end of file
+            self.jobs_dict["dead_letter"] = []
+            if self.job_queue:
+                self.job_queue.requeue(self.volume.name, [self.get_job_key(job) for job in failed_jobs])
+        self.process_jobs(batch_size)                
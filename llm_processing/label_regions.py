@@ -0,0 +1,220 @@
+from collections import deque
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from llm_processing.image_loader import read_source_bytes
+
+# labels are found on a small greyscale copy of the sheet; text strokes there are a pixel or two wide
+ANALYSIS_SIZE = 1024
+# dark areas that survive an erosion this wide are plant material rather than text
+STROKE_SIZE = 5
+CELL_SIZE = 16
+# a cell is text if enough of it is thin dark strokes and enough of its rows cross several of them;
+# a row through a word crosses several strokes, a row through a stem crosses two edges
+MIN_TEXT_DENSITY = 0.03
+MAX_TEXT_DENSITY = 0.5
+MIN_ROW_TRANSITIONS = 5
+MIN_BUSY_ROWS = 4
+MIN_REGION_CELLS = 4
+# a block taller than one line of text must have gaps between its lines: rows with next to no text in them
+MAX_LINE_HEIGHT = 2 * CELL_SIZE
+GAP_ROW_FRACTION = 0.05
+# the regions must hold most of the sheet's text, and be small enough to be worth cropping to
+MIN_CONFIDENCE = 0.7
+MAX_CROP_FRACTION = 0.6
+PADDING = 0.015
+MONTAGE_GAP = 16
+
+
+class LabelCrop:
+    def __init__(self, image, boxes, confidence):
+        self.image = image
+        self.boxes = boxes
+        self.confidence = confidence
+
+
+def get_analysis_image(image):
+    # a greyscale copy at most ANALYSIS_SIZE a side; JPEGs are decoded in draft mode straight to about that size
+    source_bytes = read_source_bytes(image)
+    analysis_image = Image.open(BytesIO(source_bytes)) if source_bytes else image
+    scale = min(1, ANALYSIS_SIZE / max(image.size))
+    target_size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    if source_bytes and analysis_image.format == "JPEG":
+        analysis_image.draft("L", target_size)
+    analysis_image = analysis_image.convert("L")
+    if analysis_image.size != target_size:
+        analysis_image = analysis_image.resize(target_size, Image.BILINEAR)
+    return np.asarray(analysis_image)
+
+
+def get_otsu_threshold(gray):
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_below = np.cumsum(histogram)
+    weight_above = weight_below[-1] - weight_below
+    sum_below = np.cumsum(histogram * levels)
+    mean_below = sum_below / np.maximum(weight_below, 1)
+    mean_above = (sum_below[-1] - sum_below) / np.maximum(weight_above, 1)
+    return int(np.argmax(weight_below * weight_above * (mean_below - mean_above) ** 2))
+
+
+def filter_box(mask, size, combine):
+    # combines mask over the size x size box centred on each pixel, a row of shifted slices at a time
+    pad = size // 2
+    rows, cols = mask.shape
+    padded = np.pad(mask, ((pad, pad), (0, 0)))
+    result = padded[:rows].copy()
+    for shift in range(1, size):
+        combine(result, padded[shift:shift + rows], out=result)
+    padded = np.pad(result, ((0, 0), (pad, pad)))
+    result = padded[:, :cols].copy()
+    for shift in range(1, size):
+        combine(result, padded[:, shift:shift + cols], out=result)
+    return result
+
+
+def erode(mask, size):
+    return filter_box(mask, size, np.logical_and)
+
+
+def dilate(mask, size):
+    return filter_box(mask, size, np.logical_or)
+
+
+def get_text_mask(gray):
+    # thresholding, then dropping dark areas too thick to be strokes of text
+    dark = gray < get_otsu_threshold(gray)
+    return dark & ~dilate(erode(dark, STROKE_SIZE), STROKE_SIZE)
+
+
+def get_cells(mask):
+    rows, cols = mask.shape[0] // CELL_SIZE, mask.shape[1] // CELL_SIZE
+    return mask[:rows * CELL_SIZE, :cols * CELL_SIZE].reshape(rows, CELL_SIZE, cols, CELL_SIZE)
+
+
+def get_text_cells(text_mask):
+    # returns the text pixels in each cell that looks like text, zero elsewhere
+    text_pixels = get_cells(text_mask).sum(axis=(1, 3))
+    density = text_pixels / (CELL_SIZE * CELL_SIZE)
+    transitions = np.zeros(text_mask.shape, dtype=bool)
+    transitions[:, 1:] = text_mask[:, 1:] != text_mask[:, :-1]
+    busy_rows = (get_cells(transitions).sum(axis=3) >= MIN_ROW_TRANSITIONS).sum(axis=1)
+    is_text = (density >= MIN_TEXT_DENSITY) & (density <= MAX_TEXT_DENSITY) & (busy_rows >= MIN_BUSY_ROWS)
+    return np.where(is_text, text_pixels, 0)
+
+
+def get_components(cells):
+    # 8-connected groups of cells, as (top, left, bottom, right, number of cells) in cells
+    seen = np.zeros(cells.shape, dtype=bool)
+    components = []
+    for start in zip(*np.nonzero(cells)):
+        if seen[start]:
+            continue
+        seen[start] = True
+        queue = deque([start])
+        top, left, bottom, right, count = start[0], start[1], start[0], start[1], 0
+        while queue:
+            row, col = queue.popleft()
+            count += 1
+            top, left, bottom, right = min(top, row), min(left, col), max(bottom, row), max(right, col)
+            for next_row in range(max(0, row - 1), min(cells.shape[0], row + 2)):
+                for next_col in range(max(0, col - 1), min(cells.shape[1], col + 2)):
+                    if cells[next_row, next_col] and not seen[next_row, next_col]:
+                        seen[next_row, next_col] = True
+                        queue.append((next_row, next_col))
+        components.append((top, left, bottom + 1, right + 1, count))
+    return components
+
+
+def trim_box(text_mask, box):
+    # trims a box to where its row and column projection profiles show text
+    top, left, bottom, right = box
+    region = text_mask[top:bottom, left:right]
+    rows = np.nonzero(region.sum(axis=1) > 0)[0]
+    cols = np.nonzero(region.sum(axis=0) > 0)[0]
+    if not len(rows) or not len(cols):
+        return None
+    return (top + rows[0], left + cols[0], top + rows[-1] + 1, left + cols[-1] + 1)
+
+
+def is_text_block(text_mask, box):
+    top, left, bottom, right = box
+    if bottom - top <= MAX_LINE_HEIGHT:
+        return True
+    row_profile = text_mask[top:bottom, left:right].sum(axis=1)
+    return bool((row_profile <= GAP_ROW_FRACTION * row_profile.max()).any())
+
+
+def find_label_regions(image):
+    """Finds the text-dense regions of a sheet.
+
+    Returns (boxes, confidence): boxes are (left, top, right, bottom) in the image's own pixels, and confidence is the
+    share of the text found on the sheet that they hold. Regions without the line structure of text are left out.
+    """
+    gray = get_analysis_image(image)
+    text_mask = get_text_mask(gray)
+    text_cells = get_text_cells(text_mask)
+    boxes = []
+    text_in_boxes = 0
+    # joining neighbouring cells makes the words and lines of a label one block
+    for top, left, bottom, right, count in get_components(dilate(text_cells > 0, 3)):
+        if count < MIN_REGION_CELLS:
+            continue
+        box = trim_box(text_mask, (top * CELL_SIZE, left * CELL_SIZE, bottom * CELL_SIZE, right * CELL_SIZE))
+        if box and is_text_block(text_mask, box):
+            boxes.append(box)
+            text_in_boxes += text_cells[top:bottom, left:right].sum()
+    total_text = text_cells.sum()
+    confidence = float(text_in_boxes / total_text) if total_text else 0
+    scale_x, scale_y = image.width / gray.shape[1], image.height / gray.shape[0]
+    padding = int(PADDING * max(image.size))
+    boxes = [(max(0, int(left * scale_x) - padding), max(0, int(top * scale_y) - padding), min(image.width, int(right * scale_x) + padding), min(image.height, int(bottom * scale_y) + padding)) for top, left, bottom, right in boxes]
+    return merge_boxes(boxes), confidence
+
+
+def merge_boxes(boxes):
+    # padded boxes that overlap become one
+    boxes = sorted(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return sorted(boxes, key=lambda box: (box[1], box[0]))
+
+
+def get_area(box):
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+
+def crop_to_labels(image):
+    """Crops a sheet to its labels, montaging several labels top to bottom.
+
+    Returns a LabelCrop, or None when the sheet should be sent whole: no text was found, the regions miss too much of it,
+    or they cover so much of the sheet that cropping would save little.
+    """
+    boxes, confidence = find_label_regions(image)
+    if not boxes or confidence < MIN_CONFIDENCE or sum(get_area(box) for box in boxes) > MAX_CROP_FRACTION * image.width * image.height:
+        return None
+    union = (min(box[0] for box in boxes), min(box[1] for box in boxes), max(box[2] for box in boxes), max(box[3] for box in boxes))
+    if get_area(union) <= MAX_CROP_FRACTION * image.width * image.height:
+        # labels close together keep their layout
+        return LabelCrop(image.crop(union).convert("RGB"), [union], confidence)
+    crops = [image.crop(box).convert("RGB") for box in boxes]
+    montage_size = (max(crop.width for crop in crops), sum(crop.height for crop in crops) + MONTAGE_GAP * (len(crops) - 1))
+    if montage_size[0] * montage_size[1] > MAX_CROP_FRACTION * image.width * image.height:
+        return None
+    montage = Image.new("RGB", montage_size, "white")
+    top = 0
+    for crop in crops:
+        montage.paste(crop, (0, top))
+        top += crop.height + MONTAGE_GAP
+    return LabelCrop(montage, boxes, confidence)
@@ -1,9 +1,14 @@
+import asyncio
+import copy
 import time
 import json
 import os
 import re
+from llm_processing.rate_limiter import get_rate_limiter, get_retry_after
+from llm_processing.concurrency_controller import get_concurrency_controller
 
 class ImageProcessor:
+    provider = ""
 
     def __init__(self, api_key, prompt_name, prompt_text, model, modelname):
         self.raw_response_folder = "llm_processing/raw_response_data"
@@ -17,12 +22,52 @@ class ImageProcessor:
         self.output_tokens = 0
         self.set_token_costs_per_mil()
         self.num_processed = 0
+        self.rate_limiter = get_rate_limiter(self.provider, self.model)
+        self.concurrency_controller = get_concurrency_controller(self.provider)
+        self.cancellation_token = None
         print(f"Initialized ImageProcessor with model: {self.model}")
 
     def ensure_directory_exists(self, directory):
         if not os.path.exists(directory):
             os.makedirs(directory)    
 
+    def process_image(self, base64_image, image_ref, index):
+        raise NotImplementedError
+
+    async def process_image_async(self, base64_image, image_ref, index):
+        # providers with an async client override this; the fallback keeps the blocking call off the event loop,
+        # on a copy of the processor so calls running at once on different threads keep their own token usage
+        call_processor = copy.copy(self)
+        return await asyncio.to_thread(call_processor.process_image, base64_image, image_ref, index)
+
+    async def close_async_client(self):
+        pass
+
+    def abort_requests(self):
+        # providers whose sync client can be closed mid-request override this to stop paying for cancelled work
+        pass
+
+    def acquire_rate_limit(self):
+        reservation = self.rate_limiter.acquire(self.cancellation_token)
+        reservation["time sent"] = time.monotonic()
+        return reservation
+
+    async def acquire_rate_limit_async(self):
+        reservation = await self.rate_limiter.acquire_async(self.cancellation_token)
+        reservation["time sent"] = time.monotonic()
+        return reservation
+
+    def release_rate_limit(self, reservation, headers=None, is_throttled=False, is_completed=False):
+        # every response also feeds the provider's concurrency window
+        self.rate_limiter.update_from_headers(headers)
+        if is_throttled:
+            self.rate_limiter.record_throttle(get_retry_after(headers))
+            self.concurrency_controller.record_throttle()
+        elif is_completed:
+            self.concurrency_controller.record_success(time.monotonic() - reservation["time sent"])
+        input_tokens, output_tokens = (self.input_tokens, self.output_tokens) if is_completed else (0, 0)
+        self.rate_limiter.record_usage(reservation, input_tokens, output_tokens)
+
     def get_timestamp(self):
         return  time.strftime("%Y-%m-%d-%H%M-%S")
     
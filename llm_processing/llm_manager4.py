@@ -11,7 +11,15 @@ from llm_processing.openai_interface3 import GPTImageProcessor
 from llm_processing.bedrock_interface import create_image_processor
 from llm_processing.transcript6 import Transcript
 import llm_processing.utility as utility
+from llm_processing.errors import ParseFailureError, TransientNetworkError, JobCancelledError
+from llm_processing.routing import get_routing_table, get_endpoints, get_circuit_breaker, is_endpoint_error
+from llm_processing.batch_api import get_batch_backend, get_custom_id
+from llm_processing.normalization import ImageNormalizer, get_normalization_profile
+import asyncio
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 class LLMManager:
     def __init__(self, msg, api_key_dict, selected_llms, selected_prompt, prompt_text):
@@ -20,7 +28,24 @@ class LLMManager:
         self.selected_llms = selected_llms[::-1] # treat the list like a stack: i.e., first selected is run last so that version is returned
         self.selected_prompt = selected_prompt
         self.prompt_text = prompt_text
+        self.cancellation_token = None
+        self.cascade_policy = None
+        self.hedge_policy = None
+        self.routing_table = None
+        self.normalize_images = True
+        self.crop_labels = False
+        # every thread's processors, so a cancel can abort them all
+        self.all_processors = {}
+        self.processors_lock = threading.Lock()
         self.processors = self.set_processors()
+        self.processors_generation = 0
+        self.thread_local = threading.local()
+        self.thread_local.processors = self.processors
+        self.thread_local.generation = self.processors_generation
+        self.fanout_executor = None
+        # hedged calls get their own pool, so a fanned-out call waiting on them can't starve it
+        self.hedge_executor = None
+        self.set_max_workers(1)
         self.raw_responses_folder = "output/raw_llm_responses"
         self.ensure_directory_exists(self.raw_responses_folder)
 
@@ -36,21 +61,126 @@ class LLMManager:
         with open(filename, 'r') as f:
             return json.load(f)
        
+    def create_processor(self, llm):
+        if "sonnet" in llm and not "bedrock" in llm:
+            processor = ClaudeImageProcessor(self.api_key_dict[f"{llm}_key"], self.selected_prompt, self.prompt_text)
+        elif "gpt" in llm:
+            processor = GPTImageProcessor(self.api_key_dict[f"{llm}_key"], self.selected_prompt, self.prompt_text)
+        elif "bedrock" in llm:
+            # Extract the model ID from the llm name (format: "bedrock-modelId")
+            model_id = llm.split("-", 1)[1] if "-" in llm else ""
+            # Create a shorter model name for display
+            model_name = model_id.split(".")[-1] if "." in model_id else model_id
+            processor = create_image_processor("", self.selected_prompt, self.prompt_text, model_id, model_name)
+        else:
+            return None
+        # the llm name is the endpoint that served a version, as recorded in its generation info
+        processor.llm_name = llm
+        processor.normalization_profile = get_normalization_profile(llm)
+        return processor
+
+    def register_processors(self, processors):
+        with self.processors_lock:
+            for processor in processors:
+                processor.cancellation_token = self.cancellation_token
+            # a thread that has exited has no requests left to abort, so its processors are dropped with it
+            self.all_processors = {thread: thread_processors for thread, thread_processors in self.all_processors.items() if thread.is_alive()}
+            self.all_processors.setdefault(threading.current_thread(), []).extend(processors)
+
+    def get_all_processors(self):
+        with self.processors_lock:
+            return [processor for thread_processors in self.all_processors.values() for processor in thread_processors]
+
     def set_processors(self):
-        processors = []
-        for llm in self.selected_llms:
-            if "sonnet" in llm and not "bedrock" in llm:
-                processors += [ClaudeImageProcessor(self.api_key_dict[f"{llm}_key"], self.selected_prompt, self.prompt_text)]
-            elif "gpt" in llm:
-                processors += [GPTImageProcessor(self.api_key_dict[f"{llm}_key"], self.selected_prompt, self.prompt_text)]
-            elif "bedrock" in llm:
-                # Extract the model ID from the llm name (format: "bedrock-modelId")
-                model_id = llm.split("-", 1)[1] if "-" in llm else ""
-                # Create a shorter model name for display
-                model_name = model_id.split(".")[-1] if "." in model_id else model_id
-                processors += [create_image_processor("", self.selected_prompt, self.prompt_text, model_id, model_name)]
+        processors = [processor for processor in map(self.create_processor, self.selected_llms) if processor]
+        self.register_processors(processors)
         return processors
 
+    def get_concurrency_controllers(self):
+        return list({processor.provider: processor.concurrency_controller for processor in self.processors}.values())
+
+    def set_cancellation_token(self, cancellation_token):
+        self.cancellation_token = cancellation_token
+        for processor in self.get_all_processors():
+            processor.cancellation_token = cancellation_token
+
+    def set_max_workers(self, max_workers):
+        # sized so every worker thread can have all of its image's model calls in flight at once, and a hedge of each;
+        # the last model runs on the worker thread itself
+        num_models = max(1, len(self.selected_llms))
+        for executor in (self.fanout_executor, self.hedge_executor):
+            if executor:
+                executor.shutdown(wait=False)
+        self.fanout_executor = ThreadPoolExecutor(max_workers=max(1, max_workers * (num_models - 1)))
+        self.hedge_executor = ThreadPoolExecutor(max_workers=2 * max_workers * num_models)
+
+    def set_cascade_policy(self, cascade_policy):
+        self.cascade_policy = cascade_policy
+
+    def set_hedge_policy(self, hedge_policy):
+        self.hedge_policy = hedge_policy
+
+    def set_normalize_images(self, normalize_images):
+        self.normalize_images = normalize_images
+
+    def set_crop_labels(self, crop_labels):
+        self.crop_labels = crop_labels
+
+    def create_normalizer(self, image, base64_image=None):
+        return ImageNormalizer(image, base64_image, self.crop_labels)
+
+    def get_normalization_profile(self, processor):
+        # None sends every model the image as it was loaded
+        return processor.normalization_profile if self.normalize_images else None
+
+    def get_image_normalizers(self, images_info):
+        return {idx: self.create_normalizer(image, base64_image) for idx, (base64_image, __, image) in images_info}
+
+    def prepare_images(self, normalizer, processors):
+        # encodes the image for every model up front, e.g. in the pipeline's encode stage rather than while holding a model slot
+        for processor in processors:
+            normalizer.get_base64_image(self.get_normalization_profile(processor))
+
+    def enable_failover(self, routing_table=None):
+        self.routing_table = routing_table if routing_table is not None else get_routing_table()
+
+    def get_endpoint_status(self):
+        if not self.routing_table:
+            return []
+        endpoints = [endpoint for llm in self.selected_llms for endpoint in get_endpoints(llm, self.routing_table)]
+        return [get_circuit_breaker(endpoint).get_status() for endpoint in dict.fromkeys(endpoints)]
+
+    def abort_requests(self):
+        # every worker thread's processors, not just the caller's
+        for processor in self.get_all_processors():
+            processor.abort_requests()
+
+    def get_processors(self):
+        # processors keep per-call token usage on the instance, so each worker thread gets its own set
+        if getattr(self.thread_local, "generation", None) != self.processors_generation:
+            self.thread_local.processors = self.set_processors()
+            self.thread_local.generation = self.processors_generation
+        return self.thread_local.processors
+
+    def get_hedge_processors(self):
+        # a second set per thread for hedged duplicates, lined up with get_processors, so the two calls don't share token usage
+        if not self.hedge_policy:
+            return [None] * len(self.get_processors())
+        if getattr(self.thread_local, "hedge_generation", None) != self.processors_generation:
+            self.thread_local.hedge_processors = self.set_processors()
+            self.thread_local.hedge_generation = self.processors_generation
+        return self.thread_local.hedge_processors
+
+    def get_model_prices(self):
+        # selected_llms is kept in the same (stack) order the processors are created in
+        return [(llm, getattr(processor, "input_cost_per_mil", 0), getattr(processor, "output_cost_per_mil", 0)) for llm, processor in zip(self.selected_llms, self.processors)]
+
+    def replace_llm(self, old_llm, new_llm):
+        # worker threads pick up the new processors with their next image
+        self.selected_llms = [new_llm if llm == old_llm else llm for llm in self.selected_llms]
+        self.processors = self.set_processors()
+        self.processors_generation += 1
+
     def fill_out_generation_info_dict(self, transcript_obj, version_name, prior_version_name, modelname):
         generation_info_dict = transcript_obj.get_generation_info_dict(modelname, version_name, prior_version_name, transcript_obj.get_timestamp(), is_ai_generated=True)
         return generation_info_dict
@@ -59,26 +189,278 @@ class LLMManager:
         return {fieldname: {"value": value, "notes": "", "new notes": ""} for fieldname, value in content_dict_without_notes.items()}     
 
     def create_version(self, transcript_obj, transcript_text, costs_dict, modelname, prior_version_name):
+        costs_dict = dict(costs_dict)
+        endpoint = costs_dict.pop("endpoint", None)
+        image_sent = costs_dict.pop("image sent", None)
         version_name = transcript_obj.get_version_name(modelname)
-        transcript_obj.intialize_new_version(version_name)
         content_dict_without_notes = utility.convert_text_to_dict(transcript_text, transcript_obj.content_fieldnames)
         filename = f"output/raw_llm_responses/{version_name}-transcript.json"
         self.save_to_json(content_dict_without_notes, filename)
+        if list(content_dict_without_notes.keys()) == ["error"]:
+            raise ParseFailureError(f"{modelname} response for {transcript_obj.image_ref} has none of the prompt's fields: {transcript_text[:200]}")
+        transcript_obj.intialize_new_version(version_name)
         content_dict = self.fill_out_content_dict(content_dict_without_notes)
         transcript_obj.versions["content"][-1] = content_dict
         generation_info_dict = self.fill_out_generation_info_dict(transcript_obj, version_name, prior_version_name, modelname)
+        if endpoint:
+            generation_info_dict["endpoint"] = endpoint
+        if image_sent:
+            generation_info_dict["image sent"] = image_sent
         transcript_obj.versions["generation info"][-1] = generation_info_dict
         transcript_obj.versions["costs"][-1] = costs_dict
         transcript_obj.commit_version()
         return version_name
     
+    def get_endpoint_processors(self, endpoint, processor, hedge_processor):
+        # failover endpoints are created the first time a thread needs them; None if the endpoint can't be set up here
+        if endpoint == processor.llm_name:
+            return processor, hedge_processor
+        if getattr(self.thread_local, "endpoints_generation", None) != self.processors_generation:
+            self.thread_local.endpoint_processors = {}
+            self.thread_local.endpoints_generation = self.processors_generation
+        if endpoint not in self.thread_local.endpoint_processors:
+            try:
+                endpoint_processors = [self.create_processor(endpoint), self.create_processor(endpoint) if self.hedge_policy else None]
+            except Exception as e:
+                print(f"Can't fail over to {endpoint}: {type(e).__name__}: {e}")
+                endpoint_processors = [None, None]
+            self.register_processors([p for p in endpoint_processors if p])
+            self.thread_local.endpoint_processors[endpoint] = endpoint_processors
+        return self.thread_local.endpoint_processors[endpoint]
+
+    def call_model(self, processor, hedge_processor, base64_image, image_ref, image_ref_idx):
+        if not self.hedge_policy:
+            return processor.process_image(base64_image, image_ref, image_ref_idx)
+        return self.hedge_policy.run(self.hedge_executor, processor, hedge_processor, base64_image, image_ref, image_ref_idx)
+
+    async def call_model_async(self, processor, hedge_processor, base64_image, image_ref, image_ref_idx):
+        if not self.hedge_policy:
+            return await processor.process_image_async(base64_image, image_ref, image_ref_idx)
+        return await self.hedge_policy.run_async(processor, hedge_processor, base64_image, image_ref, image_ref_idx)
+
+    def get_routes(self, processor, hedge_processor):
+        # yields (endpoint, circuit breaker, processor, hedge processor) for each endpoint whose circuit lets a request through
+        # lazily, so a half-open circuit's one trial request isn't claimed by an endpoint that is never tried
+        endpoints = get_endpoints(processor.llm_name, self.routing_table) if self.routing_table else [processor.llm_name]
+        for endpoint in endpoints:
+            circuit_breaker = get_circuit_breaker(endpoint)
+            endpoint_processor, endpoint_hedge_processor = self.get_endpoint_processors(endpoint, processor, hedge_processor)
+            if endpoint_processor and (not self.routing_table or circuit_breaker.allow_request()):
+                yield endpoint, circuit_breaker, endpoint_processor, endpoint_hedge_processor
+
+    def get_unroutable_error(self, processor, last_error):
+        if last_error:
+            return last_error
+        retry_afters = [get_circuit_breaker(endpoint).get_retry_after() for endpoint in get_endpoints(processor.llm_name, self.routing_table)]
+        return TransientNetworkError(f"Every endpoint for {processor.modelname} is unavailable", min([r for r in retry_afters if r], default=None))
+
+    def handle_route_error(self, endpoint, circuit_breaker, e):
+        # returns True if the next endpoint should be tried
+        if not self.routing_table or self.cancellation_token.is_cancelled():
+            return False
+        if not is_endpoint_error(e):
+            # the endpoint answered; the image or the answer is what failed
+            circuit_breaker.record_success()
+            return False
+        circuit_breaker.record_failure()
+        print(f"{endpoint} failed ({type(e).__name__}); trying the next endpoint")
+        return True
+
+    def get_model_response(self, processor, hedge_processor, normalizer, image_ref, image_ref_idx):
+        last_error = None
+        for endpoint, circuit_breaker, endpoint_processor, endpoint_hedge_processor in self.get_routes(processor, hedge_processor):
+            try:
+                base64_image, image_sent = normalizer.get_base64_image(self.get_normalization_profile(endpoint_processor))
+                transcript_text, costs = self.call_model(endpoint_processor, endpoint_hedge_processor, base64_image, image_ref, image_ref_idx)
+            except Exception as e:
+                if not self.handle_route_error(endpoint, circuit_breaker, e):
+                    raise
+                last_error = e
+                continue
+            circuit_breaker.record_success()
+            return transcript_text, costs | {"endpoint": endpoint, "image sent": image_sent}
+        raise self.get_unroutable_error(processor, last_error)
+
+    async def get_model_response_async(self, processor, hedge_processor, normalizer, image_ref, image_ref_idx):
+        last_error = None
+        for endpoint, circuit_breaker, endpoint_processor, endpoint_hedge_processor in self.get_routes(processor, hedge_processor):
+            try:
+                base64_image, image_sent = await asyncio.to_thread(normalizer.get_base64_image, self.get_normalization_profile(endpoint_processor))
+                transcript_text, costs = await self.call_model_async(endpoint_processor, endpoint_hedge_processor, base64_image, image_ref, image_ref_idx)
+            except Exception as e:
+                if not self.handle_route_error(endpoint, circuit_breaker, e):
+                    raise
+                last_error = e
+                continue
+            circuit_breaker.record_success()
+            return transcript_text, costs | {"endpoint": endpoint, "image sent": image_sent}
+        raise self.get_unroutable_error(processor, last_error)
+
+    def get_model_responses(self, processors, normalizer, image_ref, image_ref_idx):
+        # model calls don't depend on each other, so they are dispatched together and collected in stack order
+        if not processors:
+            return []
+        hedge_processors = self.get_hedge_processors()
+        futures = [self.fanout_executor.submit(self.get_model_response, processor, hedge_processor, normalizer, image_ref, image_ref_idx) for processor, hedge_processor in zip(processors[:-1], hedge_processors[:-1])]
+        last_response = self.get_model_response(processors[-1], hedge_processors[-1], normalizer, image_ref, image_ref_idx)
+        return [future.result() for future in futures] + [last_response]
+
+    async def get_model_responses_async(self, processors, normalizer, image_ref, image_ref_idx):
+        hedge_processors = self.get_hedge_processors()
+        return await asyncio.gather(*[self.get_model_response_async(processor, hedge_processor, normalizer, image_ref, image_ref_idx) for processor, hedge_processor in zip(processors, hedge_processors)])
+
+    def create_versions(self, transcript_obj, processors, responses):
+        version_name = "base"
+        for processor, (transcript_text, costs) in zip(processors, responses):
+            version_name = self.create_version(transcript_obj, transcript_text, costs, processor.modelname, version_name)
+        return version_name
+    
+    def create_cascade_version(self, transcript_obj, processor, response, prior_version_name, is_last, is_sampled_check):
+        # returns the latest version name and why the next model should run; an empty list ends the cascade
+        transcript_text, costs = response
+        try:
+            version_name = self.create_version(transcript_obj, transcript_text, costs, processor.modelname, prior_version_name)
+        except ParseFailureError:
+            if is_last:
+                raise
+            print(f"Escalating {transcript_obj.image_ref} past {processor.modelname}: parse failure")
+            return prior_version_name, ["parse failure"]
+        if is_last:
+            # the last model has the final say, but a spot check of the model before it is still recorded
+            if is_sampled_check:
+                self.cascade_policy.record_agreement(transcript_obj)
+            return version_name, []
+        reasons = self.cascade_policy.get_escalation_reasons(transcript_obj, is_sampled_check)
+        if reasons:
+            print(f"Escalating {transcript_obj.image_ref} past {processor.modelname}: {', '.join(reasons)}")
+            transcript_obj.versions["generation info"][-1]["cascade escalation"] = ", ".join(reasons)
+        return version_name, reasons
+
+    def run_cascade(self, transcript_obj, processors, normalizer, image_ref, image_ref_idx):
+        # models run one at a time in stack order, so the last one selected goes first and the first one selected is the final say
+        version_name = "base"
+        reasons = []
+        hedge_processors = self.get_hedge_processors()
+        for step, processor in enumerate(processors):
+            response = self.get_model_response(processor, hedge_processors[step], normalizer, image_ref, image_ref_idx)
+            version_name, reasons = self.create_cascade_version(transcript_obj, processor, response, version_name, step == len(processors) - 1, reasons == ["sampled"])
+            if not reasons:
+                break
+        return version_name
+
+    async def run_cascade_async(self, transcript_obj, processors, normalizer, image_ref, image_ref_idx):
+        version_name = "base"
+        reasons = []
+        hedge_processors = self.get_hedge_processors()
+        for step, processor in enumerate(processors):
+            response = await self.get_model_response_async(processor, hedge_processors[step], normalizer, image_ref, image_ref_idx)
+            version_name, reasons = await asyncio.to_thread(self.create_cascade_version, transcript_obj, processor, response, version_name, step == len(processors) - 1, reasons == ["sampled"])
+            if not reasons:
+                break
+        return version_name
+
+    def create_transcript(self, image_filename):
+        transcript_obj = Transcript(image_filename, self.selected_prompt)
+        transcript_obj.initialize_versions()
+        return transcript_obj
+
     def process_one_image(self, image_ref_idx, image_info):
         base64_image, image_filename, image = image_info
-        transcript_obj = Transcript(image_filename, self.selected_prompt)
+        normalizer = self.create_normalizer(image, base64_image)
+        transcript_obj = self.create_transcript(image_filename)
         image_ref = transcript_obj.image_ref
-        transcript_obj.initialize_versions()
-        version_name = "base"
-        for proc_idx, processor in enumerate(self.processors):
-            transcript_text, costs = processor.process_image(base64_image, image_ref, image_ref_idx)
-            version_name = self.create_version(transcript_obj, transcript_text, costs, processor.modelname, version_name)
-        return image, transcript_obj, version_name, image_ref
\ No newline at end of file
+        processors = self.get_processors()
+        if self.cascade_policy:
+            return image, transcript_obj, self.run_cascade(transcript_obj, processors, normalizer, image_ref, image_ref_idx), image_ref
+        responses = self.get_model_responses(processors, normalizer, image_ref, image_ref_idx)
+        version_name = self.create_versions(transcript_obj, processors, responses)
+        return image, transcript_obj, version_name, image_ref
+
+    async def process_one_image_async(self, image_ref_idx, image_info):
+        # creating the transcript, saving responses and comparing versions block, so they run off the event loop
+        base64_image, image_filename, image = image_info
+        normalizer = self.create_normalizer(image, base64_image)
+        transcript_obj = await asyncio.to_thread(self.create_transcript, image_filename)
+        image_ref = transcript_obj.image_ref
+        processors = self.get_processors()
+        if self.cascade_policy:
+            return image, transcript_obj, await self.run_cascade_async(transcript_obj, processors, normalizer, image_ref, image_ref_idx), image_ref
+        responses = await self.get_model_responses_async(processors, normalizer, image_ref, image_ref_idx)
+        version_name = await asyncio.to_thread(self.create_versions, transcript_obj, processors, responses)
+        return image, transcript_obj, version_name, image_ref
+
+    def submit_batches(self, backends, normalizers):
+        batch_ids = []
+        try:
+            for backend in backends:
+                profile = self.get_normalization_profile(backend.processor)
+                requests = [backend.get_request(get_custom_id(idx), normalizer.get_base64_image(profile)[0]) for idx, normalizer in normalizers.items()]
+                batch_ids.append(backend.submit(requests))
+        except Exception:
+            self.cancel_batches(backends, batch_ids)
+            raise
+        return batch_ids
+
+    def cancel_batches(self, backends, batch_ids):
+        for backend, batch_id in zip(backends, batch_ids):
+            try:
+                backend.cancel(batch_id)
+            except Exception as e:
+                print(f"Could not cancel batch {batch_id}: {e}")
+
+    def wait_for_batches(self, backends, batch_ids, on_poll=None):
+        # returns False if the run was stopped first; a paused run keeps waiting, since the batches are already paid for
+        pending = list(range(len(backends)))
+        poll_interval = min(backend.poll_interval for backend in backends)
+        while True:
+            pending = [i for i in pending if not backends[i].is_finished(batch_ids[i])]
+            if not pending:
+                return True
+            if on_poll:
+                on_poll()
+            if self.cancellation_token.wait(poll_interval):
+                return False
+
+    def get_batch_version(self, image_ref_idx, image_info, processors, backends, all_results, start_time, normalizer):
+        base64_image, image_filename, image = image_info
+        transcript_obj = self.create_transcript(image_filename)
+        image_ref = transcript_obj.image_ref
+        responses = []
+        for backend, results in zip(backends, all_results):
+            result = results.get(get_custom_id(image_ref_idx), TransientNetworkError(f"The {backend.processor.modelname} batch returned no result for {image_ref}"))
+            if isinstance(result, Exception):
+                raise result
+            transcript_text, costs = backend.parse_result(result, image_ref, image_ref_idx, start_time)
+            responses.append((transcript_text, costs | {"endpoint": backend.processor.llm_name, "image sent": normalizer.get_base64_image(self.get_normalization_profile(backend.processor))[1]}))
+        version_name = self.create_versions(transcript_obj, processors, responses)
+        return image, transcript_obj, version_name, image_ref
+
+    def get_batch_request_size(self, normalizer):
+        # the base64 bytes an image adds to the largest of the models' batch files
+        return max([len(normalizer.get_base64_image(self.get_normalization_profile(processor))[0]) for processor in self.get_processors()], default=0)
+
+    def process_batch(self, images_info, batch_backend="provider", on_poll=None, normalizers=None):
+        # images_info is [(idx, image_info)]; every model gets one batch for all of them
+        # returns {idx: the same result process_one_image gives, or the exception for that image}
+        processors = self.get_processors()
+        backends = [get_batch_backend(processor, batch_backend) for processor in processors]
+        start_time = time.time()
+        normalizers = normalizers or self.get_image_normalizers(images_info)
+        batch_ids = self.submit_batches(backends, normalizers)
+        print(f"Submitted {len(images_info)} image(s) in batch(es) {', '.join(batch_ids)}")
+        if not self.wait_for_batches(backends, batch_ids, on_poll):
+            self.cancel_batches(backends, batch_ids)
+            return {idx: JobCancelledError("Processing was cancelled") for idx, __ in images_info}
+        all_results = [backend.get_results(batch_id) for backend, batch_id in zip(backends, batch_ids)]
+        results = {}
+        for idx, image_info in images_info:
+            try:
+                results[idx] = self.get_batch_version(idx, image_info, processors, backends, all_results, start_time, normalizers[idx])
+            except Exception as e:
+                results[idx] = e
+        return results
+
+    async def close_async_clients(self):
+        for processor in self.get_processors() + self.get_hedge_processors():
+            if processor:
+                await processor.close_async_client()
\ No newline at end of file
@@ -10,6 +10,7 @@ from llm_processing.claude_interface3 import ClaudeImageProcessor
 from llm_processing.openai_interface3 import GPTImageProcessor
 from llm_processing.transcript6 import Transcript
 import llm_processing.utility as utility
+from llm_processing.errors import TransientNetworkError
 import json
 import time
 import random
@@ -120,6 +121,6 @@ class LLMManager:
             transcript_text, costs = text, costs_dict
             version_name = self.create_version(transcript_obj, transcript_text, costs, processor.modelname, version_name)
             if self.include_error and random.random() > 0.80:
-                transcript_obj = f"error processing: {image_ref}\n{text}"  
+                raise TransientNetworkError(f"error processing: {image_ref}\n{text}")
         time.sleep(3)  
         return image, transcript_obj, version_name, image_ref
@@ -0,0 +1,130 @@
+import base64
+import json
+import math
+import os
+import threading
+from io import BytesIO
+from PIL import Image
+from llm_processing.image_loader import read_source_bytes, get_source_bytes, encode_image
+from llm_processing.label_regions import crop_to_labels
+
+NORMALIZATION_PROFILES_PATH = "llm_processing/normalization_profiles.json"
+# matched against the llm name in order; the sizes are what each provider downsamples to anyway
+NORMALIZATION_PROFILES = {
+    # Anthropic resizes anything past 1568px on the long edge or about 1.15 megapixels
+    "sonnet": {"max long edge": 1568, "max pixels": 1_150_000, "jpeg quality": 85, "grayscale": False},
+    "claude": {"max long edge": 1568, "max pixels": 1_150_000, "jpeg quality": 85, "grayscale": False},
+    # OpenAI fits high detail images in 2048 x 2048, then scales the short edge to 768
+    "gpt": {"max long edge": 2048, "max pixels": 2048 * 768, "jpeg quality": 85, "grayscale": False},
+    "default": {"max long edge": 2048, "max pixels": 2_000_000, "jpeg quality": 85, "grayscale": False},
+}
+
+
+class NormalizationProfile:
+    def __init__(self, name, max_long_edge, max_pixels, jpeg_quality=85, grayscale=False):
+        self.name = name
+        self.max_long_edge = max_long_edge
+        self.max_pixels = max_pixels
+        self.jpeg_quality = jpeg_quality
+        self.grayscale = grayscale
+
+    def get_target_size(self, size):
+        width, height = size
+        scale = min(1, self.max_long_edge / max(width, height), math.sqrt(self.max_pixels / (width * height)))
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def get_normalization_profiles(path=NORMALIZATION_PROFILES_PATH):
+    # a normalization_profiles.json next to this module adds to or overrides the built-in profiles
+    profiles = dict(NORMALIZATION_PROFILES)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            profiles.update(json.load(f))
+    return profiles
+
+
+def get_normalization_profile(llm, profiles=None):
+    profiles = profiles if profiles is not None else get_normalization_profiles()
+    name = next((name for name in profiles if name != "default" and name in llm.lower()), "default")
+    settings = profiles[name]
+    return NormalizationProfile(name, settings["max long edge"], settings["max pixels"], settings.get("jpeg quality", 85), settings.get("grayscale", False))
+
+
+class ImageNormalizer:
+    """Encodes one page image for each model's profile, once per profile however many models share it.
+
+    JPEG sources are decoded in draft mode, which scales them down by up to 8x while decoding, so a 6000px scan is never
+    decoded at full size. A source already within the profile is sent as it is.
+    With crop_labels, the labels found on the sheet are sent instead of the sheet, unless detection is unsure.
+    """
+
+    def __init__(self, image, base64_image=None, crop_labels=False):
+        self.image = image
+        self.base64_image = base64_image
+        self.crop_labels = crop_labels
+        self.label_crop = None
+        self.lock = threading.Lock()
+        self.encodings = {}
+
+    def get_base64_image(self, profile):
+        # returns the base64 image for profile (None sends the image as loaded) and what was sent, for the generation info
+        key = profile.name if profile else None
+        with self.lock:
+            if key not in self.encodings:
+                self.encodings[key] = self.encode(profile)
+            return self.encodings[key]
+
+    def get_original(self):
+        self.base64_image = self.base64_image or encode_image(self.image)
+        return self.base64_image
+
+    def get_label_crop(self):
+        # found once, the first time any profile is encoded; None sends the full sheet
+        if self.label_crop is None:
+            try:
+                self.label_crop = crop_to_labels(self.image) or False
+            except Exception as e:
+                print(f"ERROR: label detection failed, sending the full sheet: {type(e).__name__}: {e}")
+                self.label_crop = False
+        return self.label_crop or None
+
+    def encode(self, profile):
+        label_crop = self.get_label_crop() if self.crop_labels else None
+        if label_crop:
+            return self.encode_label_crop(label_crop, profile)
+        if profile is None:
+            return self.get_original(), self.get_image_sent(None, self.image.size, self.get_original())
+        target_size = profile.get_target_size(self.image.size)
+        if target_size == self.image.size and not profile.grayscale and get_source_bytes(self.image) is not None:
+            return self.get_original(), self.get_image_sent(profile, self.image.size, self.get_original())
+        mode = "L" if profile.grayscale else "RGB"
+        source_bytes = read_source_bytes(self.image)
+        image = Image.open(BytesIO(source_bytes)) if source_bytes else self.image
+        if source_bytes and image.format == "JPEG":
+            image.draft(mode, target_size)
+        image = image.convert(mode)
+        if image.size != target_size:
+            image = image.resize(target_size, Image.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=profile.jpeg_quality)
+        base64_image = base64.b64encode(buffer.getvalue()).decode("utf-8")
+        return base64_image, self.get_image_sent(profile, target_size, base64_image)
+
+    def encode_label_crop(self, label_crop, profile):
+        image = label_crop.image.convert("L") if profile and profile.grayscale else label_crop.image
+        target_size = profile.get_target_size(image.size) if profile else image.size
+        if image.size != target_size:
+            image = image.resize(target_size, Image.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=profile.jpeg_quality if profile else 85)
+        base64_image = base64.b64encode(buffer.getvalue()).decode("utf-8")
+        return base64_image, self.get_image_sent(profile, target_size, base64_image)
+
+    def get_image_sent(self, profile, size, base64_image):
+        image_sent = {"profile": profile.name if profile else "original", "width": size[0], "height": size[1], "bytes": len(base64_image) * 3 // 4}
+        if self.crop_labels:
+            label_crop = self.label_crop or None
+            image_sent["label regions"] = len(label_crop.boxes) if label_crop else 0
+            image_sent["label confidence"] = round(label_crop.confidence, 2) if label_crop else None
+        return image_sent
+
@@ -1,6 +1,7 @@
 import openai
+import asyncio
+import httpx
 import base64
-import requests
 from PIL import Image
 from io import BytesIO
 import json
@@ -10,65 +11,144 @@ import traceback
 from llm_processing.utility import extract_info_from_text
 from llm_processing.transcript6 import Transcript
 from llm_processing.llm_interface import ImageProcessor
+from llm_processing.errors import ParseFailureError, TransientNetworkError, get_error_for_status
+from llm_processing.rate_limiter import get_retry_after
+from llm_processing.image_loader import get_media_type
+
+OPENAI_CHAT_COMPLETIONS_URL = "https://api.openai.com/v1/chat/completions"
+REQUEST_TIMEOUT = 300
 
 class GPTImageProcessor(ImageProcessor):
+    provider = "openai"
 
     def __init__(self, api_key, prompt_name, prompt_text, model="gpt-4o", modelname="gpt-4o"):
         super().__init__(api_key, prompt_name, prompt_text, model, modelname)
-        
+        self.client = self.get_client()
+        self.async_client = None
+        self.async_client_loop = None
+
     def set_token_costs_per_mil(self):
         if "gpt-4o" in self.model:
             self.input_cost_per_mil = 2.50
             self.output_cost_per_mil = 10.00
 
-    def process_image(self, base64_image, image_ref, index):
-        headers = {
+    def get_client(self):
+        return httpx.Client(timeout=httpx.Timeout(float(REQUEST_TIMEOUT)))
+
+    def abort_requests(self):
+        # closing the client drops its connections, so requests in flight on it fail right away
+        client = self.client
+        self.client = self.get_client()
+        client.close()
+
+    def get_async_client(self):
+        # async clients are bound to the event loop they were first used on
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.async_client_loop is not loop:
+            self.async_client = httpx.AsyncClient(timeout=httpx.Timeout(300.0), limits=httpx.Limits(max_connections=None, max_keepalive_connections=50))
+            self.async_client_loop = loop
+        return self.async_client
+
+    async def close_async_client(self):
+        if self.async_client is not None:
+            await self.async_client.aclose()
+            self.async_client = None
+
+    def get_headers(self):
+        return {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
+
+    def get_payload(self, base64_image):
+        return {
+            "model": "gpt-4o",
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": self.prompt_text},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{get_media_type(base64_image)};base64,{base64_image}"
+                            }
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": 2048,
+            "temperature": 0,
+            "seed": 42
+        }
+
+    def handle_response_data(self, response_data, status_code, headers, image_ref, index, start_time):
+        self.save_raw_response(response_data, image_ref)
+        self.update_usage(response_data)
+        end_time = time.time()
+        elapsed_time = (end_time - start_time) / 60
+        if status_code != 200:
+            error_message = f"Error processing image {index + 1} image '{image_ref}':\n {response_data}"
+            raise get_error_for_status(status_code, error_message, get_retry_after(headers))
+        if "choices" not in response_data:
+            raise ParseFailureError(f"Error processing image {index + 1} image '{image_ref}':\n {response_data}")
+        content = self.get_content_from_response(response_data)
+        return content, self.get_transcript_processing_data(elapsed_time)
+
+    def get_request_error(self, e, image_ref, index):
+        error_message = (
+            f"Error processing local image {index + 1} image '{image_ref}':\n {str(e)}"
+        )
+        print(f"ERROR: {error_message}")
+        return TransientNetworkError(error_message)
+
+    def get_response_json(self, post_resp):
+        try:
+            return post_resp.json()
+        except ValueError:
+            return {"error": post_resp.text}
+
+    def process_image(self, base64_image, image_ref, index):
         start_time = time.time()
+        reservation = self.acquire_rate_limit()
         try:
-            payload = {
-                "model": "gpt-4o",
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": self.prompt_text},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "max_tokens": 2048,
-                "temperature": 0,
-                "seed": 42
-            }
-            post_resp = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=payload
+            post_resp = self.client.post(
+                OPENAI_CHAT_COMPLETIONS_URL,
+                headers=self.get_headers(),
+                json=self.get_payload(base64_image)
             )
-            response_data = post_resp.json()
-            self.save_raw_response(response_data, image_ref)
-            self.update_usage(response_data)
-            end_time = time.time()
-            elapsed_time = (end_time - start_time) / 60
-            if "choices" not in response_data:
-                error_message = f"Error processing image {index + 1} image '{image_ref}':\n {response_data}"
-                return error_message, self.get_transcript_processing_data(elapsed_time)      
-            content = self.get_content_from_response(response_data)
-            return content, self.get_transcript_processing_data(elapsed_time)
-        except requests.exceptions.RequestException as e:
-            error_message = (
-                f"Error processing local image {index + 1} image '{image_ref}':\n {str(e)}"
+            response_data = self.get_response_json(post_resp)
+        except (httpx.HTTPError, RuntimeError) as e:
+            self.release_rate_limit(reservation)
+            raise self.get_request_error(e, image_ref, index) from e
+        except Exception:
+            self.release_rate_limit(reservation)
+            raise
+        try:
+            return self.handle_response_data(response_data, post_resp.status_code, post_resp.headers, image_ref, index, start_time)
+        finally:
+            self.release_rate_limit(reservation, post_resp.headers, is_throttled=post_resp.status_code == 429, is_completed=post_resp.status_code == 200)
+
+    async def process_image_async(self, base64_image, image_ref, index):
+        start_time = time.time()
+        reservation = await self.acquire_rate_limit_async()
+        try:
+            post_resp = await self.get_async_client().post(
+                OPENAI_CHAT_COMPLETIONS_URL,
+                headers=self.get_headers(),
+                json=self.get_payload(base64_image)
             )
-            print(f"ERROR: {error_message}")
-            return error_message, None           
+            response_data = self.get_response_json(post_resp)
+        except httpx.HTTPError as e:
+            self.release_rate_limit(reservation)
+            raise self.get_request_error(e, image_ref, index) from e
+        except BaseException:
+            self.release_rate_limit(reservation)
+            raise
+        try:
+            return self.handle_response_data(response_data, post_resp.status_code, post_resp.headers, image_ref, index, start_time)
+        finally:
+            self.release_rate_limit(reservation, post_resp.headers, is_throttled=post_resp.status_code == 429, is_completed=post_resp.status_code == 200)
 
     def get_content_from_response(self, response_data):
         content = response_data["choices"][0].get("message", {}).get("content", "")
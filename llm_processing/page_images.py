@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from llm_processing.image_store import get_image_store
+
+# decoded page images kept in memory across every session in the process
+PAGE_IMAGE_CACHE_MB = 512
+
+
+def get_image_size_in_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class PageImageCache:
+    """Decoded page images, loaded from the image store on demand and dropped least recently used first.
+
+    Pages only hold their image ref, so a volume's memory no longer grows with its page count; the cache holds at most
+    max_bytes of decoded pixels however many volumes or sessions are open.
+    """
+
+    def __init__(self, max_mb=PAGE_IMAGE_CACHE_MB):
+        self.max_bytes = max_mb * 1_000_000
+        self.lock = threading.Lock()
+        self.images = OrderedDict()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_image(self, image_ref, image_source=""):
+        # images from a url are cached under the url, as two servers can use the same file name
+        url = image_source.strip() if "http" in image_source else None
+        key = url or image_ref
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                self.hits += 1
+                return self.images[key]
+            self.misses += 1
+        image = self.load_image(image_ref, url)
+        self.add_image(key, image)
+        return image
+
+    def load_image(self, image_ref, url=None):
+        image_store = get_image_store()
+        image = image_store.open_image(url=url) if url and image_store.has(url=url) else image_store.open_image(image_ref)
+        image.load()
+        return image
+
+    def add_image(self, key, image):
+        size = get_image_size_in_bytes(image)
+        with self.lock:
+            if key in self.images:
+                return
+            self.images[key] = image
+            self.bytes_used += size
+            # the newest image stays even if it is bigger than the whole cache
+            while self.bytes_used > self.max_bytes and len(self.images) > 1:
+                __, evicted = self.images.popitem(last=False)
+                self.bytes_used -= get_image_size_in_bytes(evicted)
+
+    def discard(self, key):
+        with self.lock:
+            image = self.images.pop(key, None)
+            if image is not None:
+                self.bytes_used -= get_image_size_in_bytes(image)
+
+    def get_status(self):
+        with self.lock:
+            return {"images": len(self.images), "MB": round(self.bytes_used / 1_000_000, 1), "hits": self.hits, "misses": self.misses}
+
+
+page_image_cache = None
+page_image_cache_lock = threading.Lock()
+
+
+def get_page_image_cache():
+    # one per process, so every session and volume shares the same memory budget
+    global page_image_cache
+    with page_image_cache_lock:
+        if page_image_cache is None:
+            page_image_cache = PageImageCache()
+        return page_image_cache
@@ -0,0 +1,187 @@
+import os
+import queue
+import threading
+from llm_processing.errors import JobCancelledError
+
+STAGES = ["download", "normalize", "encode", "infer", "parse", "persist"]
+# once a model has answered, the result is kept even if the run is cancelled
+CANCELLABLE_STAGES = ["download", "normalize", "encode", "infer"]
+QUEUE_DEPTH_PER_WORKER = 2
+MAX_CPU_WORKERS = 4
+LEASE_CHECK_INTERVAL = 5
+WINDOW_POLL_INTERVAL = 0.1
+
+
+class Pipeline:
+    """Moves each job through download, normalize, encode, infer, parse and persist stages joined by bounded queues.
+
+    Every stage has its own workers, so images are downloaded and encoded while earlier ones are with the model,
+    and only about queue depth x stages images are held in memory at once, whatever the batch size.
+    """
+
+    def __init__(self, jobs_runner, queue_depth=None):
+        self.jobs_runner = jobs_runner
+        self.llm_manager = jobs_runner.llm_manager
+        self.image_loader = jobs_runner.image_loader
+        self.cancellation_token = jobs_runner.cancellation_token
+        max_workers = jobs_runner.max_workers
+        cpu_workers = max(1, min(MAX_CPU_WORKERS, os.cpu_count() or 1))
+        # volume commits rewrite the whole volume file, so persisting stays on one worker
+        self.num_workers = {"download": max_workers, "normalize": cpu_workers, "encode": cpu_workers, "infer": max_workers, "parse": 1, "persist": 1}
+        queue_depth = queue_depth or max_workers * QUEUE_DEPTH_PER_WORKER
+        self.queues = {stage: queue.Queue(maxsize=queue_depth) for stage in STAGES}
+        self.stage_handlers = {
+            "download": self.download,
+            "normalize": self.normalize,
+            "encode": self.encode,
+            "infer": self.infer,
+            "parse": self.parse,
+            "persist": self.persist,
+        }
+        self.lock = threading.Lock()
+        self.infer_condition = threading.Condition()
+        self.in_flight = 0
+        self.done = threading.Event()
+        self.remaining = 0
+        self.num_failed = 0
+
+    def download(self, item):
+        item["image_bytes"] = self.image_loader.fetch_image_bytes(item["job"])
+
+    def normalize(self, item):
+        item["image"] = self.image_loader.open_image(item["image_bytes"], item["job"])
+        del item["image_bytes"]
+
+    def encode(self, item):
+        # each model's encoding is made here, on a CPU worker, so infer workers only wait on the model
+        item["normalizer"] = self.llm_manager.create_normalizer(item["image"])
+        self.llm_manager.prepare_images(item["normalizer"], self.llm_manager.processors)
+
+    def acquire_infer_slot(self):
+        # infer workers are sized for the ceiling; the runner's concurrency limit decides how many call a model at once
+        with self.infer_condition:
+            while self.in_flight >= self.jobs_runner.get_concurrency_limit():
+                self.infer_condition.wait(WINDOW_POLL_INTERVAL)
+            self.in_flight += 1
+
+    def release_infer_slot(self):
+        with self.infer_condition:
+            self.in_flight -= 1
+            self.infer_condition.notify_all()
+
+    def infer(self, item):
+        # a fresh transcript on every attempt, so a retried parse failure doesn't build on a half-written one
+        self.acquire_infer_slot()
+        try:
+            transcript_obj = self.llm_manager.create_transcript(item["job"])
+            processors = self.llm_manager.get_processors()
+            if self.llm_manager.cascade_policy:
+                # a cascade parses each response before deciding on the next model, so it creates the versions here
+                item["version_name"] = self.llm_manager.run_cascade(transcript_obj, processors, item["normalizer"], transcript_obj.image_ref, item["idx"])
+            else:
+                item["responses"] = self.llm_manager.get_model_responses(processors, item["normalizer"], transcript_obj.image_ref, item["idx"])
+        finally:
+            self.release_infer_slot()
+        item["transcript_obj"] = transcript_obj
+        item["processors"] = processors
+
+    def parse(self, item):
+        if "responses" in item:
+            item["version_name"] = self.llm_manager.create_versions(item["transcript_obj"], item["processors"], item["responses"])
+        del item["normalizer"]
+
+    def persist(self, item):
+        transcript_obj = item["transcript_obj"]
+        self.jobs_runner.handle_result(item["job"], (item["image"], transcript_obj, item["version_name"], transcript_obj.image_ref))
+
+    def get_next_stage(self, stage):
+        idx = STAGES.index(stage) + 1
+        return STAGES[idx] if idx < len(STAGES) else None
+
+    def run_stage(self, stage):
+        handler = self.stage_handlers[stage]
+        next_stage = self.get_next_stage(stage)
+        while True:
+            item = self.queues[stage].get()
+            if item is None:
+                return
+            if stage in CANCELLABLE_STAGES and self.cancellation_token.is_cancelled():
+                self.cancel_item(item)
+                continue
+            try:
+                handler(item)
+            except Exception as e:
+                self.handle_error(stage, item, e)
+                continue
+            if next_stage:
+                self.queues[next_stage].put(item)
+            else:
+                self.finish_item(True)
+
+    def handle_error(self, stage, item, e):
+        if stage == "persist":
+            print(f"Error saving {item['job']}: {type(e).__name__}: {e}")
+            self.finish_item(False)
+            return
+        if self.cancellation_token.is_cancelled():
+            self.cancel_item(item)
+            return
+        error, delay = self.jobs_runner.get_retry_delay(item["job"], e, item["attempt"])
+        if delay is None:
+            self.jobs_runner.handle_result(item["job"], error)
+            self.finish_item(False)
+            return
+        item["attempt"] += 1
+        # a response that couldn't be parsed needs a new model call, anything else is retried where it failed
+        retry_stage = "infer" if stage == "parse" else stage
+        threading.Thread(target=self.retry_later, args=(retry_stage, item, delay), daemon=True).start()
+
+    def retry_later(self, stage, item, delay):
+        if self.cancellation_token.wait(delay):
+            self.cancel_item(item)
+            return
+        self.queues[stage].put(item)
+
+    def cancel_item(self, item):
+        self.jobs_runner.handle_result(item["job"], JobCancelledError("Processing was cancelled"))
+        self.finish_item(None)
+
+    def finish_item(self, succeeded, count=1):
+        # succeeded is None for jobs that were cancelled or never started
+        with self.lock:
+            self.remaining -= count
+            if succeeded is False:
+                self.num_failed += count
+            if self.remaining == 0:
+                self.done.set()
+
+    def feed(self, num_jobs):
+        # jobs are taken from the runner's lanes as the download queue has room, so a page the reviewer moves to jumps the queue
+        for num_fed in range(num_jobs):
+            if not self.jobs_runner.can_start_jobs():
+                # the rest were never started, so they are still waiting in to_process
+                self.finish_item(None, num_jobs - num_fed)
+                return
+            idx, image_to_process = self.jobs_runner.lanes.get_next_job()
+            if not self.jobs_runner.start_job(image_to_process):
+                self.finish_item(None)
+                continue
+            self.queues["download"].put({"job": image_to_process, "idx": idx, "attempt": 1})
+
+    def run(self, images_to_process):
+        # images_to_process is a list of (idx, job) pairs, already loaded into the runner's lanes; returns the number of jobs that failed
+        if not images_to_process:
+            return 0
+        self.remaining = len(images_to_process)
+        workers = [threading.Thread(target=self.run_stage, args=(stage,), daemon=True) for stage in STAGES for __ in range(self.num_workers[stage])]
+        for worker in workers:
+            worker.start()
+        threading.Thread(target=self.feed, args=(len(images_to_process),), daemon=True).start()
+        while not self.done.wait(LEASE_CHECK_INTERVAL):
+            self.jobs_runner.renew_leases()
+        for stage in STAGES:
+            for __ in range(self.num_workers[stage]):
+                self.queues[stage].put(None)
+        for worker in workers:
+            worker.join()
+        return self.num_failed
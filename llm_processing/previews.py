@@ -0,0 +1,160 @@
+import json
+import math
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image
+from llm_processing.image_store import get_image_store
+
+# Streamlit serves the static folder next to Transcriber.py at app/static (see .streamlit/config.toml)
+PREVIEW_FOLDER = "static/previews"
+PREVIEW_URL_PATH = "app/static/previews"
+THUMBNAIL_SIZE = 256
+EDITOR_SIZE = 1600
+TILE_SIZE = 512
+PREVIEW_JPEG_QUALITY = 80
+MAX_PREVIEW_BUILDERS = 2
+
+
+def save_jpeg(image, path):
+    temp_path = f"{path}.tmp"
+    image.save(temp_path, format="JPEG", quality=PREVIEW_JPEG_QUALITY)
+    os.replace(temp_path, path)
+
+
+class PreviewPyramid:
+    """Previews of one image, kept on disk under its SHA-256: a thumbnail, an editor-size image and zoom tiles.
+
+    Level 0 of the tiles is the full image; each level after it is half the size of the one before, down to a level
+    that fits in one tile. info.json is written last, so a pyramid with an info.json is complete.
+    """
+
+    def __init__(self, image_hash, folder=PREVIEW_FOLDER):
+        self.image_hash = image_hash
+        self.folder = f"{folder}/{image_hash}"
+        self.info = None
+
+    def get_info_path(self):
+        return f"{self.folder}/info.json"
+
+    def get_thumbnail_path(self):
+        return f"{self.folder}/thumbnail.jpg"
+
+    def get_editor_path(self):
+        return f"{self.folder}/editor.jpg"
+
+    def get_tile_path(self, level, col, row):
+        return f"{self.folder}/tiles/{level}/{col}_{row}.jpg"
+
+    def get_tile_url(self):
+        # the url of any tile, with {level}, {col} and {row} left for the viewer to fill in
+        return f"{PREVIEW_URL_PATH}/{self.image_hash}/tiles/{{level}}/{{col}}_{{row}}.jpg"
+
+    def is_built(self):
+        return os.path.exists(self.get_info_path())
+
+    def get_info(self):
+        if self.info is None:
+            with open(self.get_info_path(), "r", encoding="utf-8") as f:
+                self.info = json.load(f)
+        return self.info
+
+    def build(self, image_bytes):
+        image = Image.open(BytesIO(image_bytes))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        levels = self.build_tiles(image)
+        # reduce does the bulk of the shrinking cheaply, LANCZOS the rest
+        editor_image = image.reduce(max(1, max(image.size) // EDITOR_SIZE))
+        editor_image.thumbnail((EDITOR_SIZE, EDITOR_SIZE), Image.LANCZOS)
+        save_jpeg(editor_image, self.get_editor_path())
+        editor_size = list(editor_image.size)
+        editor_image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+        save_jpeg(editor_image, self.get_thumbnail_path())
+        self.info = {"width": image.width, "height": image.height, "editor size": editor_size, "tile size": TILE_SIZE, "levels": levels}
+        temp_path = f"{self.get_info_path()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.info, f)
+        os.replace(temp_path, self.get_info_path())
+
+    def build_tiles(self, image):
+        # returns the [width, height] of each level
+        levels = []
+        level_image = image
+        while True:
+            level = len(levels)
+            levels.append([level_image.width, level_image.height])
+            os.makedirs(f"{self.folder}/tiles/{level}", exist_ok=True)
+            for col in range(math.ceil(level_image.width / TILE_SIZE)):
+                for row in range(math.ceil(level_image.height / TILE_SIZE)):
+                    box = (col * TILE_SIZE, row * TILE_SIZE, min((col + 1) * TILE_SIZE, level_image.width), min((row + 1) * TILE_SIZE, level_image.height))
+                    save_jpeg(level_image.crop(box), self.get_tile_path(level, col, row))
+            if max(level_image.size) <= TILE_SIZE:
+                return levels
+            level_image = level_image.reduce(2)
+
+
+class PreviewBuilder:
+    """Builds preview pyramids in the background as images come in, and on the spot for an image viewed before its turn.
+
+    An image already being built is waited for rather than built twice.
+    """
+
+    def __init__(self, max_builders=MAX_PREVIEW_BUILDERS, folder=PREVIEW_FOLDER):
+        self.folder = folder
+        self.executor = ThreadPoolExecutor(max_workers=max_builders)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def submit(self, image_hash):
+        if PreviewPyramid(image_hash, self.folder).is_built():
+            return
+        self.executor.submit(self.build, image_hash)
+
+    def build(self, image_hash):
+        pyramid = PreviewPyramid(image_hash, self.folder)
+        with self.lock:
+            future = self.in_flight.get(image_hash)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.in_flight[image_hash] = future
+        if not is_owner:
+            future.result()
+            return pyramid
+        try:
+            if not pyramid.is_built():
+                with open(get_image_store().get_blob_path(image_hash), "rb") as f:
+                    pyramid.build(f.read())
+            future.set_result(True)
+        except Exception as e:
+            print(f"ERROR: could not build previews for {image_hash}: {type(e).__name__}: {e}")
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[image_hash]
+        return pyramid
+
+    def get_pyramid(self, image_ref, image_source=""):
+        # returns the built previews of an image in the image store, building them first if needed
+        url = image_source.strip() if "http" in image_source else None
+        image_store = get_image_store()
+        image_hash = (url and image_store.get_image_hash(url=url)) or image_store.get_image_hash(image_ref)
+        if image_hash is None:
+            raise FileNotFoundError(f"{image_ref} is not in the image store")
+        pyramid = PreviewPyramid(image_hash, self.folder)
+        return pyramid if pyramid.is_built() else self.build(image_hash)
+
+
+preview_builder = None
+preview_builder_lock = threading.Lock()
+
+
+def get_preview_builder():
+    global preview_builder
+    with preview_builder_lock:
+        if preview_builder is None:
+            preview_builder = PreviewBuilder()
+        return preview_builder
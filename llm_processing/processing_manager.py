@@ -1,77 +1,79 @@
-from concurrent.futures import ThreadPoolExecutor
-import threading
-from queue import Queue
-import requests
-from PIL import Image
-from io import BytesIO
-import base64
+import time
 #from llm_processing.llm_manager_testing import LLMManager
 from llm_processing.llm_manager4 import LLMManager
 from llm_processing.transcript6 import Transcript
 from llm_processing.jobs_runner import JobsRunner
+from llm_processing.job_queue import JobQueue
+from llm_processing.image_loader import ImageLoader
+from llm_processing.event_bus import EventBus, RunStatus, MetricsExporter
+from llm_processing.errors import ProcessingError, ImageUnreadableError
 
 class ProcessingManager:
-    def __init__(self, msg, input_dict, volume, user_name):
+    def __init__(self, msg, input_dict, volume, user_name, resume=False, event_bus=None, job_queue=None):
         self.msg = msg
+        self.event_bus = event_bus or EventBus()
         self.input_dict = input_dict
         self.volume = volume
         self.user_name = user_name    
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        self.processing_queue = Queue()
-        self.processed_results = {}
         self.is_processing = False
         self.transcription_folder = "transcription"
         self.temp_images_folder = "temp_images"
-        self.setup_jobs()
+        self.image_loader = ImageLoader(self.temp_images_folder)
+        # the session's queue, so every run in it leases under the same owner and release_own_leases finds them all
+        self.job_queue = job_queue or JobQueue()
+        self.metrics_exporter = MetricsExporter(self.volume.name)
+        self.event_bus.subscribe(self.metrics_exporter.handle)
+        self.setup_jobs(resume)
 
-    def setup_jobs(self):
+    def setup_jobs(self, resume=False):
         self.msg["errors"] = []
         self.msg["pause_button_enabled"] = False
-        self.msg["status"] = []
         self.jobs_dict = self.get_blank_jobs_dict()
-        selected_images_info = self.input_dict["selected_images_info"]
-        images_info_type = self.input_dict["images_info_type"]
-        self.jobs_dict["to_process"] = self.get_local_images(selected_images_info) if images_info_type == "local_images" else self.get_images_from_url(selected_images_info)
-        self.jobs_runner = JobsRunner(self.msg, self.user_name, self.input_dict, self.volume)
+        if resume:
+            self.load_queued_jobs()
+        else:
+            selected_images_info = self.input_dict["selected_images_info"]
+            images_info_type = self.input_dict["images_info_type"]
+            self.jobs_dict["to_process"] = self.get_local_images(selected_images_info) if images_info_type == "local_images" else self.get_images_from_url(selected_images_info)
+        self.job_queue.add_volume(self.volume.name, self.input_dict, self.user_name)
+        self.jobs_runner = JobsRunner(self.msg, self.user_name, self.input_dict, self.volume, self.job_queue, self.event_bus)
         self.jobs_runner.load_jobs(self.jobs_dict)
 
-                          
+    def load_queued_jobs(self):
+        # picks up a run from the job queue; images already committed to the volume are never sent to a model again
+        volume_name = self.volume.name
+        self.job_queue.release_expired_leases(volume_name)
+        committed_image_refs = {page["image_ref"] for page in self.volume.pages}
+        for state in ["to_process", "failed"]:
+            for job_key in self.job_queue.get_job_keys(volume_name, [state]):
+                if job_key.split("/")[-1] in committed_image_refs:
+                    self.job_queue.mark_processed(volume_name, job_key)
+                    continue
+                self.jobs_dict[state].append(job_key)
+        in_flight = self.job_queue.get_job_keys(volume_name, ["in_process"])
+        if in_flight:
+            self.event_bus.publish(RunStatus(message=f"{len(in_flight)} image(s) are still leased by another run and were not resumed"))
+
     def get_local_images(self, images_info):
+        # jobs are image names in the temp images folder; images are decoded and encoded when they are processed
         images_to_process = []
         for uploaded_file in images_info:
             try:
-                image = Image.open(uploaded_file)
-                buffer = BytesIO()
-                image.save(buffer, format="JPEG")
-                image_bytes = buffer.getvalue()
-                base64_image = base64.b64encode(image_bytes).decode('utf-8')
-                image_name = uploaded_file.name
-                with open(f"{self.temp_images_folder}/{image_name}", "wb") as f:
-                    image.save(f)
-                images_to_process.append((base64_image, image_name, image))
+                images_to_process.append(self.image_loader.save_upload(uploaded_file))
             except Exception as e:
                 self.msg["errors"].append(f"Could not open {uploaded_file}: {e}") 
+                self.add_dead_letter(getattr(uploaded_file, "name", str(uploaded_file)), e)
         return images_to_process
 
     def get_images_from_url(self, images_info):
-        images_to_process = []
-        for url in images_info:
-            try:
-                response = requests.get(url)
-                image = Image.open(BytesIO(response.content))
-                buffer = BytesIO()
-                image.save(buffer, format="JPEG")
-                image_bytes = buffer.getvalue()
-                base64_image = base64.b64encode(image_bytes).decode('utf-8')
-                image_name = url.split('/')[-1]  # Gets the last part of the URL as filename
-                if not any(image_name.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png']):
-                    image_name += '.jpg'
-                with open(f"{self.temp_images_folder}/{image_name}", "wb") as f:
-                    image.save(f)
-                images_to_process.append((base64_image, url, image))
-            except Exception as e:
-                self.msg["errors"].append(f"Could not open {url}: {e}") 
-        return images_to_process    
+        # urls are downloaded by the processing pipeline, so the first transcript doesn't wait for the whole batch
+        return list(images_info)
+
+    def add_dead_letter(self, image_ref, e):
+        error = e if isinstance(e, ProcessingError) else ImageUnreadableError(f"{type(e).__name__}: {e}")
+        self.jobs_dict["dead_letter"].append({"image ref": image_ref, "attempts": 1, "time failed": time.strftime("%Y-%m-%d-%H%M-%S")} | error.to_dict())
+        self.job_queue.enqueue(self.volume.name, [image_ref])
+        self.job_queue.mark_failed(self.volume.name, image_ref, error.error_type, error.message)
 
     def get_blank_jobs_dict(self):
         return {
@@ -79,6 +81,7 @@ class ProcessingManager:
             "in_process": [],
             "processed": [],
             "failed": [],
+            "dead_letter": [],
             "transcript_objs": [],
             "pages": []
         }        
@@ -90,4 +93,13 @@ class ProcessingManager:
         self.jobs_runner.process_jobs()
 
     def resume_jobs(self, try_failed_jobs, batch_size=None):
-        self.jobs_runner.resume_jobs(try_failed_jobs, batch_size)    
\ No newline at end of file
+        self.jobs_runner.resume_jobs(try_failed_jobs, batch_size)
+
+    def set_focus(self, position, direction=1):
+        self.jobs_runner.set_focus(position, direction)
+
+    def pause_jobs(self):
+        self.jobs_runner.pause_jobs()
+
+    def cancel_jobs(self):
+        self.jobs_runner.cancel_jobs()
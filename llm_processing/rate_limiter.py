@@ -0,0 +1,209 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+# starting limits per provider; header-driven providers correct these after the first response
+DEFAULT_LIMITS = {
+    "anthropic": {"requests": 50, "input tokens": 40_000, "output tokens": 8_000, "tokens": None},
+    "openai": {"requests": 500, "input tokens": None, "output tokens": None, "tokens": 30_000},
+    "bedrock": {"requests": None, "input tokens": None, "output tokens": None, "tokens": None},
+}
+UNLIMITED = {"requests": None, "input tokens": None, "output tokens": None, "tokens": None}
+
+# (limit header, remaining header) for each bucket, Anthropic first, then OpenAI
+HEADER_KEYS = {
+    "requests": [("anthropic-ratelimit-requests-limit", "anthropic-ratelimit-requests-remaining"), ("x-ratelimit-limit-requests", "x-ratelimit-remaining-requests")],
+    "input tokens": [("anthropic-ratelimit-input-tokens-limit", "anthropic-ratelimit-input-tokens-remaining")],
+    "output tokens": [("anthropic-ratelimit-output-tokens-limit", "anthropic-ratelimit-output-tokens-remaining")],
+    "tokens": [("anthropic-ratelimit-tokens-limit", "anthropic-ratelimit-tokens-remaining"), ("x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens")],
+}
+
+INITIAL_INPUT_TOKENS_ESTIMATE = 1500
+INITIAL_OUTPUT_TOKENS_ESTIMATE = 500
+ESTIMATE_SMOOTHING = 0.2
+DEFAULT_THROTTLE_PAUSE = 5.0
+THROTTLE_BACKOFF = 0.8
+QUIET_PERIOD = 60.0
+LEARNED_LIMIT_GROWTH = 1.1
+MAX_WAIT_STEP = 1.0
+
+
+def get_retry_after(headers):
+    if not headers:
+        return None
+    headers = {str(k).lower(): v for k, v in dict(headers).items()}
+    try:
+        return float(headers["retry-after"]) if "retry-after" in headers else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """A per-minute budget that refills continuously; a limit of None means unlimited."""
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.available = per_minute or 0
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.per_minute is not None:
+            elapsed = now - self.updated
+            self.available = min(self.per_minute, self.available + elapsed * self.per_minute / 60)
+        self.updated = now
+
+    def get_wait_time(self, amount, now):
+        if self.per_minute is None:
+            return 0
+        self.refill(now)
+        # a request larger than the whole bucket only waits for a full bucket
+        amount = min(amount, self.per_minute)
+        if self.available >= amount:
+            return 0
+        return (amount - self.available) * 60 / self.per_minute
+
+    def consume(self, amount):
+        if self.per_minute is not None:
+            self.available -= amount
+
+    def set_limit(self, per_minute, remaining, now):
+        self.refill(now)
+        if self.per_minute is None:
+            self.available = per_minute
+        self.per_minute = per_minute
+        self.available = min(self.available, per_minute)
+        if remaining is not None:
+            self.available = min(self.available, remaining)
+
+
+class RateLimiter:
+    """Requests, input-token, output-token and combined-token buckets for one provider and model."""
+
+    def __init__(self, provider, model, limits):
+        self.provider = provider
+        self.model = model
+        self.lock = threading.Lock()
+        self.buckets = {name: TokenBucket(per_minute) for name, per_minute in limits.items()}
+        self.blocked_until = 0
+        self.request_times = deque()
+        self.average_tokens = {"input tokens": INITIAL_INPUT_TOKENS_ESTIMATE, "output tokens": INITIAL_OUTPUT_TOKENS_ESTIMATE}
+        self.has_learned_limit = False
+        self.last_throttle = 0
+        self.last_growth = 0
+        self.throttle_count = 0
+
+    def get_estimate(self):
+        input_tokens = self.average_tokens["input tokens"]
+        output_tokens = self.average_tokens["output tokens"]
+        return {"requests": 1, "input tokens": input_tokens, "output tokens": output_tokens, "tokens": input_tokens + output_tokens}
+
+    def trim_request_times(self, now):
+        while self.request_times and now - self.request_times[0] > 60:
+            self.request_times.popleft()
+
+    def try_reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            estimate = self.get_estimate()
+            wait_time = max([self.blocked_until - now] + [bucket.get_wait_time(estimate[name], now) for name, bucket in self.buckets.items()])
+            if wait_time > 0:
+                return None, wait_time
+            for name, bucket in self.buckets.items():
+                bucket.consume(estimate[name])
+            self.request_times.append(now)
+            self.trim_request_times(now)
+            return estimate, 0
+
+    def acquire(self, cancellation_token=None):
+        while True:
+            if cancellation_token:
+                cancellation_token.raise_if_cancelled()
+            reservation, wait_time = self.try_reserve()
+            if reservation:
+                return reservation
+            time.sleep(min(wait_time, MAX_WAIT_STEP))
+
+    async def acquire_async(self, cancellation_token=None):
+        while True:
+            if cancellation_token:
+                cancellation_token.raise_if_cancelled()
+            reservation, wait_time = self.try_reserve()
+            if reservation:
+                return reservation
+            await asyncio.sleep(min(wait_time, MAX_WAIT_STEP))
+
+    def record_usage(self, reservation, input_tokens, output_tokens):
+        # settle the estimate taken at reservation time against what the provider actually counted
+        actual = {"requests": 1, "input tokens": input_tokens, "output tokens": output_tokens, "tokens": input_tokens + output_tokens}
+        with self.lock:
+            now = time.monotonic()
+            for name, bucket in self.buckets.items():
+                bucket.refill(now)
+                bucket.consume(actual[name] - reservation[name])
+            if input_tokens or output_tokens:
+                for name in self.average_tokens:
+                    self.average_tokens[name] += ESTIMATE_SMOOTHING * (actual[name] - self.average_tokens[name])
+                self.grow_learned_limit(now)
+
+    def grow_learned_limit(self, now):
+        requests_bucket = self.buckets["requests"]
+        if not self.has_learned_limit or now - self.last_throttle < QUIET_PERIOD or now - self.last_growth < QUIET_PERIOD:
+            return
+        requests_bucket.per_minute = max(requests_bucket.per_minute + 1, int(requests_bucket.per_minute * LEARNED_LIMIT_GROWTH))
+        self.last_growth = now
+
+    def record_throttle(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            self.throttle_count += 1
+            self.last_throttle = now
+            self.blocked_until = max(self.blocked_until, now + (retry_after or DEFAULT_THROTTLE_PAUSE))
+            # providers without rate-limit headers (Bedrock) get their request limit learned from the rate that was throttled
+            self.trim_request_times(now)
+            learned_limit = max(1, int(len(self.request_times) * THROTTLE_BACKOFF))
+            requests_bucket = self.buckets["requests"]
+            if requests_bucket.per_minute is None or learned_limit < requests_bucket.per_minute:
+                requests_bucket.set_limit(learned_limit, 0, now)
+                self.has_learned_limit = True
+
+    def update_from_headers(self, headers):
+        if not headers:
+            return
+        headers = {str(k).lower(): v for k, v in dict(headers).items()}
+        with self.lock:
+            now = time.monotonic()
+            for name, header_keys in HEADER_KEYS.items():
+                for limit_key, remaining_key in header_keys:
+                    if limit_key not in headers:
+                        continue
+                    try:
+                        limit = float(headers[limit_key])
+                        remaining = float(headers[remaining_key]) if remaining_key in headers else None
+                    except ValueError:
+                        continue
+                    self.buckets[name].set_limit(limit, remaining, now)
+                    if name == "requests":
+                        self.has_learned_limit = False
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "provider": self.provider,
+                "model": self.model,
+                "limits per minute": {name: bucket.per_minute for name, bucket in self.buckets.items()},
+                "throttle count": self.throttle_count,
+            }
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider, model):
+    # one limiter per provider and model, shared by every worker in the process
+    key = (provider, model)
+    with rate_limiters_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = RateLimiter(provider, model, dict(DEFAULT_LIMITS.get(provider, UNLIMITED)))
+        return rate_limiters[key]
@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+import time
+from llm_processing.errors import ThrottledError, TransientNetworkError, ProviderFatalError
+
+ROUTING_TABLE_PATH = "llm_processing/routing_table.json"
+# selected llm name -> the same model served elsewhere, in the order they are tried
+ROUTING_TABLE = {
+    "claude-3.5-sonnet": ["bedrock-anthropic.claude-3-5-sonnet-20240620-v1:0"],
+    "bedrock-anthropic.claude-3-5-sonnet-20240620-v1:0": ["claude-3.5-sonnet"],
+    "bedrock-us.anthropic.claude-3-5-sonnet-20240620-v1:0": ["claude-3.5-sonnet"],
+}
+FAILURE_THRESHOLD = 5
+OPEN_SECONDS = 60
+# errors that say something about the endpoint; a bad image or an unparsable answer would fail anywhere
+ENDPOINT_ERRORS = (ThrottledError, TransientNetworkError, ProviderFatalError)
+
+
+def get_routing_table(path=ROUTING_TABLE_PATH):
+    # a routing_table.json next to this module adds to or overrides the built-in routes
+    routing_table = dict(ROUTING_TABLE)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            routing_table.update(json.load(f))
+    return routing_table
+
+
+def get_endpoints(llm, routing_table=None):
+    routing_table = routing_table if routing_table is not None else get_routing_table()
+    return [llm] + [endpoint for endpoint in routing_table.get(llm, []) if endpoint != llm]
+
+
+def is_endpoint_error(e):
+    return isinstance(e, ENDPOINT_ERRORS)
+
+
+class CircuitBreaker:
+    """Health of one endpoint: opens after failure_threshold endpoint errors in a row and skips the endpoint for open_seconds.
+
+    After that one trial request is let through (half open); a success closes the circuit again, a failure reopens it.
+    A trial that never reports back frees the slot for another after open_seconds.
+    """
+
+    def __init__(self, endpoint, failure_threshold=FAILURE_THRESHOLD, open_seconds=OPEN_SECONDS):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.num_successes = 0
+        self.num_failures = 0
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = "half open"
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                print(f"Circuit for {self.endpoint} closed")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.num_successes += 1
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.num_failures += 1
+            if self.state == "half open" or (self.state == "closed" and self.consecutive_failures >= self.failure_threshold):
+                print(f"Circuit for {self.endpoint} opened after {self.consecutive_failures} failure(s) in a row")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def get_retry_after(self):
+        with self.lock:
+            if self.state == "closed":
+                return 0
+            return max(0, self.open_seconds - (time.monotonic() - self.opened_at))
+
+    def get_status(self):
+        with self.lock:
+            return {"endpoint": self.endpoint, "state": self.state, "successes": self.num_successes, "failures": self.num_failures}
+
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint):
+    # one per endpoint per process, shared by every run
+    with circuit_breakers_lock:
+        if endpoint not in circuit_breakers:
+            circuit_breakers[endpoint] = CircuitBreaker(endpoint)
+        return circuit_breakers[endpoint]
@@ -0,0 +1,78 @@
+import bisect
+import math
+import threading
+
+# how many of the images ahead of the reviewer go in the interactive lane
+INTERACTIVE_WINDOW = 3
+INTERACTIVE_SLOTS = 1
+
+
+class LaneScheduler:
+    """Hands out a run's jobs from two lanes.
+
+    The interactive lane holds the next interactive_window images the reviewer will come to, counted from the page
+    they are on in the direction they last moved. The bulk lane holds everything else in input order.
+    Interactive jobs always go first, and while a reviewer is following the run, bulk jobs leave interactive_slots
+    of the concurrency limit free, so a page the reviewer moves to can start straight away.
+    """
+
+    def __init__(self, interactive_window=INTERACTIVE_WINDOW, interactive_slots=INTERACTIVE_SLOTS):
+        self.interactive_window = interactive_window
+        self.interactive_slots = interactive_slots
+        self.lock = threading.Lock()
+        # jobs are keyed by (position in the input, idx), so both lanes sort by position
+        self.jobs = {}
+        self.bulk = []
+        self.interactive = []
+        self.focus = None
+
+    def load(self, images_to_process, positions):
+        # images_to_process is a list of (idx, job) pairs; positions gives each one's place in the input
+        with self.lock:
+            self.jobs = {(position, idx): (idx, job) for position, (idx, job) in zip(positions, images_to_process)}
+            self.bulk = sorted(self.jobs)
+            self.interactive = []
+            self.split_lanes()
+
+    def set_focus(self, position, direction=1):
+        # position is the input position of the page the reviewer is on, -1 before any page is in
+        with self.lock:
+            self.focus = (position, direction)
+            self.split_lanes()
+
+    def split_lanes(self):
+        for key in self.interactive:
+            bisect.insort(self.bulk, key)
+        self.interactive = []
+        if self.focus is None:
+            return
+        position, direction = self.focus
+        if direction >= 0:
+            start = bisect.bisect_right(self.bulk, (position, math.inf))
+            end = start + self.interactive_window
+            self.interactive = self.bulk[start:end]
+        else:
+            end = bisect.bisect_left(self.bulk, (position,))
+            start = max(0, end - self.interactive_window)
+            self.interactive = self.bulk[start:end][::-1]
+        del self.bulk[start:end]
+
+    def get_next_job(self, num_in_flight=0, limit=None):
+        # returns an (idx, job) pair, or None when nothing may start with num_in_flight of limit slots taken
+        with self.lock:
+            if limit is not None and num_in_flight >= limit:
+                return None
+            if self.interactive:
+                return self.jobs.pop(self.interactive.pop(0))
+            reserved = min(self.interactive_slots, limit - 1) if self.focus is not None and limit is not None else 0
+            if self.bulk and (limit is None or num_in_flight < limit - reserved):
+                return self.jobs.pop(self.bulk.pop(0))
+            return None
+
+    def has_jobs(self):
+        with self.lock:
+            return bool(self.jobs)
+
+    def get_status(self):
+        with self.lock:
+            return {"interactive": len(self.interactive), "bulk": len(self.bulk)}
@@ -6,7 +6,6 @@ parent = os.path.dirname(current)
 sys.path.append(parent)
 
 import requests
-from PIL import Image
 from io import BytesIO
 import base64
 import re
@@ -20,6 +19,8 @@ from llm_processing.compare2 import TranscriptComparer
 from llm_processing import utility
 from llm_processing.volume import Volume
 from llm_processing.processing_manager import ProcessingManager
+from llm_processing.job_queue import JobQueue
+from llm_processing.event_bus import EventBus, RunStatus, ProgressCounters
 import time
 
 class Session:
@@ -28,10 +29,11 @@ class Session:
         self.session_start_time = self.get_timestamp()
         self.overall_session_time = 0
         self.name = f"{self.user_name}-{self.session_start_time}"
-        self.msg = {"pause_button_enabled": False, "status": []}
+        self.msg = {"pause_button_enabled": False}
+        self.reset_event_bus()
         self.table_type = "page"
         self.table_content_option = "content"
-        self.input_dict = {"api_key_dict": {}, "selected_llms": [], "selected_images_info": [], "images_info_type": ""}
+        self.input_dict = {"api_key_dict": {}, "selected_llms": [], "selected_images_info": [], "images_info_type": "", "max_workers": 1, "execution_mode": "threads", "adaptive_concurrency": False, "volume_budget": 0, "daily_budget": 0, "budget_action": "pause", "batch_backend": "provider", "cascade": False, "hedge_requests": False, "failover": False, "normalize_images": True, "crop_labels": False}
         self.volume = None
         self.pages = []
         self.final_output = ""
@@ -41,6 +43,7 @@ class Session:
         self.ensure_directory_exists(self.temp_images_folder)
         self.processing_manager = None
         self.background_processing = False
+        self.job_queue = None
     
 
     def dict_to_text(self, d):
@@ -88,9 +91,6 @@ class Session:
     def get_data_for_table(self) -> list[dict]:
         return self.volume.current_transcript_obj.versions[self.table_content_option] if self.table_type=="page" else self.volume.data["costs"]      
 
-    def get_image_from_temp_folder(self, image_ref):
-        image = Image.open(f"{self.temp_images_folder}/{image_ref}")
-        return image                                 
 #
     def get_legal_json_filename(self, image_ref):
         ref = re.sub(r"[\/]", "#", image_ref)
@@ -132,6 +132,7 @@ class Session:
             else:
                 self.volume.current_page_idx = 0
             self.load_current_transcript_obj()
+            self.set_review_focus(1)
             
     def go_previous_image(self):
         if self.pages:
@@ -141,6 +142,7 @@ class Session:
             else:
                 self.volume.current_page_idx = len(self.pages) - 1
             self.load_current_transcript_obj()
+            self.set_review_focus(-1)
 
     def go_to_next_field(self):
         field_idx = self.volume.field_idx
@@ -177,14 +179,15 @@ class Session:
     def process_initial_batch(self, volume_name, initial_batch_size):
         self.volume = self.initialize_volume(volume_name)
         self.pages = self.volume.pages
-        self.processing_manager = ProcessingManager(self.msg, self.input_dict, self.volume, self.user_name)
+        self.processing_manager = ProcessingManager(self.msg, self.input_dict, self.volume, self.user_name, event_bus=self.reset_event_bus(), job_queue=self.get_job_queue())
+        self.set_review_focus()
         try:
             self.processing_manager.process_initial_batch(initial_batch_size)
             print("session process_batch returned")
             print(f"{self.volume.pages = }")
         except Exception as e:
             self.msg["errors"].append(f"Error processing images: {str(e)}")
-        self.msg["status"].append(f"Volume {volume_name} created and saved!!!!")      
+        self.event_bus.publish(RunStatus(message=f"Volume {volume_name} created and saved!!!!"))      
         
     def recreate_transcript_obj(self, transcript_dict):
         image_name = transcript_dict["generation info"][-1]["image ref"]
@@ -193,8 +196,7 @@ class Session:
         transcript_obj = Transcript(image_source, prompt_name)
         transcript_obj.versions = transcript_dict
         version_name = transcript_obj.create_new_version_for_user(self.user_name)
-        image = self.get_image_from_temp_folder(image_name)
-        page = {"image_ref": image_name, "transcript_obj": transcript_obj, "image": image, "version_name": version_name}
+        page = {"image_ref": image_name, "transcript_obj": transcript_obj, "version_name": version_name}
         self.volume.add_page(page)
 
     def re_edit_volume(self, selected_volume_file):
@@ -220,16 +222,76 @@ class Session:
         self.msg["reedit_mode"] = False
 #    
     def reset_inputs(self):
-        self.input_dict = {"api_key_dict": {}, "selected_llms": [], "selected_images_info": [], "images_info_type": ""}
+        self.input_dict = {"api_key_dict": {}, "selected_llms": [], "selected_images_info": [], "images_info_type": "", "max_workers": 1, "execution_mode": "threads", "adaptive_concurrency": False, "volume_budget": 0, "daily_budget": 0, "budget_action": "pause", "batch_backend": "provider", "cascade": False, "hedge_requests": False, "failover": False, "normalize_images": True, "crop_labels": False}
 #
     def reset_msg(self):
         print(f"session.reset_msg called")
-        self.msg = {"pause_button_enabled": False, "status": []}
+        self.msg = {"pause_button_enabled": False}
+
+    def reset_event_bus(self):
+        # each run gets its own bus; the status bar and the progress counters read from it, never from lists the workers append to
+        self.event_bus = EventBus()
+        self.progress = ProgressCounters()
+        self.event_bus.subscribe(self.progress.handle)
+        self.status_subscription = self.event_bus.subscribe()
+        self.status_lines = []
+        return self.event_bus
+
+    def get_status_lines(self):
+        self.status_lines += [event.message for event in self.status_subscription.get_events() if event.message]
+        return self.status_lines
+
+    def get_progress(self):
+        return self.progress.get_snapshot()
+
+    def set_review_focus(self, direction=1):
+        # images just ahead of the reviewer, in the direction they are moving, are processed before the rest
+        if self.processing_manager:
+            self.processing_manager.set_focus(self.volume.get_current_position(), direction)
 
     def resume_jobs(self, try_failed_jobs, batch_size=None):
         self.msg["pause_button_enabled"] = False
         self.processing_manager.resume_jobs(try_failed_jobs, batch_size)
 
+    def pause_jobs(self):
+        if self.processing_manager:
+            self.processing_manager.pause_jobs()
+
+    def cancel_jobs(self):
+        if self.processing_manager:
+            self.processing_manager.cancel_jobs()
+
+    def get_job_queue(self):
+        # one connection for the session, rather than one per Streamlit rerun
+        if self.job_queue is None:
+            self.job_queue = JobQueue()
+        return self.job_queue
+
+    def get_resumable_volumes(self):
+        return self.get_job_queue().get_unfinished_volumes()
+
+    def get_job_state_counts(self, volume_name):
+        return self.get_job_queue().get_state_counts(volume_name)
+
+    def resume_interrupted_volume(self, volume_name, api_key_dict):
+        job_queue = self.get_job_queue()
+        settings = job_queue.get_volume_settings(volume_name)
+        if not settings:
+            self.msg["errors"] = [f"No saved settings found for {volume_name}"]
+            return False
+        volume_file = f"{volume_name}-volume.json"
+        if os.path.exists(f"{self.transcription_folder}/volumes/{volume_file}"):
+            self.re_edit_volume(volume_file)
+            self.volume.reorder_pages(job_queue.get_positions(volume_name))
+        else:
+            self.volume = self.initialize_volume(volume_name)
+            self.pages = self.volume.pages
+        self.input_dict = {name: settings[name] for name in settings if name != "user_name"} | {"api_key_dict": api_key_dict, "selected_images_info": []}
+        self.processing_manager = ProcessingManager(self.msg, self.input_dict, self.volume, self.user_name, resume=True, event_bus=self.reset_event_bus(), job_queue=self.get_job_queue())
+        self.set_review_focus()
+        self.event_bus.publish(RunStatus(message=f"Resuming {volume_name}: {len(self.processing_manager.jobs_dict['to_process'])} image(s) left to process"))
+        return True
+
     def save_edits_as_text(self):
         self.final_output = self.get_combined_output_as_text() 
    
@@ -0,0 +1,124 @@
+import sys
+import os
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+import argparse
+import json
+import multiprocessing
+import signal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from llm_processing.batch import BatchRun, ProgressReporter, get_image_sources
+from llm_processing.volume import Volume
+from llm_processing.job_queue import JobQueue
+
+
+def get_shard_volume_prefix(volume_name):
+    return f"{volume_name}-shard-"
+
+
+def get_shard_volume_name(volume_name, shard_idx, num_shards):
+    return f"{get_shard_volume_prefix(volume_name)}{shard_idx + 1}-of-{num_shards}"
+
+
+def run_shard(args, shard_volume_name, sources):
+    # runs in a worker process, with its own provider clients, rate limiters and job queue connection
+    shard_args = argparse.Namespace(**vars(args))
+    shard_args.volume = shard_volume_name
+    # every shard charges the whole volume's budget, rather than each getting a budget of its own
+    shard_args.budget_volume = args.volume
+    shard_args.processes = 1
+    shard_args.progress_interval = 0
+    BatchRun(shard_args).run(sources)
+    return shard_volume_name
+
+
+class ShardCoordinator:
+    """Splits a batch across worker processes, each writing its own shard volume, and merges the shards into one volume."""
+
+    def __init__(self, args):
+        self.args = args
+        self.msg = {"pause_button_enabled": False, "errors": []}
+        self.num_shards = args.processes
+        self.volume = Volume(self.msg, args.volume)
+        self.shard_volume_names = [get_shard_volume_name(args.volume, shard_idx, self.num_shards) for shard_idx in range(self.num_shards)]
+
+    def get_volume_file(self, volume_name):
+        return f"{self.volume.volumes_folder}/{volume_name}-volume.json"
+
+    def get_earlier_shard_volume_names(self, job_queue):
+        # shard volumes from runs with a different --processes, whose images went to other shards than they would now
+        return [volume_name for volume_name in job_queue.get_volume_names(get_shard_volume_prefix(self.volume.name)) if volume_name not in self.shard_volume_names]
+
+    def get_done_keys(self, job_queue, volume_names):
+        # images that failed before are skipped too unless --retry-failed is given, as in BatchRun
+        states = ["processed"] if self.args.retry_failed else ["processed", "failed"]
+        return {job_key for volume_name in volume_names for job_key in job_queue.get_job_keys(volume_name, states)}
+
+    def get_shards(self, sources):
+        # round robin, so every shard gets a similar mix of the input and the shards finish together
+        return [sources[shard_idx::self.num_shards] for shard_idx in range(self.num_shards)]
+
+    def run(self):
+        for volume_name in [self.volume.name] + self.shard_volume_names:
+            if os.path.exists(self.get_volume_file(volume_name)) and not self.args.resume:
+                raise SystemExit(f"{self.get_volume_file(volume_name)} already exists; pass --resume to continue it or choose another --volume")
+        sources = list(get_image_sources(self.args))
+        positions = {source: position for position, source in enumerate(sources)}
+        job_queue = JobQueue(self.args.queue_path)
+        earlier_shard_volume_names = self.get_earlier_shard_volume_names(job_queue) if self.args.resume else []
+        if earlier_shard_volume_names:
+            done_keys = self.get_done_keys(job_queue, earlier_shard_volume_names)
+            num_sources = len(sources)
+            sources = [source for source in sources if source not in done_keys]
+            print(f"Skipping {num_sources - len(sources)} image(s) already done in {', '.join(earlier_shard_volume_names)}")
+        print(f"Splitting {len(sources)} image(s) across {self.num_shards} processes")
+        reporter = ProgressReporter(job_queue, self.shard_volume_names, self.args.progress_interval)
+        if self.args.progress_interval:
+            reporter.start()
+        try:
+            self.run_shards(self.get_shards(sources))
+        finally:
+            if self.args.progress_interval:
+                reporter.stop()
+            job_queue.close()
+        self.merge_shards(positions, earlier_shard_volume_names)
+
+    def handle_interrupt(self, signum, frame):
+        # Ctrl+C reaches every shard process too; each pauses or cancels its own run, and the coordinator merges what they finished
+        print("Stopping shards...")
+
+    def run_shards(self, shards):
+        signal.signal(signal.SIGINT, self.handle_interrupt)
+        # spawn rather than fork: the parent already has threads, and it matches how workers start on Windows
+        mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.num_shards, mp_context=mp_context) as executor:
+            futures = {executor.submit(run_shard, self.args, shard_volume_name, shard): shard_volume_name for shard_volume_name, shard in zip(self.shard_volume_names, shards) if shard}
+            for future in as_completed(futures):
+                try:
+                    print(f"{future.result()} finished")
+                except Exception as e:
+                    print(f"{futures[future]} stopped with an error; rerun with --resume to finish it: {type(e).__name__}: {e}")
+
+    def merge_shards(self, positions, earlier_shard_volume_names=()):
+        dead_letter = []
+        for shard_volume_name in list(earlier_shard_volume_names) + self.shard_volume_names:
+            shard_volume_file = self.get_volume_file(shard_volume_name)
+            if os.path.exists(shard_volume_file):
+                shard_volume = Volume(self.msg, shard_volume_name)
+                shard_volume.load_from_json(shard_volume_file)
+                self.volume.merge_volume(shard_volume, positions)
+            dead_letter_file = f"{self.volume.volumes_folder}/{shard_volume_name}-dead-letter.json"
+            if os.path.exists(dead_letter_file):
+                with open(dead_letter_file, "r", encoding="utf-8") as f:
+                    dead_letter += json.load(f)
+        if not self.volume.pages:
+            print("No pages were transcribed; nothing to merge")
+            return
+        self.volume.commit_volume()
+        print(f"Merged {len(self.volume.pages)} page(s) into {self.get_volume_file(self.volume.name)}")
+        if dead_letter:
+            with open(f"{self.volume.volumes_folder}/{self.volume.name}-dead-letter.json", "w", encoding="utf-8") as f:
+                json.dump(dead_letter, f, ensure_ascii=False, indent=4)
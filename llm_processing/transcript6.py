@@ -16,15 +16,15 @@ import math
 import copy
 from llm_processing.compare2 import TranscriptComparer
 from llm_processing.utility import get_fieldnames_from_prompt
-from llm_processing.utility import get_image_from_url
+from llm_processing.downloader import get_downloader
+from llm_processing.image_store import get_image_store
 
 
 class Transcript:
     def __init__(self, image_filename: str, prompt_name: str):
         self.transcription_folder = "output"
         self.ensure_directory_exists(self.transcription_folder)
-        self.images_folder = "temp_images"
-        self.ensure_directory_exists(self.images_folder)
+        self.image_store = get_image_store()
         self.image_ref = self.get_image_ref(image_filename)
         self.versions =  self.load_versions()
         self.image_source = self.ensure_image_saved(image_filename)
@@ -70,13 +70,13 @@ class Transcript:
 
     def ensure_image_saved(self, image_filename):
         print(f"{image_filename = }")
-        image_is_saved = self.is_in_images_folder(self.image_ref)
-        print(f"{image_is_saved = }")
         image_source = image_filename if not self.versions else self.versions["generation info"][0]["image source"]
-        if not image_is_saved and "http" in image_source:
+        url = image_source if "http" in image_source else None
+        image_is_saved = self.is_in_images_folder(self.image_ref, url)
+        print(f"{image_is_saved = }")
+        if not image_is_saved and url:
             print(f"downloading image: {image_source = }")
-            image = get_image_from_url(image_source)
-            image.save(f"{self.images_folder}/{self.image_ref}")
+            self.image_store.put(get_downloader().download(image_source), self.image_ref, url)
         return image_source            
 
     def file_exists(self, filename):
@@ -200,8 +200,8 @@ class Transcript:
         self.versions["editing"].append({"version name": version_name} | self.get_blank_editing_dict())
         self.versions["generation info"].append({"version name": version_name} | self.get_blank_generation_info_dict()) 
 
-    def is_in_images_folder(self, image_ref):
-        return os.path.exists(f"{self.images_folder}/{image_ref}")        
+    def is_in_images_folder(self, image_ref, url=None):
+        return self.image_store.has(image_ref, url)        
 
     def is_same_user(self, created_by):
         return self.versions["generation info"] and self.versions["generation info"][-1]["created by"] == created_by
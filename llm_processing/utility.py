@@ -1,10 +1,21 @@
+import os
 import re
-import requests
 from PIL import Image
 from io import BytesIO
-import base64
+from llm_processing.downloader import get_downloader
+from llm_processing.image_loader import encode_image
+from llm_processing.image_store import get_image_store
+from llm_processing.errors import ProcessingError
 import csv
 
+def get_api_key_dict_from_env():
+    api_key_dict = {}
+    if "OPENAI_API_KEY" in os.environ:
+        api_key_dict["gpt-4o_key"] = os.getenv("OPENAI_API_KEY")
+    if "ANTHROPIC_API_KEY" in os.environ:
+        api_key_dict["claude-3.5-sonnet_key"] = os.getenv("ANTHROPIC_API_KEY")
+    return api_key_dict
+
 def get_blank_transcript(prompt_text):
     fieldnames = get_fieldnames_from_prompt_text(prompt_text)
     return {fieldname: "" for fieldname in fieldnames}
@@ -60,24 +71,19 @@ def get_image_name_url(url):
 def get_image_from_url(url):
     try:
         print(f"Processing image: '{url = }'")
-        response = requests.get(url.strip())
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
+        image = Image.open(BytesIO(get_downloader().download(url)))
         return image
-    except requests.exceptions.RequestException as e:
+    except ProcessingError as e:
         error_message = f"Error processing image: '{url}': {str(e)}"
         print(f"ERROR: {error_message}")
         return error_message
 
 def get_base64_image(image):
-    buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return img_str
+    return encode_image(image)
 
 def get_image_from_temp_folder(image_name):
     try:
-        image = Image.open(f"temp_images/{image_name}")
+        image = get_image_store().open_image(image_name)
         base64_image = get_base64_image(image)
         return base64_image
     except Exception as e:
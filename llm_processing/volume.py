@@ -1,6 +1,10 @@
 from llm_processing.transcript6 import Transcript
+from llm_processing.page_images import get_page_image_cache
+from llm_processing.previews import get_preview_builder
 import json
 import csv
+import bisect
+import threading
 
 class Volume:
     def __init__(self, msg, name):
@@ -8,18 +12,61 @@ class Volume:
         self.name = name
         self.volumes_folder = "output/volumes"
         self.pages = []
+        self.page_order = []
+        self.lock = threading.RLock()
         self.current_page_idx = 0
         self.current_page = None
         self.field_idx = 0
         self.data = {}
 
-    def add_page(self, d):
-        self.pages.append(d)
+    def add_page(self, d, order=None):
+        # pages added with an order (e.g. input position of a concurrently processed image) stay sorted by it
+        with self.lock:
+            if order is None:
+                order = self.page_order[-1] + 1 if self.page_order else 0
+            idx = bisect.bisect_right(self.page_order, order)
+            # a page landing before the one being reviewed shifts it along, so the reviewer stays on the same page
+            if idx <= self.current_page_idx < len(self.pages):
+                self.current_page_idx += 1
+            self.page_order.insert(idx, order)
+            self.pages.insert(idx, d)
+
+    def reorder_pages(self, positions):
+        # positions maps job keys (urls or file names) to their place in the original input
+        positions = {job_key.split("/")[-1]: position for job_key, position in positions.items()}
+        with self.lock:
+            orders = [positions.get(page["image_ref"], idx) for idx, page in enumerate(self.pages)]
+            ordered = sorted(zip(orders, self.pages), key=lambda order_and_page: order_and_page[0])
+            self.page_order = [order for order, __ in ordered]
+            self.pages[:] = [page for __, page in ordered]
+
+    def load_from_json(self, filename=None):
+        # rebuilds pages from a saved volume file; used to pick up a headless run
+        filename = filename or f"{self.volumes_folder}/{self.name}-volume.json"
+        with open(filename, "r", encoding="utf-8") as f:
+            volume_dict = json.load(f)
+        for image_ref, versions in volume_dict.items():
+            if image_ref == "volume data":
+                self.set_data(versions)
+                continue
+            generation_info = versions["generation info"][-1]
+            transcript_obj = Transcript(generation_info["image source"], generation_info["prompt name"])
+            transcript_obj.versions = versions
+            self.add_page({"image_ref": image_ref, "transcript_obj": transcript_obj, "version_name": generation_info["version name"]})
+
+    def merge_volume(self, other, positions=None):
+        # positions maps job keys (the image sources) to their place in the combined input, so pages from several volumes interleave correctly
+        # keyed by the full source rather than the image ref, as pages from different folders or urls can share a file name
+        positions = positions or {}
+        with self.lock:
+            for page in other.pages:
+                self.add_page(page, positions.get(page["transcript_obj"].image_source))
 
     def commit_volume(self):
-        self.compile_volume_data()
-        self.save_volume_to_json()
-        self.save_volume_to_csv()    
+        with self.lock:
+            self.compile_volume_data()
+            self.save_volume_to_json()
+            self.save_volume_to_csv()    
 
     def compile_volume_data(self):
         self.data["costs"] = self.get_volume_costs()
@@ -48,6 +95,14 @@ class Volume:
                 return costs_dict
         print("no costs found")
 
+    def get_page_image(self, page):
+        # pages keep only their image ref; the decoded image comes from the shared page image cache
+        return get_page_image_cache().get_image(page["image_ref"], page["transcript_obj"].image_source)
+
+    def get_page_previews(self, page):
+        # the editor and the zoom viewer show these instead of the full image
+        return get_preview_builder().get_pyramid(page["image_ref"], page["transcript_obj"].image_source)
+
     def get_values_from_content(self, content_dict):
         return {k: v["value"] for k, v in content_dict.items()}                
 
@@ -102,7 +157,7 @@ class Volume:
     def set_current_page(self):  
         self.current_page = self.pages[self.current_page_idx]
         self.current_transcript_obj = self.pages[self.current_page_idx]["transcript_obj"]
-        self.current_image = self.pages[self.current_page_idx]["image"]
+        self.current_previews = self.get_page_previews(self.current_page)
         self.current_image_ref = self.pages[self.current_page_idx]["image_ref"]
         self.current_version_name = self.pages[self.current_page_idx]["version_name"]
         self.current_output_dict = self.current_transcript_obj.versions["content"][-1]
@@ -116,6 +171,11 @@ class Volume:
         self.field_idx = idx
         self.set_current_field() 
 
+    def get_current_position(self):
+        # the current page's place in the input, -1 before any page is in
+        with self.lock:
+            return self.page_order[self.current_page_idx] if self.current_page_idx < len(self.page_order) else -1
+
     def set_page_idx(self, idx):
         self.current_page_idx = idx
         self.set_current_page()       